@@ -1,4 +1,5 @@
 import argparse
+import os
 
 def get_train_args():
     """Get arguments needed in train.py."""
@@ -30,7 +31,7 @@ def get_train_args():
     parser.add_argument('--metric_name',
                         type=str,
                         default='F1',
-                        choices=('NLL', 'EM', 'F1'),
+                        choices=('NLL', 'F1', 'Precision', 'Recall', 'ROUGE-1', 'ROUGE-2', 'ROUGE-L'),
                         help='Name of dev metric to determine best checkpoint.')
     parser.add_argument('--max_checkpoints',
                         type=int,
@@ -48,20 +49,694 @@ def get_train_args():
                         type=float,
                         default=0.999,
                         help='Decay rate for exponential moving average of parameters.')
+    parser.add_argument('--val_num_threads',
+                        type=int,
+                        default=1,
+                        help='Number of threads used by the background validation process.')
+    parser.add_argument('--checkpoint_activations',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        choices=('encoders', 'bidaf', 'decoder', 'all'),
+                        help='Blocks whose activations are recomputed in the backward pass to save memory.')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Record the wall time, FLOPs and activation bytes of every stage of the model (see profiling.py), \
+                              written to TensorBoard and to <save_dir>/profile.json at every evaluation. Stages are only \
+                              attributed correctly with a single device per process.')
+    parser.add_argument('--dist_backend',
+                        type=str,
+                        default='gloo',
+                        help='torch.distributed backend used when launched with torchrun.')
 
     args = parser.parse_args()
 
     if args.metric_name == 'NLL':
         # Best checkpoint is the one that minimizes negative log-likelihood
         args.maximize_metric = False
-    elif args.metric_name in ('EM', 'F1'):
-        # Best checkpoint is the one that maximizes EM or F1
+    elif args.metric_name in ('F1', 'Precision', 'Recall', 'ROUGE-1', 'ROUGE-2', 'ROUGE-L'):
+        # Best checkpoint is the one that maximizes F1 or ROUGE
         args.maximize_metric = True
     else:
         raise ValueError(f'Unrecognized metric name: "{args.metric_name}"')
 
     return args
 
+def get_preprocess_args():
+    """Get arguments needed in preprocess_text.py."""
+    parser = argparse.ArgumentParser('Tokenize and clean the lecture transcripts')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, one numbered directory per course.')
+    parser.add_argument('--glove_path',
+                        type=str,
+                        default='/home/amankhullar/glove_data/glove.6B.300d.txt',
+                        help='GloVe vectors whose vocabulary decides which sentences are blank.')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of preprocessing processes.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Reprocess every transcript, even the ones unchanged since the last run.')
+    parser.add_argument('--no_embeddings',
+                        action='store_true',
+                        help='Do not (re)compute the packed sentence embeddings of the courses.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_keyframe_args():
+    """Get arguments needed in key_frame_extraction.py."""
+    parser = argparse.ArgumentParser('Extract the I-frames of the lecture videos')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, one numbered directory per course.')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of extraction processes, one video each.')
+    parser.add_argument('--keyframes_only',
+                        action='store_true',
+                        help='Only decode the keyframes. Faster, but misses I-frames that are not keyframes.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Extract every video, even the ones already extracted by a previous run.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_dedup_args():
+    """Get arguments needed in keyframe_dedup.py."""
+    parser = argparse.ArgumentParser('Drop near-duplicate keyframes and cache the features of the others')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, one numbered directory per course.')
+    parser.add_argument('--threshold',
+                        type=int,
+                        default=5,
+                        help='Keyframes whose 64-bit perceptual hashes differ by at most this many bits are near-duplicates.')
+    parser.add_argument('--max_frames',
+                        type=int,
+                        default=None,
+                        help='Maximum number of keyframes kept per video, evenly spread over it. No limit by default.')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of hashing processes.')
+    parser.add_argument('--cache_features',
+                        action='store_true',
+                        help='Also embed the kept keyframes missing from the content-addressed ResNet feature cache.')
+    parser.add_argument('--load_path',
+                        type=str,
+                        default=None,
+                        help='Checkpoint whose ResNet computes the cached features. The ImageNet weights by default.')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=32,
+                        help='Number of keyframes per ResNet forward pass.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_pack_args():
+    """Get arguments needed in pack_keyframes.py."""
+    parser = argparse.ArgumentParser('Pack the keyframes of every course into one array at model resolution')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, one numbered directory per course.')
+    parser.add_argument('--size',
+                        type=int,
+                        default=256,
+                        help='Short side of the packed keyframes, the long side follows their aspect ratio.')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of decoding processes.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Repack every course, even the ones whose store is up to date.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_audio_args():
+    """Get arguments needed in audio_features.py."""
+    parser = argparse.ArgumentParser('Compute the MFCC features of the lecture audio')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, one numbered directory per course.')
+    parser.add_argument('--audio_subdir',
+                        type=str,
+                        default='audio',
+                        help='Sub-directory of the courses with the extracted <video>.wav or .pcm audio. \
+                              The audio track of videos/<video>.mp4 is used for the videos without one.')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=22050,
+                        help='Sample rate the audio is resampled to.')
+    parser.add_argument('--pcm_rate',
+                        type=int,
+                        default=16000,
+                        help='Sample rate of the raw .pcm files (mono, 16-bit little-endian).')
+    parser.add_argument('--n_mfcc',
+                        type=int,
+                        default=128,
+                        help='Number of MFCC per frame, the audio_embedding_size of the model.')
+    parser.add_argument('--n_mels',
+                        type=int,
+                        default=128,
+                        help='Number of mel bands.')
+    parser.add_argument('--n_fft',
+                        type=int,
+                        default=2048,
+                        help='Length of the FFT window, in samples.')
+    parser.add_argument('--hop_length',
+                        type=int,
+                        default=512,
+                        help='Number of samples between successive frames.')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of processes, one video each.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Recompute the features of every video, even the ones already computed.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_ingest_args():
+    """Get arguments needed in ingest.py."""
+    parser = argparse.ArgumentParser('Ingest lectures from the raw videos, audio and transcripts to model-ready features')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, one numbered directory per course.')
+    parser.add_argument('--courses',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='Courses to ingest, all the courses of courses_dir with a videos/ directory by default.')
+    parser.add_argument('--glove_path',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/glove.6B.300d.txt',
+                        help='Path of the GloVe vectors.')
+    parser.add_argument('--catalog',
+                        type=str,
+                        default='dataset_inter2.pkl',
+                        help='Catalog of the videos read by the datasets, the ingested videos are added to it.')
+    parser.add_argument('--queue_size',
+                        type=int,
+                        default=4,
+                        help='Number of videos waiting between two stages before the earlier stage blocks.')
+    parser.add_argument('--keyframe_workers',
+                        type=int,
+                        default=2,
+                        help='Number of processes extracting keyframes.')
+    parser.add_argument('--image_workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes selecting the keyframes.')
+    parser.add_argument('--feature_workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes computing the ResNet features with --cache_features (one per GPU is enough).')
+    parser.add_argument('--audio_workers',
+                        type=int,
+                        default=2,
+                        help='Number of processes computing the audio features.')
+    parser.add_argument('--text_workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes processing the transcripts.')
+    parser.add_argument('--target_workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes aligning the ground-truth summaries.')
+    parser.add_argument('--keyframes_only',
+                        action='store_true',
+                        help='Only decode the keyframes of the videos (faster, misses the I-frames that are not keyframes).')
+    parser.add_argument('--threshold',
+                        type=int,
+                        default=5,
+                        help='Keyframes within this many bits (dHash Hamming distance) of a kept keyframe are dropped.')
+    parser.add_argument('--max_frames',
+                        type=int,
+                        default=None,
+                        help='Maximum number of keyframes kept per video, evenly spread. No limit by default.')
+    parser.add_argument('--audio_subdir',
+                        type=str,
+                        default='audio',
+                        help='Sub-directory of the courses with the extracted <video>.wav or .pcm audio. \
+                              The audio track of videos/<video>.mp4 is used for the videos without one.')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=22050,
+                        help='Sample rate the audio is resampled to.')
+    parser.add_argument('--pcm_rate',
+                        type=int,
+                        default=16000,
+                        help='Sample rate of the raw .pcm files (mono, 16-bit little-endian).')
+    parser.add_argument('--pack_keyframes',
+                        action='store_true',
+                        help='Also pack the keyframes of the courses (see pack_keyframes.py).')
+    parser.add_argument('--keyframe_size',
+                        type=int,
+                        default=256,
+                        help='Short side of the packed keyframes.')
+    parser.add_argument('--cache_features',
+                        action='store_true',
+                        help='Also cache the ResNet features of the kept keyframes (see keyframe_dedup.py).')
+    parser.add_argument('--load_path',
+                        type=str,
+                        default=None,
+                        help='Checkpoint whose ResNet computes the cached features, the ImageNet weights by default.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Extract the keyframes and audio features again, even for the videos that have them.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_evaluate_args():
+    """Get arguments needed in evaluate.py."""
+    parser = argparse.ArgumentParser('Evaluate a trained MMBiDAF checkpoint')
+
+    add_train_test_args(parser)
+    add_eval_args(parser)
+
+    parser.add_argument('--num_shards',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of contiguous shards the videos are split into.')
+    parser.add_argument('--out_dir',
+                        type=str,
+                        default=None,
+                        help='Directory for the shard and merged results. Pass a previous one to resume or rerun shards.')
+    parser.add_argument('--shards',
+                        type=int,
+                        nargs='*',
+                        default=None,
+                        help='Shards of out_dir to (re)run. By default only the shards without results are run.')
+    parser.add_argument('--image_features',
+                        action='store_true',
+                        help='Use the ResNet features of the selected keyframes cached by keyframe_dedup.py --cache_features --load_path <load_path>.')
+
+    args = parser.parse_args()
+
+    if args.eval_workers is None:
+        args.eval_workers = args.num_shards
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, os.cpu_count() // max(1, args.eval_workers))
+
+    return args
+
+def get_summarize_args():
+    """Get arguments needed in summarize.py."""
+    parser = argparse.ArgumentParser('Summarize lectures with a trained MMBiDAF checkpoint')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset.')
+    parser.add_argument('--load_path',
+                        type=str,
+                        required=True,
+                        help='Path of the checkpoint to summarize with.')
+    parser.add_argument('--videos',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='Videos to summarize, as <course>/<video>.')
+    parser.add_argument('--courses',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='Courses whose videos are summarized. Every video of the catalog when no video or course is given.')
+    parser.add_argument('--out_file',
+                        type=str,
+                        default='./save/summaries.jsonl',
+                        help='JSONL file the summaries are written to.')
+    parser.add_argument('--beam_size',
+                        type=int,
+                        default=1,
+                        help='Number of hypotheses of the beam search, 1 for greedy decoding.')
+    parser.add_argument('--max_sentences',
+                        type=int,
+                        default=30,
+                        help='Maximum number of sentences of a summary.')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=8,
+                        help='Number of videos decoded together.')
+    parser.add_argument('--num_candidates',
+                        type=int,
+                        default=None,
+                        help='Decode in two stages : the decoder attends and points only within the num_candidates best sentences of every lecture (see candidates.py). \
+                              Fewer candidates decode faster but may miss sentences of the full summary. All the sentences by default.')
+    parser.add_argument('--candidate_scorer',
+                        type=str,
+                        default='centrality',
+                        choices=('centrality', 'decoder'),
+                        help='First-stage scorer of the sentences : the similarity of their embeddings to the rest of the lecture, or the first decoder timestep.')
+    parser.add_argument('--hidden_size',
+                        type=int,
+                        default=100,
+                        help='Number of features in encoder hidden layers.')
+    parser.add_argument('--packed_keyframes',
+                        action='store_true',
+                        help='Read the keyframes from the stores of pack_keyframes.py and transform them batch by batch.')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=1,
+                        help='Number of summarization processes, each with its own model copy.')
+    parser.add_argument('--threads_per_worker',
+                        type=int,
+                        default=None,
+                        help='Torch threads per summarization process. Defaults to the cores divided by num_workers.')
+
+    args = parser.parse_args()
+
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, os.cpu_count() // max(1, args.num_workers))
+
+    return args
+
+def get_candidates_args():
+    """Get arguments needed in candidates.py."""
+    parser = argparse.ArgumentParser('Measure the recall and decoding time of the two-stage decoding')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset.')
+    parser.add_argument('--load_path',
+                        type=str,
+                        required=True,
+                        help='Path of the checkpoint to decode with.')
+    parser.add_argument('--videos',
+                        nargs='*',
+                        default=[],
+                        help='The <course>/<video> videos to decode.')
+    parser.add_argument('--courses',
+                        nargs='*',
+                        default=[],
+                        help='Courses whose videos are decoded. All the videos of the catalog when neither videos nor courses are given.')
+    parser.add_argument('--num_candidates',
+                        type=int,
+                        nargs='*',
+                        default=[16, 32, 64, 128],
+                        help='Numbers of candidates to compare with the decoding over all the sentences.')
+    parser.add_argument('--candidate_scorer',
+                        type=str,
+                        default='centrality',
+                        choices=('centrality', 'decoder'),
+                        help='First-stage scorer of the sentences : the similarity of their embeddings to the rest of the lecture, or the first decoder timestep.')
+    parser.add_argument('--ground_truth',
+                        action='store_true',
+                        help='Also report the fraction of the ground-truth summary sentences that are candidates.')
+    parser.add_argument('--beam_size',
+                        type=int,
+                        default=1,
+                        help='Number of hypotheses of the beam search, 1 for greedy decoding.')
+    parser.add_argument('--max_sentences',
+                        type=int,
+                        default=30,
+                        help='Maximum number of sentences of a summary.')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=8,
+                        help='Number of videos decoded together.')
+    parser.add_argument('--hidden_size',
+                        type=int,
+                        default=100,
+                        help='Number of features in encoder hidden layers.')
+    parser.add_argument('--image_features',
+                        action='store_true',
+                        help='Use the ResNet features of the selected keyframes cached by keyframe_dedup.py --cache_features --load_path <load_path>.')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Torch threads of the model.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_serve_args():
+    """Get arguments needed in serve.py."""
+    parser = argparse.ArgumentParser('Serve MMBiDAF summaries over HTTP')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset, for the requests naming a video of the catalog.')
+    parser.add_argument('--load_path',
+                        type=str,
+                        required=True,
+                        help='Path of the checkpoint to summarize with.')
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='Address to listen on.')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8080,
+                        help='Port to listen on.')
+    parser.add_argument('--max_batch_size',
+                        type=int,
+                        default=8,
+                        help='Maximum number of requests decoded together.')
+    parser.add_argument('--max_wait_ms',
+                        type=float,
+                        default=20,
+                        help='Milliseconds a request may wait for other requests to join its batch.')
+    parser.add_argument('--max_queue',
+                        type=int,
+                        default=256,
+                        help='Maximum number of waiting requests, the next ones are refused.')
+    parser.add_argument('--request_timeout',
+                        type=float,
+                        default=300,
+                        help='Seconds a request waits for its summary.')
+    parser.add_argument('--beam_size',
+                        type=int,
+                        default=1,
+                        help='Number of hypotheses of the beam search, 1 for greedy decoding.')
+    parser.add_argument('--max_sentences',
+                        type=int,
+                        default=30,
+                        help='Maximum number of sentences of a summary.')
+    parser.add_argument('--num_candidates',
+                        type=int,
+                        default=None,
+                        help='Decode in two stages : the decoder attends and points only within the num_candidates best sentences of every lecture (see candidates.py). \
+                              Fewer candidates decode faster but may miss sentences of the full summary. All the sentences by default.')
+    parser.add_argument('--candidate_scorer',
+                        type=str,
+                        default='centrality',
+                        choices=('centrality', 'decoder'),
+                        help='First-stage scorer of the sentences : the similarity of their embeddings to the rest of the lecture, or the first decoder timestep.')
+    parser.add_argument('--hidden_size',
+                        type=int,
+                        default=100,
+                        help='Number of features in encoder hidden layers.')
+    parser.add_argument('--image_features',
+                        action='store_true',
+                        help='Use the ResNet features of the selected keyframes cached by keyframe_dedup.py --cache_features --load_path <load_path>.')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Torch threads of the model.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_live_args():
+    """Get arguments needed in live.py."""
+    parser = argparse.ArgumentParser('Summarize a lecture of the catalog replayed as a live stream')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset.')
+    parser.add_argument('--load_path',
+                        type=str,
+                        required=True,
+                        help='Path of the checkpoint to summarize with.')
+    parser.add_argument('--video',
+                        type=str,
+                        required=True,
+                        help='The <course>/<video> of the catalog to replay.')
+    parser.add_argument('--chunk_sentences',
+                        type=int,
+                        default=10,
+                        help='Number of sentences of every chunk, with the audio frames and keyframes of the same share of the lecture.')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='Replay the lecture this many times in a row, to simulate a longer one.')
+    parser.add_argument('--text_lookback',
+                        type=int,
+                        default=8,
+                        help='Number of the latest sentences encoded again with every chunk.')
+    parser.add_argument('--audio_lookback',
+                        type=int,
+                        default=256,
+                        help='Number of the latest audio frames encoded again with every chunk.')
+    parser.add_argument('--image_lookback',
+                        type=int,
+                        default=2,
+                        help='Number of the latest keyframes encoded again with every chunk.')
+    parser.add_argument('--audio_memory',
+                        type=int,
+                        default=2048,
+                        help='Number of the latest audio frames the sentences attend to.')
+    parser.add_argument('--image_memory',
+                        type=int,
+                        default=16,
+                        help='Number of the latest keyframes the sentences attend to.')
+    parser.add_argument('--decoder_memory',
+                        type=int,
+                        default=None,
+                        help='Number of the latest sentences the decoder attends over and selects from, which bounds the decoding time \
+                              of an update. All the kept sentences (up to 408) by default.')
+    parser.add_argument('--compare',
+                        action='store_true',
+                        help='Also encode everything received so far again after every chunk, and report its latency and summary overlap.')
+    parser.add_argument('--beam_size',
+                        type=int,
+                        default=1,
+                        help='Number of hypotheses of the beam search, 1 for greedy decoding.')
+    parser.add_argument('--max_sentences',
+                        type=int,
+                        default=30,
+                        help='Maximum number of sentences of a summary.')
+    parser.add_argument('--hidden_size',
+                        type=int,
+                        default=100,
+                        help='Number of features in encoder hidden layers.')
+    parser.add_argument('--image_features',
+                        action='store_true',
+                        help='Use the ResNet features of the selected keyframes cached by keyframe_dedup.py --cache_features --load_path <load_path>.')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Torch threads of the model.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_load_generator_args():
+    """Get arguments needed in load_generator.py."""
+    parser = argparse.ArgumentParser('Load test a running serve.py')
+
+    parser.add_argument('--url',
+                        type=str,
+                        default='http://127.0.0.1:8080',
+                        help='Address of the server.')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=64,
+                        help='Total number of requests.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='Number of concurrent clients.')
+    parser.add_argument('--videos',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='Videos of the catalog to request, as <course>/<video>. Random features are sent when none is given.')
+    parser.add_argument('--num_sentences',
+                        type=int,
+                        default=200,
+                        help='Number of sentences of the random lectures.')
+    parser.add_argument('--num_frames',
+                        type=int,
+                        default=1000,
+                        help='Number of audio frames of the random lectures.')
+    parser.add_argument('--num_keyframes',
+                        type=int,
+                        default=16,
+                        help='Number of keyframes of the random lectures.')
+    parser.add_argument('--npz_dir',
+                        type=str,
+                        default=None,
+                        help='Save the random lectures as .npz files in this directory and send their paths instead of their features.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=224,
+                        help='Random seed of the random lectures.')
+
+    args = parser.parse_args()
+
+    return args
+
+def get_sweep_args():
+    """Get arguments needed in sweep.py."""
+    parser = argparse.ArgumentParser('Evaluate every checkpoint of a training run')
+
+    add_train_test_args(parser)
+    add_eval_args(parser)
+
+    parser.add_argument('--sweep_dir',
+                        type=str,
+                        required=True,
+                        help='Training save directory holding the step_*.pth.tar checkpoints.')
+
+    args = parser.parse_args()
+
+    if args.eval_workers is None:
+        args.eval_workers = os.cpu_count()
+
+    return args
+
+def add_eval_args(parser):
+    """Add arguments common to evaluate.py and sweep.py"""
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        default='/home/anish17281/NLP_Dataset/dataset/',
+                        help='Directory containing the entire dataset.')
+    parser.add_argument('--split',
+                        type=str,
+                        default='test',
+                        choices=('test', 'train', 'val'),
+                        help='Videos to evaluate on.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=224,
+                        help='Random seed of the train/val split (as in train.py).')
+    parser.add_argument('--eval_workers',
+                        type=int,
+                        default=None,
+                        help='Number of evaluation processes, each with its own model copy. \
+                              Defaults to num_shards in evaluate.py and to the number of checkpoints (up to the cores) in sweep.py.')
+    parser.add_argument('--threads_per_worker',
+                        type=int,
+                        default=None,
+                        help='Torch threads per evaluation process. Defaults to the cores divided by eval_workers.')
+
 def add_common_args(parser):
     """Add arguments common to all 3 scripts: setup.py, train.py, test.py"""
     parser.add_argument('--train_record_file',
@@ -125,4 +800,34 @@ def add_train_test_args(parser):
                         type=str,
                         default=None,
                         help='Path to load as a model checkpoint.')
-                        
\ No newline at end of file
+    parser.add_argument('--packed_keyframes',
+                        action='store_true',
+                        help='Read the keyframes from the stores of pack_keyframes.py and transform them batch by batch.')
+                        
+def get_rouge_args():
+    """Get arguments needed in compute_rouge.py."""
+    parser = argparse.ArgumentParser('Score generated summaries against the ground truth with ROUGE')
+
+    parser.add_argument('--courses_dir',
+                        type=str,
+                        required=True,
+                        help='Directory with one sub-directory per course, each with a ground-truth directory.')
+    parser.add_argument('--res_dir',
+                        type=str,
+                        required=True,
+                        help='Directory with one sub-directory of generated summaries per course.')
+    parser.add_argument('--results_file',
+                        type=str,
+                        default='./save/rouge_scores.jsonl',
+                        help='Per-file scores are appended here as they are computed (.jsonl or .csv).')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of scoring processes.')
+    parser.add_argument('--no_resume',
+                        action='store_true',
+                        help='Rescore every file instead of skipping the ones already in results_file.')
+
+    args = parser.parse_args()
+
+    return args
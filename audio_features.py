@@ -0,0 +1,207 @@
+"""
+Compute the 128-dimensional MFCC features of the lecture audio, in the layout `AudioDataset` reads.
+
+The audio of a video is read from `<course>/audio/<video>.wav` (any format PyAV decodes) or `.pcm`
+(raw mono 16-bit little-endian samples at `--pcm_rate`), or, for the videos without extracted audio,
+straight from the audio track of `<course>/videos/<video>.mp4`. It is mixed down to mono and resampled
+to `--sample_rate`.
+
+The features follow `librosa.feature.mfcc` (centered Hann-windowed frames, Slaney mel filterbank,
+power in dB clipped 80 dB below the peak, orthonormal DCT-II), computed for blocks of frames at once
+with strided framing, a batched real FFT and matrix products for the filterbank and the DCT.
+Each video gets a (n_mfcc, num_frames) float32 array pickled to `<course>/audio-features8/<video>.pkl`.
+"""
+import multiprocessing as mp
+import os
+import pickle
+import time
+
+import av
+import numpy as np
+import torch
+
+from args import get_audio_args
+
+AUDIO_FEATURES = 'audio-features8'
+
+def load_audio(path, sample_rate=22050, pcm_rate=None):
+    """
+    The samples of an audio file, or of the audio track of a video, mixed down to mono at `sample_rate`.
+
+    Returns:
+        samples (np.ndarray) : (num_samples,) float32 samples in [-1, 1].
+    """
+    if path.endswith('.pcm'):
+        samples = np.fromfile(path, dtype='<i2').astype(np.float32) / 32768
+        if pcm_rate is None or pcm_rate == sample_rate:
+            return samples
+        # Let PyAV's resampler convert the rate of the raw samples
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format='flt', layout='mono')
+        frame.sample_rate = pcm_rate
+        return resample([frame], sample_rate)
+
+    with av.open(path) as container:
+        return resample(container.decode(audio=0), sample_rate)
+
+def resample(frames, sample_rate):
+    resampler = av.AudioResampler(format='flt', layout='mono', rate=sample_rate)
+    chunks = []
+    for frame in frames:
+        frame.pts = None
+        chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(frame))
+    # Flush the samples buffered by the resampler
+    chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(None))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+# Slaney's mel scale : linear below 1 kHz (200 / 3 Hz per mel), logarithmic above
+MEL_F_SP = 200.0 / 3
+MEL_MIN_LOG_HZ = 1000.0
+MEL_MIN_LOG_MEL = MEL_MIN_LOG_HZ / MEL_F_SP
+MEL_LOGSTEP = np.log(6.4) / 27.0
+
+def hz_to_mel(frequencies):
+    frequencies = np.asanyarray(frequencies, dtype=np.float64)
+    log_mels = MEL_MIN_LOG_MEL + np.log(np.maximum(frequencies, MEL_MIN_LOG_HZ) / MEL_MIN_LOG_HZ) / MEL_LOGSTEP
+    return np.where(frequencies >= MEL_MIN_LOG_HZ, log_mels, frequencies / MEL_F_SP)
+
+def mel_to_hz(mels):
+    mels = np.asanyarray(mels, dtype=np.float64)
+    log_frequencies = MEL_MIN_LOG_HZ * np.exp(MEL_LOGSTEP * (np.maximum(mels, MEL_MIN_LOG_MEL) - MEL_MIN_LOG_MEL))
+    return np.where(mels >= MEL_MIN_LOG_MEL, log_frequencies, MEL_F_SP * mels)
+
+def mel_filterbank(sample_rate, n_fft, n_mels=128, fmin=0.0, fmax=None):
+    """
+    The (n_mels, 1 + n_fft // 2) triangular mel filters, with Slaney's area normalization.
+    """
+    fmax = sample_rate / 2.0 if fmax is None else fmax
+    fft_frequencies = np.linspace(0, sample_rate / 2.0, 1 + n_fft // 2)
+    mel_frequencies = mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), n_mels + 2))
+    widths = np.diff(mel_frequencies)
+    ramps = mel_frequencies[:, None] - fft_frequencies[None, :]
+    lower = -ramps[:-2] / widths[:-1, None]
+    upper = ramps[2:] / widths[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    weights *= (2.0 / (mel_frequencies[2:n_mels + 2] - mel_frequencies[:n_mels]))[:, None]
+    return weights.astype(np.float32)
+
+def dct_matrix(n_mfcc, n_mels):
+    """The (n_mfcc, n_mels) orthonormal DCT-II matrix."""
+    k = np.arange(n_mfcc)[:, None]
+    n = np.arange(n_mels)[None, :]
+    basis = np.cos(np.pi * k * (2 * n + 1) / (2.0 * n_mels)) * np.sqrt(2.0 / n_mels)
+    basis[0] /= np.sqrt(2.0)
+    return basis.astype(np.float32)
+
+def log_mel_spectrogram(samples, sample_rate, n_fft=2048, hop_length=512, n_mels=128, block_frames=4096):
+    """
+    The (num_frames, n_mels) log10 mel power spectrogram of centered Hann-windowed frames.
+    Frames are strided views of the zero-padded signal, transformed `block_frames` at a time to bound the memory.
+    """
+    samples = torch.as_tensor(samples, dtype=torch.float32)
+    samples = torch.nn.functional.pad(samples, (n_fft // 2, n_fft // 2))
+    if samples.numel() < n_fft:
+        return torch.zeros(0, n_mels)
+    frames = samples.unfold(0, n_fft, hop_length)                                   # (num_frames, n_fft) view
+    window = torch.hann_window(n_fft, periodic=True)
+    mel_basis = torch.from_numpy(mel_filterbank(sample_rate, n_fft, n_mels)).t()    # (1 + n_fft // 2, n_mels)
+
+    log_mel = torch.empty(frames.size(0), n_mels)
+    for start in range(0, frames.size(0), block_frames):
+        block = frames[start:start + block_frames] * window
+        power = torch.fft.rfft(block).abs().pow_(2)                                 # (block_frames, 1 + n_fft // 2)
+        torch.matmul(power, mel_basis, out=log_mel[start:start + block_frames])
+    # 10 * log10(S / ref) with ref = 1 and amin = 1e-10, as librosa.power_to_db
+    return log_mel.clamp_(min=1e-10).log10_().mul_(10)
+
+def mfcc(samples, sample_rate=22050, n_mfcc=128, n_fft=2048, hop_length=512, n_mels=128, top_db=80.0):
+    """
+    The MFCC of a signal, as `librosa.feature.mfcc` with the same arguments.
+
+    Returns:
+        features (np.ndarray) : (n_mfcc, num_frames) float32 array.
+    """
+    log_mel = log_mel_spectrogram(samples, sample_rate, n_fft, hop_length, n_mels)
+    if log_mel.size(0) and top_db is not None:
+        # The floor is relative to the loudest frame of the whole signal
+        log_mel = torch.max(log_mel, log_mel.max() - top_db)
+    features = torch.matmul(torch.from_numpy(dct_matrix(n_mfcc, n_mels)), log_mel.t())
+    return features.numpy()
+
+def get_audio_path(course_path, video, audio_subdir='audio'):
+    """The extracted audio of a video when there is one, otherwise the video itself."""
+    for extension in ('.wav', '.pcm'):
+        path = os.path.join(course_path, audio_subdir, video + extension)
+        if os.path.exists(path):
+            return path
+    return os.path.join(course_path, 'videos', video + '.mp4')
+
+def get_videos(course_path, audio_subdir='audio'):
+    """The videos of a course, from its extracted audio and its videos (excluding the `_` variants)."""
+    videos = set()
+    for subdir, extensions in ((audio_subdir, ('.wav', '.pcm')), ('videos', ('.mp4',))):
+        path = os.path.join(course_path, subdir)
+        if os.path.isdir(path):
+            videos.update(os.path.splitext(fname)[0] for fname in os.listdir(path)
+                          if fname.endswith(extensions) and '_' not in fname and os.path.splitext(fname)[0].isdigit())
+    return sorted(videos, key=int)
+
+# Feature settings of the pool processes, set once by `init_worker`
+worker_settings = {}
+
+def init_worker(settings):
+    # Every process runs its own video, one thread each
+    torch.set_num_threads(1)
+    worker_settings.update(settings)
+
+def extract_audio_features(task):
+    """Pool worker : compute and save the features of one video, returns (task, number of frames or None on failure)."""
+    audio_path, features_path = task
+    settings = worker_settings
+    try:
+        samples = load_audio(audio_path, settings['sample_rate'], settings['pcm_rate'])
+        features = mfcc(samples, settings['sample_rate'], settings['n_mfcc'], settings['n_fft'], settings['hop_length'], settings['n_mels'])
+        with open(features_path + '.tmp', 'wb') as f:
+            pickle.dump(features, f)
+        os.replace(features_path + '.tmp', features_path)
+        return task, features.shape[1]
+    except Exception as e:
+        print('Unable to compute the audio features of {}. Exception: {}'.format(audio_path, e))
+        return task, None
+
+def main(args):
+    settings = {'sample_rate': args.sample_rate, 'pcm_rate': args.pcm_rate, 'n_mfcc': args.n_mfcc,
+                'n_fft': args.n_fft, 'hop_length': args.hop_length, 'n_mels': args.n_mels}
+    courses = [fname for fname in os.listdir(args.courses_dir) if fname.isdigit() and os.path.isdir(os.path.join(args.courses_dir, fname))]
+    tasks = []
+    for course in sorted(courses, key=int):
+        course_path = os.path.join(args.courses_dir, course)
+        features_dir = os.path.join(course_path, AUDIO_FEATURES)
+        for video in get_videos(course_path, args.audio_subdir):
+            features_path = os.path.join(features_dir, video + '.pkl')
+            if args.force or not os.path.exists(features_path):
+                os.makedirs(features_dir, exist_ok=True)
+                tasks.append((get_audio_path(course_path, video, args.audio_subdir), features_path))
+    print('Computing the audio features of {} videos'.format(len(tasks)))
+
+    start = time.time()
+    if args.num_workers > 1 and len(tasks) > 1:
+        pool = mp.Pool(args.num_workers, initializer=init_worker, initargs=(settings,))
+        results = pool.imap_unordered(extract_audio_features, tasks)
+    else:
+        pool = None
+        worker_settings.update(settings)
+        results = map(extract_audio_features, tasks)
+    num_done = 0
+    try:
+        for (audio_path, features_path), num_frames in results:
+            if num_frames is not None:
+                num_done += 1
+                print('Saved {} frames of {} to {}'.format(num_frames, audio_path, features_path))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('Computed the audio features of {} of {} videos in {:.1f}s'.format(num_done, len(tasks), time.time() - start))
+
+if __name__ == '__main__':
+    main(get_audio_args())
@@ -0,0 +1,112 @@
+"""
+Measure the recall / decoding time trade-off of the two-stage decoding (`MMBiDAF.select_candidates`).
+
+Every batch of videos is encoded once, then decoded over all the sentences and with every `--num_candidates`. For
+every number of candidates, the report gives the mean decoding time of a batch (the candidate selection included)
+and its speedup, the fraction of the sentences of the full summaries that are candidates (candidate recall) and
+that the two-stage summaries still select (summary recall) and, with `--ground_truth`, the fraction of the
+ground-truth summary sentences that are candidates.
+"""
+import time
+from collections import OrderedDict
+from json import dumps
+
+import numpy as np
+import torch
+
+import util
+from args import get_candidates_args
+from datasets import TargetDataset, collator, get_image_collator
+from summarize import get_batches, get_datasets, load_summarizer, load_video, select_videos
+
+def decode_batch(model, encoded, text, text_lengths, max_sentences, beam_size, num_candidates=None, candidate_scorer='centrality'):
+    """
+    Decode an encoded batch over all the sentences, or over `num_candidates` candidates.
+
+    Returns:
+        summaries (list) : The sentence indices and log-probability of every summary.
+        candidates (list) : The set of candidate sentences of every video, None over all the sentences.
+        elapsed (float) : Seconds spent selecting the candidates and decoding.
+    """
+    decoder_state, decoder_context = encoded
+    candidates = None
+    start = time.time()
+    if num_candidates is not None:
+        decoder_state, decoder_context, text, text_lengths, candidates = \
+            model.select_candidates(decoder_state, decoder_context, text, text_lengths, num_candidates, candidate_scorer)
+    summaries = model.decode(decoder_state, decoder_context, text, text_lengths, max_sentences, beam_size, candidates)
+    elapsed = time.time() - start
+    if candidates is not None:
+        candidates = [set(row[:length]) for row, length in zip(candidates.tolist(), text_lengths)]
+    return summaries, candidates, elapsed
+
+def fraction(selected, reference):
+    """Fraction of the distinct `reference` sentences in `selected`, None without reference sentences."""
+    reference = set(reference)
+    return len(reference & set(selected)) / len(reference) if reference else None
+
+def main(args, model_kwargs):
+    torch.set_num_threads(args.num_threads)
+    device = model_kwargs['device']
+    model = load_summarizer(model_kwargs, args.load_path)
+    image_features = None
+    if args.image_features:
+        from keyframe_dedup import get_resnet_state, weights_fingerprint
+        image_features = weights_fingerprint(get_resnet_state(args.load_path))
+    datasets = get_datasets(args.courses_dir, model_kwargs['max_transcript_length'], image_features)
+    target_dataset = TargetDataset(args.courses_dir) if args.ground_truth else None
+    image_collator = get_image_collator(datasets[2])
+    indices = select_videos(datasets[0], set(args.videos), set(args.courses))
+    batches = get_batches(datasets[0], indices, args.batch_size)
+    print('Decoding {} videos in {} batches with all the sentences and {} {} candidates'.format(
+        len(indices), len(batches), ', '.join(map(str, args.num_candidates)), args.candidate_scorer))
+
+    settings = [None] + sorted(args.num_candidates)
+    times = {num_candidates: [] for num_candidates in settings}
+    recalls = {num_candidates: {'candidate': [], 'summary': [], 'ground_truth': []} for num_candidates in args.num_candidates}
+    num_sentences = []
+    for batch in batches:
+        _, text_items, audio_items, image_items = zip(*[load_video(datasets, idx) for idx in batch])
+        batch_text, text_lengths = collator(text_items)
+        batch_audio, audio_lengths = collator(audio_items)
+        batch_images, image_lengths = image_collator(image_items)
+        batch_text = batch_text.to(device)
+        num_sentences.extend(length - 1 for length in text_lengths)
+        with torch.no_grad():
+            encoded = model.encode(batch_text, text_lengths, batch_audio.to(device), audio_lengths, batch_images.to(device), image_lengths)
+            full, _, elapsed = decode_batch(model, encoded, batch_text, text_lengths, args.max_sentences, args.beam_size)
+            times[None].append(elapsed)
+            for num_candidates in args.num_candidates:
+                summaries, candidates, elapsed = decode_batch(model, encoded, batch_text, text_lengths, args.max_sentences, args.beam_size,
+                                                              num_candidates, args.candidate_scorer)
+                times[num_candidates].append(elapsed)
+                for row, idx in enumerate(batch):
+                    recalls[num_candidates]['candidate'].append(fraction(candidates[row], full[row][0]))
+                    recalls[num_candidates]['summary'].append(fraction(summaries[row][0], full[row][0]))
+                    if target_dataset is not None:
+                        target_indices = target_dataset[idx][0].view(-1).long().tolist()[:-1]          # Without the EOS
+                        recalls[num_candidates]['ground_truth'].append(fraction(candidates[row], target_indices))
+
+    mean = lambda values: None if not [value for value in values if value is not None] else \
+        round(float(np.mean([value for value in values if value is not None])), 4)
+    print('Sentences per video : mean {:.1f}, max {}'.format(np.mean(num_sentences), max(num_sentences)))
+    report = []
+    for num_candidates in settings:
+        row = OrderedDict([('num_candidates', num_candidates if num_candidates is not None else 'all'),
+                           ('decode_ms', round(1000 * float(np.mean(times[num_candidates])), 1)),
+                           ('speedup', round(float(np.sum(times[None]) / np.sum(times[num_candidates])), 2))])
+        if num_candidates is not None:
+            row['candidate_recall'] = mean(recalls[num_candidates]['candidate'])
+            row['summary_recall'] = mean(recalls[num_candidates]['summary'])
+            if target_dataset is not None:
+                row['ground_truth_recall'] = mean(recalls[num_candidates]['ground_truth'])
+        report.append(row)
+        print(dumps(row))
+    return report
+
+if __name__ == '__main__':
+    args = get_candidates_args()
+    device = util.get_available_devices()[0]
+    model_kwargs = dict(hidden_size=args.hidden_size, text_embedding_size=300, audio_embedding_size=128, image_embedding_size=1000,
+                        device=device, drop_prob=0.2, max_transcript_length=409)
+    main(args, model_kwargs)
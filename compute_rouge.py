@@ -1,44 +1,42 @@
 import os
 import re
-import sys
 
+import csv
+import json
+import multiprocessing as mp
 import numpy as np
 
-from rouge import Rouge
-from nltk import PorterStemmer
-
-stemmer = PorterStemmer()
+from args import get_rouge_args
+from collections import OrderedDict
+from rouge_scorer import METRICS, STATS, RougeScorer
+from text_normalization import stem
 
 def get_num(str):
     return int(re.search(r'\d+', str).group())
 
-def prepare(gt, res):
-	clean_gt = [" ".join([stemmer.stem(i) for i in line.split()]) for line in gt]
-	clean_res = [" ".join([stemmer.stem(i) for i in line.split()]) for line in res]
-	return clean_gt, clean_res
-
-def get_rouge(clean_gt, clean_res):
-    rouge = Rouge()
-    scores = rouge.get_scores(clean_res, clean_gt, avg=True)
-    return scores
+# Stemmed references are cached, see `rouge_scorer.RougeScorer`
+rouge_scorer = RougeScorer(stemmer=stem)
 
 def calculate_rouge(gt_file, res_file):
+    """Summary-level ROUGE of a generated summary file against a ground-truth file, both stemmed."""
     try:
-        with open(gt_file, 'r') as f:
-            gt_data = f.readlines()
+        ref = rouge_scorer.reference(gt_file)
         with open(res_file, 'r') as f:
-            res_data = f.readlines()
+            res_data = [line.strip() for line in f]
     except Exception as e:
-        print("Cannot open files with error : "+ e)
-    else:
-        min_len = min(len(gt_data), len(res_data))
-        gt_data = gt_data[:min_len]
-        res_data = res_data[:min_len]
-        clean_gt, clean_res = prepare(gt_data, res_data)
-        score = get_rouge(clean_gt, clean_res)
-    return score
-
-def main(courses_dir, res_dir):
+        print("Cannot open files with error : "+ str(e))
+        return None
+    return rouge_scorer.score(res_data, ref)
+
+# Columns of the results file
+FIELDS = ['course', 'ground_truth', 'summary'] + ['{}-{}'.format(metric, stat) for metric in METRICS for stat in STATS]
+SCORE_FIELDS = FIELDS[3:]
+
+def get_file_pairs(courses_dir, res_dir):
+    """
+    List the (course, ground-truth file, generated summary file) triples to score, the i-th summary of a
+    course being scored against its i-th ground truth.
+    """
     courses_dirlist = []
     for fname in os.listdir(courses_dir):
         if os.path.isdir(os.path.join(courses_dir, fname)):
@@ -51,49 +49,130 @@ def main(courses_dir, res_dir):
 
     assert len(res_dirlist) == len(courses_dirlist), "Unequal ground truth and generated summary dir length"
 
-    num_files = 0
-    total_score_r1p = 0
-    total_score_r1r = 0
-    total_score_r1f = 0
-    total_score_r2p = 0
-    total_score_r2r = 0
-    total_score_r2f = 0
-    total_score_rl1 = 0
-    total_score_rl2 = 0
-    total_score_rlf = 0
-
+    pairs = []
     for course_num in sorted(courses_dirlist, key=int):
         gt_path = os.path.join(courses_dir, course_num, 'ground-truth')
         res_path = os.path.join(res_dir, course_num)
         for gt, res in zip(sorted(os.listdir(gt_path), key=get_num), sorted(os.listdir(res_path), key=get_num)):
             if '.txt' in gt and '.txt' in res:
-                num_files += 1
-                gt_file = os.path.join(gt_path, gt)
-                res_file = os.path.join(res_path, res)
-                total_score = calculate_rouge(gt_file, res_file)
-                total_score_r1p += total_score['rouge-1']['p']
-                total_score_r1r += total_score['rouge-1']['r']
-                total_score_r1f += total_score['rouge-1']['f']
-                total_score_r2p += total_score['rouge-2']['p']
-                total_score_r2r += total_score['rouge-2']['r']
-                total_score_r2f += total_score['rouge-2']['f']
-                total_score_rl1 += total_score['rouge-l']['p']
-                total_score_rl2 += total_score['rouge-l']['r']
-                total_score_rlf += total_score['rouge-l']['f']
-
-    total_score_r1p /= num_files
-    total_score_r1r /= num_files
-    total_score_r1f /= num_files
-    total_score_r2p /= num_files
-    total_score_r2r /= num_files
-    total_score_r2f /= num_files
-    total_score_rl1 /= num_files
-    total_score_rl2 /= num_files
-    total_score_rlf /= num_files
-    print("Average rouge score over all the files is : ", total_score_r1p, total_score_r1r, total_score_r1f, total_score_r2p, total_score_r2r, total_score_r2f, total_score_rlp, total_score_rlr, total_score_rlf)
+                pairs.append((course_num, os.path.join(gt_path, gt), os.path.join(res_path, res)))
+    return pairs
+
+def score_pair(pair):
+    """Pool worker : score one (course, ground truth, summary) triple into a results row, None on failure."""
+    course_num, gt_file, res_file = pair
+    total_score = calculate_rouge(gt_file, res_file)
+    if total_score is None:
+        return None
+    row = {'course': course_num, 'ground_truth': gt_file, 'summary': res_file}
+    for metric in METRICS:
+        for stat in STATS:
+            row['{}-{}'.format(metric, stat)] = float(total_score[metric][stat])
+    return row
+
+def is_csv(results_file):
+    return results_file.endswith('.csv')
+
+def read_results(results_file):
+    """Read the complete rows of a (possibly interrupted) results file."""
+    rows = []
+    if not os.path.exists(results_file):
+        return rows
+    with open(results_file, 'r', newline='') as f:
+        if is_csv(results_file):
+            for row in csv.DictReader(f):
+                try:
+                    rows.append(dict(row, **{field: float(row[field]) for field in SCORE_FIELDS}))
+                except (TypeError, ValueError):
+                    pass    # Row cut by an interruption
+        else:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if all(field in row for field in FIELDS):
+                    rows.append(row)
+    return rows
+
+def write_results(results_file, rows):
+    """Rewrite the results file with `rows` only (atomically), dropping any partially written row."""
+    tmp_file = results_file + '.tmp'
+    with open(tmp_file, 'w', newline='') as f:
+        if is_csv(results_file):
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    os.replace(tmp_file, results_file)
+
+def average_scores(rows):
+    """
+    Average the per-file scores.
+
+    Returns:
+        course_scores (OrderedDict) : Course -> (number of files, mean of every score field), in course order.
+        overall (tuple) : (number of files, mean over all the files).
+    """
+    by_course = OrderedDict()
+    for row in sorted(rows, key=lambda row: int(row['course'])):
+        by_course.setdefault(row['course'], []).append([row[field] for field in SCORE_FIELDS])
+    course_scores = OrderedDict((course, (len(scores), np.mean(scores, axis=0))) for course, scores in by_course.items())
+    all_scores = [row[field] for row in rows for field in SCORE_FIELDS]
+    overall = (len(rows), np.array(all_scores).reshape(len(rows), -1).mean(axis=0) if rows else np.zeros(len(SCORE_FIELDS)))
+    return course_scores, overall
+
+def main(args):
+    pairs = get_file_pairs(args.courses_dir, args.res_dir)
+
+    # Resume : keep the complete rows of a previous run and only score the remaining files
+    rows = [] if args.no_resume else read_results(args.results_file)
+    summaries = set(pair[2] for pair in pairs)
+    rows = list(OrderedDict((row['summary'], row) for row in rows if row['summary'] in summaries).values())
+    done = set(row['summary'] for row in rows)
+    todo = [pair for pair in pairs if pair[2] not in done]
+    print('Scoring {} files ({} already in {})'.format(len(todo), len(pairs) - len(todo), args.results_file))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_file)), exist_ok=True)
+    write_results(args.results_file, rows)
+
+    num_failed = 0
+    with open(args.results_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS) if is_csv(args.results_file) else None
+        if args.num_workers > 1 and len(todo) > 1:
+            pool = mp.Pool(args.num_workers)
+            results = pool.imap_unordered(score_pair, todo, chunksize=max(1, min(64, len(todo) // (4 * args.num_workers))))
+        else:
+            pool = None
+            results = map(score_pair, todo)
+        try:
+            # Stream every score to disk as soon as it is computed
+            for row in results:
+                if row is None:
+                    num_failed += 1
+                    continue
+                if writer is not None:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(row) + '\n')
+                f.flush()
+                rows.append(row)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    if num_failed:
+        print('{} files could not be scored and will be retried on the next run'.format(num_failed))
+
+    course_scores, (num_files, overall) = average_scores(rows)
+    print('course\tfiles\t' + '\t'.join(SCORE_FIELDS))
+    for course_num, (count, scores) in course_scores.items():
+        print('{}\t{}\t'.format(course_num, count) + '\t'.join('{:.4f}'.format(score) for score in scores))
+    print('Average rouge score over all the {} files is : '.format(num_files) + ' '.join('{:.4f}'.format(score) for score in overall))
+    return course_scores, overall
 
 
 if __name__ == "__main__":
-    courses_dir = ""
-    res_dir = ""
-    main(courses_dir, res_dir)
+    main(get_rouge_args())
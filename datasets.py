@@ -8,13 +8,71 @@ import logging
 import numpy as np
 import torch
 from PIL import Image
-from torch.utils.data import Dataset
-from nltk.corpus import stopwords, words
-from nltk.tokenize import sent_tokenize, word_tokenize, TweetTokenizer
-from nltk.stem import WordNetLemmatizer
+import torch.nn.functional as F
+from torch.utils.data import Dataset, Sampler
+from nltk.tokenize import sent_tokenize
+from text_normalization import blank_sentences, is_blank_sentence, read_transcript, tokenize_sentences
 
 final_indices_path = 'dataset_inter2.pkl'
 
+# Names of the packed sentence embeddings of a course, written by `preprocess_text.embed_course`
+SENTENCE_STORE = 'sentence_embeddings'
+
+class SentenceEmbeddingStore:
+    """
+    The sentence embeddings of all the videos of a course, packed in one (num_sentences, 300) float32 matrix
+    (memory-mapped) with the row offset and the processed sentences of every video.
+    """
+    def __init__(self, course_path):
+        """
+        Args :
+             course_path (string) : The course directory holding `sentence_embeddings.json` and the matrix it names.
+        """
+        with open(os.path.join(course_path, SENTENCE_STORE + '.json')) as f:
+            meta = json.load(f)
+        # `sentence_embeddings.npy` for the stores written before the matrices were versioned
+        embeddings_path = os.path.join(course_path, meta.get('embeddings', SENTENCE_STORE + '.npy'))
+        self.embeddings = np.load(embeddings_path, mmap_mode='r')
+        if self.embeddings.shape[0] != meta['offsets'][-1]:
+            raise ValueError('{} has {} rows, {} expected by its metadata'.format(embeddings_path, self.embeddings.shape[0], meta['offsets'][-1]))
+        self.offsets = {video: (start, end) for video, start, end in zip(meta['videos'], meta['offsets'][:-1], meta['offsets'][1:])}
+        self.sentences = dict(zip(meta['videos'], meta['sentences']))
+
+    def __contains__(self, video):
+        return video in self.offsets
+
+    def get(self, video):
+        """The sentences of a video and their (num_sentences, 300) embeddings."""
+        start, end = self.offsets[video]
+        return self.sentences[video], torch.from_numpy(np.array(self.embeddings[start:end]))
+
+# Course directory -> its SentenceEmbeddingStore (None when the course has none), per process
+sentence_stores = {}
+
+def load_sentence_embeddings(embedding_path):
+    """
+    The sentences and embeddings of a video, from the packed store of its course when there is one,
+    otherwise from the `torch.save`d {sentence: embedding} dict at `embedding_path`.
+
+    Returns:
+        sentences (list) : The processed sentences of the video, in order.
+        embeddings (torch.Tensor) : (num_sentences, 300) tensor.
+    """
+    course_path = os.path.dirname(os.path.dirname(embedding_path))
+    if course_path not in sentence_stores:
+        has_store = os.path.exists(os.path.join(course_path, SENTENCE_STORE + '.json'))
+        sentence_stores[course_path] = SentenceEmbeddingStore(course_path) if has_store else None
+    store = sentence_stores[course_path]
+    video = os.path.basename(embedding_path)[:-3]
+    if store is not None and video in store:
+        return store.get(video)
+
+    embedding_dict = torch.load(embedding_path)
+    embeddings = torch.zeros(len(embedding_dict), 300)
+    for count, sentence in enumerate(embedding_dict):
+        embeddings[count] = embedding_dict[sentence]
+    return list(embedding_dict), embeddings
+
 class TextDataset(Dataset):
     """
     A Pytorch dataset class to be used in the Pytorch Dataloader to create text batches
@@ -41,7 +99,13 @@ class TextDataset(Dataset):
         
         for course_number in sorted(dirlist, key=int):
             course_transcript_path = os.path.join(self.courses_dir, course_number, 'sentence_features/')
-            for transcript_path in sorted(os.listdir(course_transcript_path), key=self.get_num):
+            if os.path.isdir(course_transcript_path):
+                transcript_paths = os.listdir(course_transcript_path)
+            else:
+                # Courses only embedded into a packed store (see `preprocess_text.embed_course`)
+                with open(os.path.join(self.courses_dir, course_number, SENTENCE_STORE + '.json')) as f:
+                    transcript_paths = [video + '.pt' for video in json.load(f)['videos']]
+            for transcript_path in sorted(transcript_paths, key=self.get_num):
                 if '_' in transcript_path:
                     continue
                 # Dataset cleanup for consistency
@@ -61,13 +125,74 @@ class TextDataset(Dataset):
         return len(self.text_embedding_paths)
     
     def __getitem__(self, idx):
-        self.embedding_path = self.text_embedding_paths[idx]
-        self.embedding_dict = torch.load(self.embedding_path)
-        word_vectors = torch.zeros(len(self.embedding_dict)+1, 300)
-        for count, sentence in enumerate(self.embedding_dict):
-            word_vectors[count] = self.embedding_dict[sentence]
-        word_vectors[len(self.embedding_dict)] = torch.zeros(1, 300) - 1            # End of summary token embedding
-        return word_vectors, len(self.embedding_dict) + 1                           # Added EOS to the original data
+        return self.get_with_sentences(idx)[1:]
+
+    def get_with_sentences(self, idx):
+        """The sentences of a transcript (in the order of its embeddings) along with its item."""
+        sentences, embeddings = load_sentence_embeddings(self.text_embedding_paths[idx])
+        word_vectors = torch.cat((embeddings, torch.zeros(1, 300) - 1))             # End of summary token embedding
+        return sentences, word_vectors, len(embeddings) + 1                         # Added EOS to the original data
+
+# Keyframes kept per video by `keyframe_dedup.py`, and the directory of their cached ResNet features
+KEYFRAME_SELECTION = 'keyframes.json'
+KEYFRAME_FEATURES = 'keyframe_features'
+
+def get_keyframe_num(path):
+    """The number n of a `<video>_i_frame_<n>.jpg` keyframe."""
+    return int(re.search(r'\d+', re.search(r'_\d+', path).group()).group())
+
+def load_keyframe_selection(course_path):
+    """The {video: {'frames': [...], 'content': [...]}} selection of a course, None when it has none."""
+    selection_path = os.path.join(course_path, KEYFRAME_SELECTION)
+    if not os.path.exists(selection_path):
+        return None
+    with open(selection_path, 'r') as f:
+        return json.load(f)['videos']
+
+# Keyframes of a course resized to a fixed height and packed in one array by `pack_keyframes.py`
+KEYFRAME_STORE = 'keyframe_store'
+
+class KeyframeStore:
+    """
+    The keyframes of all the videos of a course, packed in one (num_keyframes, height, width, 3) uint8 RGB array
+    (memory-mapped), with the rows of the keyframes of every video.
+    """
+    def __init__(self, course_path):
+        """
+        Args :
+             course_path (string) : The course directory holding `keyframe_store.json` and the array it names.
+        """
+        with open(os.path.join(course_path, KEYFRAME_STORE + '.json')) as f:
+            meta = json.load(f)
+        # `keyframe_store.npy` for the stores written before the arrays were versioned
+        images_path = os.path.join(course_path, meta.get('store', KEYFRAME_STORE + '.npy'))
+        self.images = np.load(images_path, mmap_mode='r')
+        shape = (meta['offsets'][-1], meta['height'], meta['width'], 3)
+        if self.images.shape != shape:
+            raise ValueError('{} has shape {}, {} expected by its metadata'.format(images_path, self.images.shape, shape))
+        self.rows = {video: {name: start + row for row, name in enumerate(frames)}
+                     for video, start, frames in zip(meta['videos'], meta['offsets'], meta['frames'])}
+
+    def __contains__(self, video):
+        return video in self.rows
+
+    def get(self, video, names):
+        """The (num_keyframes, height, width, 3) uint8 keyframes `names` of a video."""
+        rows = [self.rows[video][name] for name in names]
+        if rows == list(range(rows[0], rows[0] + len(rows))):
+            # All the keyframes of the video : a single copy of contiguous rows
+            return torch.from_numpy(np.array(self.images[rows[0]:rows[0] + len(rows)]))
+        return torch.from_numpy(self.images[rows])
+
+# Course directory -> its KeyframeStore, per process
+keyframe_stores = {}
+
+def get_keyframe_store(course_path):
+    if course_path not in keyframe_stores:
+        if not os.path.exists(os.path.join(course_path, KEYFRAME_STORE + '.json')):
+            raise ValueError('No packed keyframes in {}, run pack_keyframes.py first'.format(course_path))
+        keyframe_stores[course_path] = KeyframeStore(course_path)
+    return keyframe_stores[course_path]
 
 class ImageDataset(Dataset):
     """
@@ -77,24 +202,33 @@ class ImageDataset(Dataset):
     self.image_paths (2D list) : A 2D list containing image paths of all the videos.
                                  The first index represents the video, and the
                                  second index represents the keyframe.
+    self.image_contents (2D list) : The content hash of every keyframe of `image_paths`, None for the
+                                    videos of courses without a keyframe selection.
     self.num_videos (int) : The total number of videos across courses in the dataset.
 
     """
-    def __init__(self, courses_dir, transform = None):
+    def __init__(self, courses_dir, transform = None, features = None, packed = False):
         """
         Args:
             courses_dir (string) : Directory with all the courses
             transform (torchvision.transforms.transforms.Compose) : The required transformation required to normalize all images
+            features (string) : Return the cached ResNet features of the keyframes computed with these weights
+                                (see `keyframe_dedup.weights_fingerprint`) instead of the transformed images.
+            packed (bool) : Return the untransformed uint8 keyframes of the course stores written by pack_keyframes.py,
+                            to be transformed batch by batch (see `PackedKeyframeCollator`). `transform` is ignored.
         """
         self.courses_dir = courses_dir
         self.transform = transform
+        self.features = features
+        self.packed = packed
         self.num_videos = 0
         with open(final_indices_path, 'rb') as f:
             self.dataset_inter = pickle.load(f)
+        self.image_contents = []
         self.image_paths = self.load_image_paths()
 
     def get_num(self, str):
-        return int(re.search(r'\d+', re.search(r'_\d+', str).group()).group())
+        return get_keyframe_num(str)
     
     def load_image_paths(self):
         images = []
@@ -107,6 +241,8 @@ class ImageDataset(Dataset):
 
         for course_dir in sorted(dirlist, key=int):
             keyframes_dir_path = os.path.join(self.courses_dir, course_dir, 'video_key_frames/')
+            # The keyframes left by keyframe_dedup.py, when it was run on the course
+            selection = load_keyframe_selection(os.path.join(self.courses_dir, course_dir))
 
             for video_dir in sorted(os.listdir(keyframes_dir_path), key=int):
                 # Dataset cleanup for consistency
@@ -116,9 +252,16 @@ class ImageDataset(Dataset):
                 
                 self.num_videos += 1
                 video_dir_path = os.path.join(keyframes_dir_path, video_dir)
-                keyframes = [os.path.join(video_dir_path, img) for img in os.listdir(video_dir_path) \
-                            if os.path.isfile(os.path.join(video_dir_path, img))]
-                keyframes.sort(key = self.get_num)
+                if selection is not None and video_dir in selection:
+                    keyframes = [os.path.join(video_dir_path, img) for img in selection[video_dir]['frames']]
+                    self.image_contents.append(selection[video_dir]['content'])
+                else:
+                    if self.features is not None:
+                        raise ValueError('No keyframe selection for {}, run keyframe_dedup.py first'.format(video_dir_path))
+                    keyframes = [os.path.join(video_dir_path, img) for img in os.listdir(video_dir_path) \
+                                if os.path.isfile(os.path.join(video_dir_path, img))]
+                    keyframes.sort(key = self.get_num)
+                    self.image_contents.append(None)
                 images.extend([keyframes])
 
         return images
@@ -126,7 +269,27 @@ class ImageDataset(Dataset):
     def __len__(self):
         return self.num_videos
 
+    def get_course_path(self, idx):
+        # <course>/video_key_frames/<video>/<keyframe>
+        return os.path.dirname(os.path.dirname(os.path.dirname(self.image_paths[idx][0])))
+
+    def load_features(self, idx):
+        features_dir = os.path.join(self.get_course_path(idx), KEYFRAME_FEATURES, self.features)
+        features = [np.load(os.path.join(features_dir, content + '.npy')) for content in self.image_contents[idx]]
+        return torch.from_numpy(np.stack(features))
+
+    def load_packed(self, idx):
+        video = os.path.basename(os.path.dirname(self.image_paths[idx][0]))
+        store = get_keyframe_store(self.get_course_path(idx))
+        return store.get(video, [os.path.basename(path) for path in self.image_paths[idx]])
+
     def __getitem__(self, idx):
+        if self.features is not None:
+            features = self.load_features(idx)
+            return features, len(features)
+        if self.packed:
+            images = self.load_packed(idx)
+            return images, len(images)
         transformed_images = []
         for image_path in self.image_paths[idx]:
             image = Image.open(image_path)
@@ -162,6 +325,9 @@ class AudioDataset(Dataset):
         
         for course_number in sorted(dirlist, key=int):
             course_audio_path = os.path.join(self.courses_dir, course_number, 'audio-features/')
+            if not os.path.isdir(course_audio_path):
+                # Courses whose features were only computed by audio_features.py
+                course_audio_path = os.path.join(self.courses_dir, course_number, 'audio-features8/')
             
             for audio_path in sorted(os.listdir(course_audio_path), key=self.get_num):
                 # Dataset cleanup for consistency
@@ -187,6 +353,35 @@ class AudioDataset(Dataset):
         audio_vectors = torch.from_numpy(audio_vectors)
         return audio_vectors, int(audio_vectors.size(0))
 
+def get_sentence_index(source_sentences, target_sentence):
+    """Index of the first source sentence containing `target_sentence`, None if there is none."""
+    for idx, sent in enumerate(source_sentences):
+        if target_sentence in sent:
+            return idx
+
+def get_target_indices(source_sentences, target_text, words_set):
+    """
+    Align a ground-truth summary with the processed sentences of its transcript.
+
+    Args :
+         source_sentences (list) : The processed sentences of the transcript.
+         target_text (string) : The cleaned ground-truth text.
+         words_set (set) : Vocabulary deciding which ground-truth sentences are blank.
+
+    Returns :
+         target_indices (list) : The index of the source sentence of every non-blank ground-truth sentence found
+                                 in the transcript, in order (the EOS index is not included).
+    """
+    target_tokens = tokenize_sentences(sent_tokenize(target_text))
+    target_indices = []
+    for sent, blank in zip(target_tokens, blank_sentences(target_tokens, words_set)):
+        if blank: # Ignore blank sentences
+            continue
+        index = get_sentence_index(source_sentences, ' '.join(sent))
+        if index is not None:
+            target_indices.append(index)
+    return target_indices
+
 class TargetDataset(Dataset):
     """
     A Pytorch dataset class to be used in loading target datatset for training and evaluation purpose.
@@ -203,7 +398,6 @@ class TargetDataset(Dataset):
         self.source_sentences_path = self.load_source_sentences_path()
         with open('words_set.pkl', 'rb') as f:
             self.words_set = pickle.load(f)
-        self.lemmatizer = WordNetLemmatizer()
 
     def load_target_sentences_path(self):
         target_sentences = []
@@ -232,68 +426,27 @@ class TargetDataset(Dataset):
     def __getitem__(self, idx):
         lines = []
         try:
-            emb = torch.load(self.source_sentences_path[idx])
+            source_sentences, _ = load_sentence_embeddings(self.source_sentences_path[idx])
         except Exception as e:
             logging.error('Unable to open file. Exception: ' + str(e))
-        else:
-            source_sentences = emb.keys()
 
-        lines = []
         try:
-            with open(self.target_sentences_path[idx]) as f:
-                for line in f:
-                    if re.match(r'\d+:\d+', line) is None:
-                        line = line.replace('[MUSIC]', '')
-                        lines.append(line.strip())
+            lines = read_transcript(self.target_sentences_path[idx])
         except Exception as e:
             logging.error('Unable to open file. Exception: ' + str(e))
         else:
             target_text = ' '.join(lines)
 
-        # target_text = target_text.lower()
-        target_sentences = sent_tokenize(target_text)
-        stop_words = stopwords.words('english')
-        tweet_tokenizer = TweetTokenizer()
-        target_sentences_processed = []
-        for idx2 in range(len(target_sentences)):
-            target_sentences[idx2] = target_sentences[idx2].lower()
-            words = tweet_tokenizer.tokenize(target_sentences[idx2])
-            sent = [word for word in words if word not in stop_words]
-            if not self.is_blank_sentence(sent): # Ignore blank sentences
-                target_sentences_processed.append(' '.join(sent))
-
-        target_indices = []
-        for tidx, target_sentence in enumerate(target_sentences_processed):
-            # target_indices.append(torch.Tensor([source_sentences.index(target_sentence)]))
-            try:
-                target_indices.append(torch.Tensor([self.get_index(source_sentences, target_sentence)]))
-            except Exception as e:
-                if False:
-                    print("Exception: " + str(e))
-                    print(self.target_sentences_path[idx])
-                    print(target_sentences)
-                    print('\n--------------------')
-                    print(target_sentence)
-                    print('\n--------------------')
-                    print(target_sentences[tidx])
-                    print('\n\n--------------------\n\n')
-                    print(source_sentences)
-                    print('\n-----------------------\n')
-                continue
+        target_indices = [torch.Tensor([index]) for index in get_target_indices(source_sentences, target_text, self.words_set)]
         target_indices.append(torch.Tensor([len(source_sentences)]))                        # Appended the EOS token
         
         return torch.stack(target_indices), self.source_sentences_path[idx], self.target_sentences_path[idx], len(target_indices)
 
     def get_index(self, source_sentences, target_sentence):
-        for idx, sent in enumerate(source_sentences):
-            if target_sentence in sent:
-                return idx
+        return get_sentence_index(source_sentences, target_sentence)
 
     def is_blank_sentence(self, sentence):
-        for token in sentence:
-            if self.lemmatizer.lemmatize(token) in self.words_set:
-                return False
-        return True
+        return is_blank_sentence(sentence, self.words_set)
 
 def collator(DataLoaderBatch):
     items = [item[0] for item in DataLoaderBatch]
@@ -301,6 +454,123 @@ def collator(DataLoaderBatch):
     padded_seq = torch.nn.utils.rnn.pad_sequence(items, batch_first=True, padding_value=0)
     return padded_seq, lengths
 
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+class KeyframeBatchTransform:
+    """
+    The image transforms of train.py and evaluate.py as tensor operations over a whole stack of packed keyframes.
+    For training, `RandomResizedCrop(size)` and `RandomHorizontalFlip()`; for evaluation, `CenterCrop(size)` (the
+    packed keyframes are already resized to a height of `size`, as `Resize(size)` would). Both are followed by
+    the ImageNet normalization.
+    """
+    def __init__(self, size=256, train=False, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+        """
+        Args :
+             size (int) : Side of the output images.
+             train (bool) : Random crops and flips instead of the center crop.
+             scale (tuple) : Range of the area of the random crops, relative to the keyframe.
+             ratio (tuple) : Range of the aspect ratio of the random crops.
+        """
+        self.size = size
+        self.train = train
+        self.scale = scale
+        self.ratio = ratio
+        mean, std = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1), torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+        self.norm_scale = 1 / (255 * std)
+        self.norm_shift = mean / std
+
+    def crop_boxes(self, num_images, height, width, num_attempts=10):
+        """
+        The (x1, y1, x2, y2) boxes of `RandomResizedCrop` for `num_images` keyframes, all drawn at once : the first of
+        `num_attempts` random boxes fitting in the keyframe, or a center crop of the whole keyframe when none fits.
+        """
+        target_area = height * width * torch.empty(num_images, num_attempts).uniform_(*self.scale)
+        log_ratio = (np.log(self.ratio[0]), np.log(self.ratio[1]))
+        aspect_ratio = torch.exp(torch.empty(num_images, num_attempts).uniform_(*log_ratio))
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+        fits = (w > 0) & (h > 0) & (w <= width) & (h <= height)
+        first = fits.float().argmax(1, keepdim=True)
+        w, h, fits = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1), fits.any(1)
+
+        # Fallback to the whole keyframe, clamped to the ratio range
+        fallback_w, fallback_h = width, height
+        if width / height < min(self.ratio):
+            fallback_h = int(round(width / min(self.ratio)))
+        elif width / height > max(self.ratio):
+            fallback_w = int(round(height * max(self.ratio)))
+        w = torch.where(fits, w, torch.full_like(w, fallback_w))
+        h = torch.where(fits, h, torch.full_like(h, fallback_h))
+        top = torch.where(fits, (torch.rand(num_images) * (height - h + 1)).floor(), ((height - h) // 2))
+        left = torch.where(fits, (torch.rand(num_images) * (width - w + 1)).floor(), ((width - w) // 2))
+        return torch.stack([left, top, left + w, top + h], 1)
+
+    def crop(self, images):
+        """
+        Args :
+             images (torch.Tensor) : (num_images, height, width, 3) uint8 RGB keyframes.
+
+        Returns :
+             images (torch.Tensor) : (num_images, 3, size, size) uint8 crops (a view for the center crop).
+        """
+        num_images, height, width, _ = images.shape
+        if not self.train or num_images == 0:
+            top, left = int(round((height - self.size) / 2.)), int(round((width - self.size) / 2.))
+            return images[:, top:top + self.size, left:left + self.size].permute(0, 3, 1, 2)
+        boxes = self.crop_boxes(num_images, height, width).long().tolist()
+        # The crops differ in size, each is resized on uint8 with an antialiased bilinear filter (as `Resize` on tensors)
+        images = torch.cat([F.interpolate(images[k, top:bottom, left:right].permute(2, 0, 1).unsqueeze(0), size=(self.size, self.size),
+                                          mode='bilinear', antialias=True, align_corners=False)
+                            for k, (left, top, right, bottom) in enumerate(boxes)])
+        flip = torch.rand(num_images) < 0.5
+        images[flip] = images[flip].flip(-1)
+        return images
+
+    def normalize_(self, images):
+        """(images / 255 - mean) / std, in place on float images."""
+        return images.mul_(self.norm_scale.to(images.device)).sub_(self.norm_shift.to(images.device))
+
+    def __call__(self, images):
+        """
+        Args :
+             images (torch.Tensor) : (..., height, width, 3) uint8 RGB keyframes.
+
+        Returns :
+             images (torch.Tensor) : (..., 3, size, size) normalized float images.
+        """
+        batch_shape = images.shape[:-3]
+        images = self.crop(images.reshape(-1, *images.shape[-3:]))
+        return self.normalize_(images.float()).reshape(*batch_shape, 3, self.size, self.size)
+
+class PackedKeyframeCollator:
+    """
+    `collator` for packed keyframes : the keyframes of the whole batch are cropped at once, then converted to
+    float and normalized directly in the padded batch, without an intermediate float copy.
+    """
+    def __init__(self, transform):
+        """
+        Args :
+             transform (KeyframeBatchTransform) : The transform of the keyframes.
+        """
+        self.transform = transform
+
+    def __call__(self, DataLoaderBatch):
+        items = [item[0] for item in DataLoaderBatch]
+        lengths = [num_elements.size(0) for num_elements in items]
+        crops = self.transform.crop(torch.cat(items)).split(lengths)
+        size = self.transform.size
+        padded_seq = torch.zeros(len(items), max(lengths, default=0), 3, size, size)
+        for row, images in enumerate(crops):
+            self.transform.normalize_(padded_seq[row, :len(images)].copy_(images))
+        return padded_seq, lengths
+
+def get_image_collator(image_dataset, train=False, size=256):
+    """The collate function of the images of `image_dataset` : `collator`, or a `PackedKeyframeCollator` for packed keyframes."""
+    if getattr(image_dataset, 'packed', False):
+        return PackedKeyframeCollator(KeyframeBatchTransform(size, train))
+    return collator
+
 def target_collator(DataLoaderBatch):
     batch_items = [item for item in DataLoaderBatch]
     items, source_sent_paths, target_sent_paths, _ = zip(*batch_items)
@@ -308,6 +578,82 @@ def target_collator(DataLoaderBatch):
     padded_seq = torch.nn.utils.rnn.pad_sequence(items, batch_first=True, padding_value=0)
     return padded_seq, source_sent_paths, target_sent_paths, lengths
 
+class ShardedIndexSampler(Sampler):
+    """
+    A `DistributedSampler`-style sampler over an explicit list of dataset indices
+    (e.g. the output of `gen_train_val_indices`).
+
+    Every process gets a disjoint, equally sized shard of `indices`. The list is padded
+    by repeating indices from its start so that all ranks run the same number of steps.
+    When shuffling, the permutation only depends on `seed` and the epoch set through
+    `set_epoch`, so the text, audio, image and target loaders sharing this sampler stay aligned.
+    `set_epoch` can also skip the samples of this rank's shard consumed before a resume.
+    """
+    def __init__(self, indices, num_replicas=1, rank=0, shuffle=False, seed=0):
+        """
+        Args :
+             indices (list) : Dataset indices to draw from.
+             num_replicas (int) : Number of processes taking part in training.
+             rank (int) : Rank of the current process.
+             shuffle (bool) : Reshuffle the indices every epoch.
+             seed (int) : Seed shared by all processes for the shuffle.
+        """
+        self.indices = list(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = int(np.ceil(len(self.indices) / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+    def set_epoch(self, epoch, start=0):
+        """
+        Args :
+             epoch (int) : Epoch used to seed the shuffle.
+             start (int) : Number of samples of this rank's shard to skip.
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            indices = [indices[i] for i in rng.permutation(len(indices))]
+
+        # Pad so that the shards are evenly sized
+        indices = indices + indices[:(self.total_size - len(indices))]
+        return iter(indices[self.rank:self.total_size:self.num_replicas][self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+class PreloadedDataset(Dataset):
+    """
+    The items of another dataset at a fixed set of indices, read once and kept in memory
+    (e.g. to evaluate many checkpoints on the same videos without re-reading the files).
+    Indexed with the indices of the wrapped dataset.
+    """
+    def __init__(self, dataset, indices, num_workers=0):
+        """
+        Args :
+             dataset (Dataset) : Dataset to read from.
+             indices (list) : Indices of the items to keep.
+             num_workers (int) : Number of sub-processes reading the items.
+        """
+        self.dataset_size = len(dataset)
+        self.packed = getattr(dataset, 'packed', False)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, sampler=list(indices), num_workers=num_workers)
+        self.items = dict(zip(indices, loader))
+
+    def __len__(self):
+        return self.dataset_size
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
 def gen_train_val_indices(dataset, validation_split=0.1, shuffle=True):
     # Ignore indices from test set and videos where ground-truth is missing
     test_indices = get_test_indices()
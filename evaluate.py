@@ -1,7 +1,11 @@
 import os
+import queue
 import re
 import sys
+import time
 import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
 
 import numpy as np
 import seaborn as sns
@@ -9,6 +13,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.multiprocessing as mp
 import torch.optim.lr_scheduler as sched
 import torch.utils.data as data
 import torchvision
@@ -16,153 +21,359 @@ import torchvision.transforms as transforms
 from datasets import *
 from models import MMBiDAF
 from PIL import Image
-from rouge import Rouge
 from tensorboardX import SummaryWriter
 from tqdm import tqdm
 from ujson import load as json_load
 from nltk.tokenize import sent_tokenize
-from json import dumps
+from json import dumps, loads
 
 import util
-from args import get_train_args
+from args import get_evaluate_args
 
-from rouge import Rouge
-from nltk import PorterStemmer
-
-from sklearn.metrics import f1_score
-
-stemmer = PorterStemmer()
+from index_metrics import IndexMetrics, pad_indices
+from rouge_scorer import RougeScorer
+from text_normalization import read_transcript
 
 USE_CPU = False
 
-def get_indices(dataset):
-    # return get_test_indices()
-    train_indices, _ = gen_train_val_indices(dataset)
-    return train_indices
-
-def evaluate(courses_dir, hidden_size, text_embedding_size, audio_embedding_size, image_embedding_size, drop_prob, max_text_length, args, checkpoint_path, batch_size=1):
-    # Set up logging and devices
-    args.save_dir = util.get_save_dir(args.save_dir, args.name, training=False)
-    log = util.get_logger(args.save_dir, args.name)
-    log.info(f'Args: {dumps(vars(args), indent=4, sort_keys=True)}')
-    
-    device, gpu_ids = util.get_available_devices()
-
-    if USE_CPU:
-        device = torch.device('cpu')    #### TODO : only because GPU is out of memory
-        gpu_ids = None    #### TODO : Gpu out of memory
-    
-    if gpu_ids is not None:
-        args.batch_size *= max(1, len(gpu_ids))
-
-    # Set random seed
-    log.info(f'Using random seed {args.seed}...')
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed_all(args.seed)
-
-    model = MMBiDAF(hidden_size, text_embedding_size, audio_embedding_size, image_embedding_size, device, drop_prob, max_text_length)
-    model = nn.DataParallel(model, gpu_ids)
-    
-    log.info(f'Loading checkpoint from {args.load_path}...')
-    model = util.load_model(model, checkpoint_path, device, gpu_ids, return_step=False)
-    model = model.to(device)
-    model.eval()
-    # the loading is being performed in the train.py file as well
-
-    # model = load_model(model, checkpoint_path, args.gpu_ids)
-    print("Model Loaded")
-#     print(model)
-
-    # Create Dataset objects
+def get_indices(dataset, split='test', seed=224):
+    """
+    Dataset indices of the videos of a split, in a fixed order so that the shards are reproducible.
+    The train/val split is the one drawn by `train.py` with the same seed.
+    """
+    if split == 'test':
+        return sorted(get_test_indices())
+    np.random.seed(seed)
+    train_indices, val_indices = gen_train_val_indices(dataset)
+    return train_indices if split == 'train' else val_indices
+
+def get_shards(indices, num_shards):
+    """Split `indices` into `num_shards` contiguous shards whose sizes differ by at most one."""
+    bounds = np.linspace(0, len(indices), num_shards + 1).round().astype(int)
+    return [list(indices[bounds[k]:bounds[k + 1]]) for k in range(num_shards)]
+
+def get_eval_transform():
+    """Preprocess the image in prescribed format, without the random crops and flips of training."""
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    return transforms.Compose([transforms.Resize(256), transforms.CenterCrop(256), transforms.ToTensor(), normalize,])
+
+def get_datasets(courses_dir, max_text_length, image_features=None, packed_keyframes=False):
+    """
+    The text, audio, image and target datasets, with a deterministic image transform.
+    With `image_features`, the image dataset returns the ResNet features cached by keyframe_dedup.py for these weights,
+    with `packed_keyframes` the keyframes of the stores of pack_keyframes.py.
+    """
     text_dataset = TextDataset(courses_dir, max_text_length)
     audio_dataset = AudioDataset(courses_dir)
     target_dataset = TargetDataset(courses_dir)
-    # Preprocess the image in prescribed format
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    transform = transforms.Compose([transforms.RandomResizedCrop(256), transforms.RandomHorizontalFlip(), transforms.ToTensor(), normalize,])
-    image_dataset = ImageDataset(courses_dir, transform)
-
-    # Creating data indices for training and validation splits:
-    test_indices = get_indices(text_dataset)
-
-    # Creating PT data sampler and loaders:
-    test_sampler = torch.utils.data.SequentialSampler(test_indices)
-
-    # Get sentence embeddings
-    test_text_loader = torch.utils.data.DataLoader(text_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=test_sampler)
-
-    # Get Audio embeddings
-    test_audio_loader = torch.utils.data.DataLoader(audio_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=test_sampler)
-
-    # Get images
-    test_image_loader = torch.utils.data.DataLoader(image_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=test_sampler)
+    image_dataset = ImageDataset(courses_dir, get_eval_transform(), features=image_features, packed=packed_keyframes)
+    return text_dataset, audio_dataset, image_dataset, target_dataset
+
+def get_loaders(datasets, indices, batch_size):
+    """Loaders over `indices`, in order, sharing one sampler so that the four modalities stay aligned."""
+    sampler = ShardedIndexSampler(indices)
+    text_dataset, audio_dataset, image_dataset, target_dataset = datasets
+    # Evaluation processes are daemons, so the loaders cannot spawn workers of their own
+    return (torch.utils.data.DataLoader(text_dataset, batch_size=batch_size, collate_fn=collator, sampler=sampler),
+            torch.utils.data.DataLoader(audio_dataset, batch_size=batch_size, collate_fn=collator, sampler=sampler),
+            torch.utils.data.DataLoader(image_dataset, batch_size=batch_size, collate_fn=get_image_collator(image_dataset), sampler=sampler),
+            torch.utils.data.DataLoader(target_dataset, batch_size=batch_size, collate_fn=target_collator, sampler=sampler))
+
+def write_atomic(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def shard_paths(out_dir, shard_id):
+    """Per-video scores and summary of a shard. The summary is written last and marks the shard as done."""
+    prefix = os.path.join(out_dir, 'shard_{:03d}'.format(shard_id))
+    return prefix + '.jsonl', prefix + '.json'
+
+# Model and data of an evaluation process, set once by `init_evaluation_worker`
+worker_state = {}
+
+def init_evaluation_worker(model_kwargs, checkpoint_path, datasets, batch_size, num_threads):
+    """Pool initializer : build and load this process' own copy of the model once."""
+    torch.set_num_threads(num_threads)
+    device = model_kwargs['device']
+    model = nn.DataParallel(MMBiDAF(**model_kwargs), [])
+    model, step = util.load_model(model, checkpoint_path, device, [])
+    worker_state.update(model=model.to(device), device=device, datasets=datasets, batch_size=batch_size, step=step)
+
+def evaluate_shard(shard_id, indices, out_dir):
+    """
+    Score the videos of one shard and write their scores to `out_dir`.
+
+    Returns:
+        summary (OrderedDict) : Shard id, number of videos (scored or not), average NLL and running time.
+    """
+    start = time.time()
+    records = []
+    data_loaders = get_loaders(worker_state['datasets'], indices, worker_state['batch_size'])
+    scores = validate(worker_state['model'], data_loaders, worker_state['device'], records=records)
+
+    records = [OrderedDict([('index', int(indices[record['video']]))] + [(k, v) for k, v in record.items() if k != 'video'])
+               for record in records]
+    scores_path, summary_path = shard_paths(out_dir, shard_id)
+    write_atomic(scores_path, ''.join(dumps(record) + '\n' for record in records))
+    summary = OrderedDict([('shard', shard_id), ('step', worker_state['step']), ('num_videos', len(indices)),
+                           ('num_scored', len(records)), ('NLL', scores['NLL']), ('seconds', time.time() - start)])
+    write_atomic(summary_path, dumps(summary, indent=4))
+    return summary
+
+def run_evaluation_shard(task):
+    shard_id, indices, out_dir = task
+    try:
+        return evaluate_shard(shard_id, indices, out_dir)
+    except Exception as e:
+        logging.error('Shard {} failed. Exception: {}'.format(shard_id, e))
+        return OrderedDict([('shard', shard_id), ('error', str(e))])
+
+def merge_shard_results(out_dir, num_shards):
+    """
+    Merge the results of the finished shards of `out_dir` : every per-video score goes to `scores.jsonl`,
+    the averages over all the scored videos to `report.json`.
+
+    Returns:
+        report (OrderedDict) : The averages, with the number of videos and the shards still missing.
+    """
+    records, summaries, missing = [], [], []
+    for shard_id in range(num_shards):
+        scores_path, summary_path = shard_paths(out_dir, shard_id)
+        if not os.path.exists(summary_path):
+            missing.append(shard_id)
+            continue
+        with open(summary_path, 'r') as f:
+            summaries.append(json_load(f))
+        with open(scores_path, 'r') as f:
+            records.extend(loads(line) for line in f)
+
+    num_videos = sum(summary['num_videos'] for summary in summaries)
+    report = OrderedDict([('num_videos', num_videos), ('num_scored', len(records)), ('missing_shards', missing),
+                          ('NLL', sum(summary['NLL'] * summary['num_videos'] for summary in summaries) / max(1, num_videos))])
+    for name in METRIC_NAMES:
+        report[name] = float(np.mean([record[name] for record in records])) if records else 0.0
+
+    write_atomic(os.path.join(out_dir, 'scores.jsonl'), ''.join(dumps(record) + '\n' for record in records))
+    write_atomic(os.path.join(out_dir, 'report.json'), dumps(report, indent=4))
+    return report
+
+def evaluate(args, model_kwargs):
+    """
+    Evaluate the checkpoint `args.load_path` on a split, sharded over `args.eval_workers` processes.
+
+    The videos are split once into `args.num_shards` contiguous shards, recorded in `shards.json` of the
+    output directory. Every shard writes its own per-video scores, so a failed shard can be rerun alone
+    (`--out_dir <dir> --shards <id>`) and merged with the others.
+    """
+    out_dir = args.out_dir or util.get_save_dir(args.save_dir, args.name, training=False)
+    os.makedirs(out_dir, exist_ok=True)
+    log = util.get_logger(out_dir, args.name)
+    log.info(f'Args: {dumps(vars(args), indent=4, sort_keys=True)}')
 
-    # Load Target text
-    test_target_loader = torch.utils.data.DataLoader(target_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=target_collator, sampler=test_sampler)
+    image_features = None
+    if args.image_features:
+        # The cached features of the checkpoint's own ResNet weights
+        from keyframe_dedup import get_resnet_state, weights_fingerprint
+        image_features = weights_fingerprint(get_resnet_state(args.load_path))
+        log.info('Using the cached image features of weights {}'.format(image_features))
+    datasets = get_datasets(args.courses_dir, model_kwargs['max_transcript_length'], image_features, args.packed_keyframes)
+
+    # The shards are drawn once per output directory, reruns reuse them
+    manifest_path = os.path.join(out_dir, 'shards.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json_load(f)
+        if manifest['load_path'] != args.load_path:
+            raise ValueError('{} holds the results of {}, not {}'.format(out_dir, manifest['load_path'], args.load_path))
+    else:
+        indices = get_indices(datasets[0], args.split, args.seed)
+        manifest = OrderedDict([('load_path', args.load_path), ('split', args.split), ('shards', get_shards(indices, args.num_shards))])
+        write_atomic(manifest_path, dumps(manifest))
+    shards = manifest['shards']
 
-    batch_idx = 0
-    total_scores = [0]*9        # in order of 'p' 'r' and 'f' for r1, r2, rl
-    f1_score = 0
+    if args.shards:
+        todo = sorted(set(args.shards))
+    else:
+        todo = [shard_id for shard_id in range(len(shards)) if not os.path.exists(shard_paths(out_dir, shard_id)[1])]
+    tasks = [(shard_id, shards[shard_id], out_dir) for shard_id in todo if shards[shard_id]]
+    log.info('Evaluating {} of {} shards with {} processes of {} threads...'.format(len(tasks), len(shards), args.eval_workers, args.threads_per_worker))
+
+    initargs = (model_kwargs, args.load_path, datasets, args.batch_size, args.threads_per_worker)
+    num_workers = min(args.eval_workers, len(tasks))
+    start = time.time()
+    if num_workers > 1:
+        with mp.get_context('spawn').Pool(num_workers, initializer=init_evaluation_worker, initargs=initargs) as pool:
+            summaries = list(pool.imap_unordered(run_evaluation_shard, tasks))
+    else:
+        init_evaluation_worker(*initargs)
+        summaries = [run_evaluation_shard(task) for task in tasks]
+    for summary in sorted(summaries, key=lambda summary: summary['shard']):
+        log.info('Shard {}: {}'.format(summary['shard'], dumps(summary)))
+
+    report = merge_shard_results(out_dir, len(shards))
+    log.info('Evaluated {} videos in {:.1f}s'.format(sum(len(task[1]) for task in tasks), time.time() - start))
+    if report['missing_shards']:
+        log.warning('Shards {} have no results yet, rerun them with --out_dir {} --shards ...'.format(report['missing_shards'], out_dir))
+    log.info('Report: {}'.format(dumps(report, indent=4)))
+    return report
+
+def get_transcript_paths(batch_source_paths):
+    """Map sentence embedding paths to the processed transcripts holding the sentence text."""
+    return [path.replace('sentence_features3', 'processed_transcripts').replace('.pt', '.p') for path in batch_source_paths]
+
+# Per-video metrics reported by `validate`, after the NLL
+METRIC_NAMES = ('F1', 'Precision', 'Recall', 'ROUGE-1', 'ROUGE-2', 'ROUGE-L')
+
+def validate(model, data_loaders, device, records=None):
+    """
+    Run the model in evaluation mode over a set of batched loaders and score the greedy summaries.
+
+    Args:
+        model (torch.nn.Module) : Model to evaluate.
+        data_loaders (tuple) : The text, audio, image and target loaders, sharing one sampler.
+        device (torch.device) : Device to run the model on.
+        records (list) : If given, the scores of every scored video are appended to it, with the
+                         position of the video in the loaders (`video`) and its ground-truth path.
+
+    Returns:
+        scores (OrderedDict) : Average NLL, sentence index F1/precision/recall and ROUGE-1/2/L F-scores over the videos.
+    """
+    model.eval()
+    num_videos = 0
+    num_scored = 0
+    nll = 0
+    index_metrics = IndexMetrics()
+    rouge_scores = np.zeros(3)
     with torch.no_grad():
         for (batch_text, original_text_lengths), (batch_audio, original_audio_lengths), (batch_images, original_img_lengths), \
-            (batch_target_indices, batch_source_paths, batch_target_paths, original_target_len) \
-            in zip(test_text_loader, test_audio_loader, test_image_loader, test_target_loader):
-            batch_idx += 1
-
-            max_dec_len = max(original_target_len)             # TODO check error : max decoder timesteps for each batch 
-
-            # Transfer tensors to GPU
-            batch_text = batch_text.to(device)
-            # log.info("Loaded batch text")
-            batch_audio = batch_audio.to(device)
-            # log.info("Loaded batch audio")
-            batch_images = batch_images.to(device)
-            # log.info("Loaded batch image")
-            batch_target_indices = batch_target_indices.to(device)
-            # log.info("Loaded batch targets")
-
-            batch_out_distributions, _ = model(batch_text, original_text_lengths, batch_audio, original_audio_lengths, \
-                                            batch_images, original_img_lengths, batch_target_indices, original_target_len, max_dec_len)
-
-            # Generate summary for current batch
-            log.info("\n\nGenerating summaries for batch {}\n".format(batch_idx))
-
-            ###### FOR TESTING ##########
-#             print(batch_source_paths)
-#             print(type(batch_source_paths))
-            batch_source_paths = list(batch_source_paths)
-            for idx in range(len(batch_source_paths)):
-                batch_source_paths[idx] = batch_source_paths[idx].replace('sentence_features3', 'processed_transcripts').replace('.pt', '.p')
-#             print(batch_source_paths)
-            summaries, gen_idxs = get_generated_summaries(batch_out_distributions, original_text_lengths, batch_source_paths) # (batch_size, beam_size, sents)
-
-            print('Generated summaries for batch {}: '.format(batch_idx))
-            print(summaries)
+            (batch_target_indices, batch_source_paths, batch_target_paths, original_target_len) in zip(*data_loaders):
+            batch_size = batch_text.size(0)
+            max_dec_len = max(original_target_len)
+
+            batch_out_distributions, loss = model(batch_text.to(device), original_text_lengths, batch_audio.to(device), original_audio_lengths,
+                                                  batch_images.to(device), original_img_lengths, batch_target_indices.to(device), original_target_len, max_dec_len)
+            nll += loss.item()
+            num_videos += batch_size
 
+            summaries, gen_idxs = get_generated_summaries(batch_out_distributions, original_text_lengths, get_transcript_paths(batch_source_paths))
             try:
-                # Calculate Rouge score for the current batch
-                all_scrores = compute_rouge(summaries, batch_target_paths, beam_size=1) # tuple of all scores
-                for idx, score in enumerate(all_scrores):
-                    total_scores[idx] += score
-
-                # Calculate F1 score for the current batch
-                curr_f1_score = compute_f1(gen_idxs, batch_target_indices, beam_size=1)
-                print("F1 score: {}".format(curr_f1_score))
-                f1_score += curr_f1_score
+                refs = [rouge_scorer.reference(target_path) for target_path in batch_target_paths]
+                batch_rouge = rouge_scorer.score_batch([summary[0] for summary in summaries], refs)[:, :, 2]      # (batch_size, 3) F-scores
             except Exception as e:
-                print("Error: " + str(e))
+                logging.warning('Unable to score batch. Exception: ' + str(e))
                 continue
+            rouge_scores += batch_rouge.sum(0)
+            precision, recall, f1 = index_metrics.update(*get_index_tensors(gen_idxs, batch_target_indices, original_target_len))
+            num_scored += batch_size
+
+            if records is not None:
+                for idx in range(batch_size):
+                    values = [f1[idx].item(), precision[idx].item(), recall[idx].item()] + batch_rouge[idx].tolist()
+                    records.append(OrderedDict([('video', num_videos - batch_size + idx), ('target_path', batch_target_paths[idx]),
+                                                ('num_sentences', len(gen_idxs[idx][0]))] + list(zip(METRIC_NAMES, values))))
+
+    num_scored = max(1, num_scored)
+    index_scores = index_metrics.result()
+    return OrderedDict([('NLL', nll / max(1, num_videos)),
+                        ('F1', index_scores['F1']),
+                        ('Precision', index_scores['Precision']),
+                        ('Recall', index_scores['Recall']),
+                        ('ROUGE-1', rouge_scores[0] / num_scored),
+                        ('ROUGE-2', rouge_scores[1] / num_scored),
+                        ('ROUGE-L', rouge_scores[2] / num_scored)])
+
+def validation_worker(model_kwargs, datasets, indices, batch_size, num_threads, requests, results):
+    """
+    Entry point of the validation process started by `AsyncValidator`.
+    Builds its own model copy once, then scores every weight snapshot received on `requests`.
+    """
+    torch.set_num_threads(num_threads)
+    device = model_kwargs['device']
+    model = nn.DataParallel(MMBiDAF(**model_kwargs), [])
+    model = model.to(device)
 
-        # Average Rouge score across batches
-        for idx in range(len(total_scores)):                
-            total_scores[idx] /= batch_idx
+    data_loaders = get_loaders(datasets, indices, batch_size)
 
-        #Average F1 score
-        f1_score /= batch_idx
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        step, model_state = request
+        model.load_state_dict(model_state)
+        del model_state
+        try:
+            scores = validate(model, data_loaders, device)
+        except Exception as e:
+            logging.error('Validation failed at step {}. Exception: {}'.format(step, e))
+            scores = None
+        results.put((step, scores))
+
+class AsyncValidator:
+    """
+    Runs validation in a separate process so that training continues while a snapshot of the weights is evaluated.
+
+    Only one snapshot is evaluated at a time, `submit` returns False while the previous one is still running.
+    """
+    def __init__(self, model_kwargs, datasets, indices, batch_size, num_threads=1):
+        """
+        Args:
+            model_kwargs (dict) : Keyword arguments to build `MMBiDAF` in the worker.
+            datasets (tuple) : The text, audio, image and target datasets.
+            indices (list) : Dataset indices to validate on.
+            batch_size (int) : Batch size of the validation loaders.
+            num_threads (int) : Number of intra-op threads for the worker.
+        """
+        ctx = mp.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.busy = False
+        self.process = ctx.Process(target=validation_worker,
+                                   args=(model_kwargs, datasets, indices, batch_size, num_threads, self.requests, self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, step, model, ema=None):
+        """
+        Send a copy of the current (EMA) weights to the validation process.
+
+        Returns:
+            submitted (bool) : False if the previous validation has not finished yet.
+        """
+        if self.busy:
+            return False
+        if ema is not None:
+            ema.assign(model)
+        model_state = OrderedDict((name, tensor.detach().cpu().clone()) for name, tensor in model.state_dict().items())
+        if ema is not None:
+            ema.resume(model)
+        self.requests.put((step, model_state))
+        self.busy = True
+        return True
+
+    def poll(self, block=False):
+        """
+        Collect finished validations.
+
+        Returns:
+            results (list) : (step, scores) pairs, scores is None if the validation failed.
+        """
+        finished = []
+        while self.busy:
+            try:
+                finished.append(self.results.get(block=block))
+            except queue.Empty:
+                break
+            self.busy = False
+        return finished
 
-        print("Average Rouge score on the data is : {}".format(total_scores))
-        print("Average F1 score on the data is : {}".format(f1_score))
+    def close(self):
+        """Wait for the running validation and stop the worker. Returns its results."""
+        finished = self.poll(block=True)
+        self.requests.put(None)
+        self.process.join()
+        return finished
 
 def get_generated_summaries(batch_out_distributions, original_text_lengths, batch_source_paths, method='greedy', k=5):
     batch_out_distributions = np.array([dist.cpu().detach().numpy() for dist in batch_out_distributions])
@@ -233,99 +444,54 @@ def beam_search(out_distributions, original_text_length, source_path, k=5):
 
     return beam_summaries, beam_idxs
 
+@lru_cache(maxsize=256)
+def load_source_sentences(source_path):
+    """Read the processed sentences of a transcript once instead of once per selected sentence."""
+    with open(source_path, 'rb') as f:
+        source_file = pickle.load(f)
+    return tuple(sent[0] for sent in source_file)
+
+# Transcript sentences preloaded by path (see `sweep.py`), looked up before reading the transcript
+preloaded_sentences = {}
+
 def get_source_sentence(source_path, idx):
-    lines = []
     try:
-        with open(source_path, 'rb') as f:
-#             for line in f:
-#                     if re.match(r'\d+:\d+', line) is None:
-#                         line = line.replace('[MUSIC]', '')
-#                         lines.append(line.strip())
-            source_file = pickle.load(f)
+        source_sentences = preloaded_sentences.get(source_path)
+        if source_sentences is None:
+            source_sentences = load_source_sentences(source_path)
     except Exception as e:
         logging.error('Unable to open file. Exception: ' + str(e))
     else:
-        # print("Idx is  : {}".format(idx))
-#         source_text = ' '.join(lines)
-#         source_sentences = sent_tokenize(source_text)
-        # print("length of source sentences is : {}".format(len(source_sentences)))
-        source_sentences = [sent[0] for sent in source_file]
-#         for i in range(len(source_sentences)):
-#             source_sentences[i] = source_sentences[i].lower()
         if idx == len(source_sentences):
             return 0
         if idx > len(source_sentences):
             return None
         return source_sentences[idx]
 
-def prepare(gt, res):
-#     clean_gt = [" ".join([stemmer.stem(i) for i in line.split()]) for line in gt]
-#     clean_res = [" ".join([stemmer.stem(i) for i in line.split()]) for line in res]
-    return gt, res
-
-def get_rouge(clean_gt, clean_res):
-    rouge = Rouge()
-    scores = rouge.get_scores(clean_res, clean_gt, avg=True)
-    return scores
-
-def compute_rouge(summaries, batch_target_paths, beam_size=1):
-    total_score_r1p = total_score_r1r = total_score_r1f = total_score_r2p = \
-    total_score_r2r = total_score_r2f = total_score_rlp = total_score_rlr = total_score_rlf = 0
-    batch_count = len(summaries)
-    for batch_idx, batch_val in enumerate(summaries):
-        try:
-            gt_data = []
-            with open(batch_target_paths[batch_idx], 'r') as f:
-                for line in f:
-                    if re.match(r'\d+:\d+', line) is None:
-                        line = line.replace('[MUSIC]', '')
-                        line = line.lower()
-                        gt_data.append(line.strip())
-        except Exception as e:
-            print("Cannot open files with error : "+ str(e))
-#         print("Generated summary is : {}".format(summaries))
-#         print("Ground truth is : {}".format(gt_data))
-        summaries = [item for sublist in summaries for item in sublist]
-        res_data = batch_val[beam_size-1]
-        min_len = min(len(gt_data), len(res_data))
-        gt_data = gt_data[:min_len]
-        res_data = res_data[:min_len]
-        clean_gt, clean_res = prepare(gt_data, res_data)
-        score = get_rouge(clean_gt, clean_res)
-        total_score_r1p += score['rouge-1']['p']
-        total_score_r1r += score['rouge-1']['r']
-        total_score_r1f += score['rouge-1']['f']
-        total_score_r2p += score['rouge-2']['p']
-        total_score_r2r += score['rouge-2']['r']
-        total_score_r2f += score['rouge-2']['f']
-        total_score_rlp += score['rouge-l']['p']
-        total_score_rlr += score['rouge-l']['r']
-        total_score_rlf += score['rouge-l']['f']
-    
-    return (total_score_r1p/batch_count, total_score_r1r/batch_count, total_score_r1f/batch_count, \
-        total_score_r2p/batch_count, total_score_r2r/batch_count, total_score_r2f/batch_count, \
-        total_score_rlp/batch_count, total_score_rlr/batch_count, total_score_rlf/batch_count)
-
-def compute_f1(gen_idxs, batch_target_indices, beam_size=1):
-    f1_val = 0
-    batch_count = len(gen_idxs)
-    for batch_idx, batch_val in enumerate(gen_idxs):
-        gt_idxs = batch_target_indices[batch_idx].squeeze(0).tolist()
-        res_idxs = batch_val[beam_size-1]
-        min_len = min(len(gt_idxs), len(res_idxs))
-        gt_idxs = gt_idxs[:min_len]
-        res_idxs = res_idxs[:min_len]
-        f1_val += f1_score(gt_idxs, res_idxs, average='macro')          # this average is used in SQUAD dataset
-    return f1_val/batch_count
+def read_ground_truth(target_path):
+    """Read a ground-truth summary, dropping the timestamps and [MUSIC] tags."""
+    return [line.lower() for line in read_transcript(target_path)]
+
+# References are read and tokenized once per run, see `rouge_scorer.RougeScorer`
+rouge_scorer = RougeScorer(reader=read_ground_truth)
+
+def get_index_tensors(gen_idxs, batch_target_indices, original_target_len, beam_size=1):
+    """
+    Padded generated and ground-truth sentence indices of a batch, in the argument order of `IndexMetrics.update`.
+    The EOS index closing every target sequence is left out.
+    """
+    pred, pred_lengths = pad_indices([batch_val[beam_size-1] for batch_val in gen_idxs])
+    target_lengths = torch.as_tensor(original_target_len, dtype=torch.long) - 1
+    return pred, pred_lengths, batch_target_indices.cpu(), target_lengths
 
 if __name__ == "__main__":
-    hidden_size = 100
     text_embedding_size = 300
     audio_embedding_size = 128
     image_embedding_size = 1000
     drop_prob = 0.2
     max_text_length = 409
-    args = get_train_args()
-    checkpoint_path = "/home/amankhullar/model/multimodal_bidaf/save/train/temp-21/step_67900.pth.tar"
-    courses_dir = '/home/anish17281/NLP_Dataset/dataset/'
-    evaluate(courses_dir, hidden_size, text_embedding_size, audio_embedding_size, image_embedding_size, drop_prob, max_text_length, args, checkpoint_path)
+    args = get_evaluate_args()
+    device = torch.device('cpu') if USE_CPU else util.get_available_devices()[0]
+    model_kwargs = dict(hidden_size=args.hidden_size, text_embedding_size=text_embedding_size, audio_embedding_size=audio_embedding_size,
+                        image_embedding_size=image_embedding_size, device=device, drop_prob=drop_prob, max_transcript_length=max_text_length)
+    evaluate(args, model_kwargs)
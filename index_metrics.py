@@ -0,0 +1,153 @@
+"""
+Batched metrics over selected sentence indices.
+
+Generated and ground-truth summaries are compared as sets of source sentence indices:
+precision is the fraction of the distinct selected sentences that are in the ground truth,
+recall the fraction of the distinct ground-truth sentences that were selected.
+precision@k only looks at the first k selected sentences, in selection order.
+
+Everything works on padded (batch_size, max_len) index tensors and their lengths,
+so a whole evaluation batch is scored with a handful of tensor operations.
+"""
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
+
+def pad_indices(index_lists, padding_value=-1):
+    """
+    Pad a list of index lists into a tensor.
+
+    Returns:
+        indices (torch.LongTensor) : (batch_size, max_len) indices, padded with `padding_value`.
+        lengths (torch.LongTensor) : (batch_size,) number of valid indices per row.
+    """
+    lengths = torch.tensor([len(idxs) for idxs in index_lists], dtype=torch.long)
+    indices = torch.full((len(index_lists), max(1, int(lengths.max())) if len(index_lists) else 1), padding_value, dtype=torch.long)
+    for row, idxs in enumerate(index_lists):
+        if len(idxs):
+            indices[row, :len(idxs)] = torch.as_tensor(idxs, dtype=torch.long)
+    return indices, lengths
+
+def length_mask(lengths, max_len):
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+def first_occurrences(indices, mask):
+    """Mask of the valid positions holding the first occurrence of their index in the row."""
+    max_len = indices.size(1)
+    earlier = torch.ones(max_len, max_len, dtype=torch.bool, device=indices.device).tril(-1)
+    repeated = (indices.unsqueeze(2) == indices.unsqueeze(1)) & earlier & mask.unsqueeze(1)
+    return mask & ~repeated.any(2)
+
+def membership(indices, other, other_mask):
+    """Mask of the positions of `indices` whose index appears among the valid entries of `other`."""
+    return ((indices.unsqueeze(2) == other.unsqueeze(1)) & other_mask.unsqueeze(1)).any(2)
+
+def set_prf(pred, pred_lengths, target, target_lengths):
+    """
+    Set-based precision, recall and F1 of every row.
+
+    Args:
+        pred (torch.Tensor) : (batch_size, max_pred_len) selected indices, any padding.
+        pred_lengths (torch.Tensor) : (batch_size,) number of selected indices per row.
+        target (torch.Tensor) : (batch_size, max_target_len) ground-truth indices, any padding
+                                (extra trailing dimensions of size 1 are flattened).
+        target_lengths (torch.Tensor) : (batch_size,) number of ground-truth indices per row.
+
+    Returns:
+        precision, recall, f1 (torch.Tensor) : (batch_size,) float tensors, 0 for empty sets.
+    """
+    pred, pred_lengths, target, target_lengths = as_index_tensors(pred, pred_lengths, target, target_lengths)
+    pred_mask = length_mask(pred_lengths, pred.size(1))
+    target_mask = length_mask(target_lengths, target.size(1))
+
+    pred_first = first_occurrences(pred, pred_mask)
+    target_first = first_occurrences(target, target_mask)
+    hits = (pred_first & membership(pred, target, target_mask)).sum(1).double()
+
+    precision = hits / pred_first.sum(1).clamp(min=1)
+    recall = hits / target_first.sum(1).clamp(min=1)
+    f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+    return precision, recall, f1
+
+def precision_at_k(pred, pred_lengths, target, target_lengths, ks=(1, 3, 5)):
+    """
+    Fraction of the first k selected indices that are (distinct) ground-truth indices, for every k in `ks`.
+    Rows selecting fewer than k indices are still divided by k.
+
+    Returns:
+        precisions (torch.Tensor) : (batch_size, len(ks)) float tensor.
+    """
+    pred, pred_lengths, target, target_lengths = as_index_tensors(pred, pred_lengths, target, target_lengths)
+    pred_mask = length_mask(pred_lengths, pred.size(1))
+    target_mask = length_mask(target_lengths, target.size(1))
+
+    hits = (first_occurrences(pred, pred_mask) & membership(pred, target, target_mask)).double()
+    cumulative_hits = hits.cumsum(1)
+    precisions = []
+    for k in ks:
+        if pred.size(1) == 0:
+            precisions.append(hits.new_zeros(pred.size(0)))
+        else:
+            precisions.append(cumulative_hits[:, min(k, pred.size(1)) - 1] / k)
+    return torch.stack(precisions, 1)
+
+def as_index_tensors(pred, pred_lengths, target, target_lengths):
+    target = torch.as_tensor(target)
+    pred = torch.as_tensor(pred, device=target.device).long().reshape(len(pred), -1)
+    target = target.long().reshape(target.size(0), -1)
+    pred_lengths = torch.as_tensor(pred_lengths, device=target.device).long()
+    target_lengths = torch.as_tensor(target_lengths, device=target.device).long()
+    return pred, pred_lengths, target, target_lengths
+
+class IndexMetrics:
+    """
+    Running sums of the per-row index metrics.
+
+    Accumulators of different processes (or of shards scored separately) are combined
+    with `merge`, or in place over a `torch.distributed` group with `all_reduce`.
+
+    Args:
+        ks (tuple) : The k of the reported precision@k.
+    """
+    def __init__(self, ks=(1, 3, 5)):
+        self.ks = tuple(ks)
+        # count, precision, recall, F1, then precision@k for every k
+        self.totals = torch.zeros(4 + len(self.ks), dtype=torch.float64)
+
+    def update(self, pred, pred_lengths, target, target_lengths):
+        """Add a batch, see `set_prf` for the arguments."""
+        precision, recall, f1 = set_prf(pred, pred_lengths, target, target_lengths)
+        at_k = precision_at_k(pred, pred_lengths, target, target_lengths, self.ks)
+        batch_totals = torch.cat([torch.tensor([float(len(precision))], dtype=torch.float64),
+                                  torch.stack([precision.sum(), recall.sum(), f1.sum()]).cpu(),
+                                  at_k.sum(0).cpu()])
+        self.totals += batch_totals
+        return precision, recall, f1
+
+    def merge(self, other):
+        assert self.ks == other.ks, 'Cannot merge metrics over different k'
+        self.totals += other.totals
+        return self
+
+    def all_reduce(self):
+        """Sum the totals of all the processes of the default group (no-op when not distributed)."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.totals)
+        return self
+
+    def state_dict(self):
+        return {'ks': self.ks, 'totals': self.totals.clone()}
+
+    def load_state_dict(self, state_dict):
+        self.ks = tuple(state_dict['ks'])
+        self.totals = state_dict['totals'].clone()
+
+    def __len__(self):
+        return int(self.totals[0])
+
+    def result(self):
+        """Mean of every metric over the rows seen so far."""
+        means = (self.totals[1:] / max(1, len(self))).tolist()
+        names = ['Precision', 'Recall', 'F1'] + ['P@{}'.format(k) for k in self.ks]
+        return OrderedDict(zip(names, means))
@@ -0,0 +1,244 @@
+"""
+Ingest lectures : take every video of a course from the raw files to the inputs the datasets read.
+
+Each video goes through six stages, each run by its own worker processes :
+    keyframes : the I-frames of `videos/<video>.mp4`, see `key_frame_extraction.save_i_keyframes`.
+    images    : the near-duplicate-free keyframe selection, see `keyframe_dedup.dedup_video`.
+    features  : with `--cache_features`, the ResNet features of the kept keyframes, see `keyframe_dedup.cache_features`.
+    audio     : the MFCC features, see `audio_features.mfcc`.
+    text      : the processed transcript, see `preprocess_text.process_transcript`.
+    targets   : the alignment of the ground-truth summary with the processed transcript.
+The stages are connected by bounded queues, so a video is in its audio stage while the next one is
+being decoded, and a slow stage holds back the earlier ones instead of letting work pile up in memory.
+
+As soon as the last video of a course is through, while the videos of the next courses are still in the
+stages, the course-level files are written (`keyframes.json`, the packed sentence embeddings and, optionally,
+the packed keyframes), and the videos of the course that went through every
+stage are added to the catalog of videos read by the datasets (`datasets.final_indices_path`).
+"""
+import multiprocessing as mp
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from args import get_ingest_args
+from audio_features import AUDIO_FEATURES, get_audio_path, load_audio, mfcc
+from datasets import get_target_indices, load_keyframe_selection
+from key_frame_extraction import KEYFRAMES_MANIFEST, is_extracted, load_manifest, save_i_keyframes, save_manifest, video_signature
+from keyframe_dedup import cache_features, dedup_video, get_resnet_state, save_selection, weights_fingerprint
+from pack_keyframes import pack_course
+from preprocess_text import embed_course, get_model, get_vocab, process_transcript
+from text_normalization import get_stop_words, lemmatize, read_transcript
+
+STAGES = ('keyframes', 'images', 'features', 'audio', 'text', 'targets')
+
+def run_keyframes(item, settings):
+    output_name = os.path.join(item['course_path'], 'video_key_frames', item['video'])
+    # Extracted again when the video changed since, see `key_frame_extraction.main`
+    if settings['force'] or not is_extracted(settings['manifest'], settings['courses_dir'], item['video_path'], output_name):
+        os.makedirs(os.path.dirname(output_name), exist_ok=True)
+        count = save_i_keyframes(item['video_path'], output_name, settings['keyframes_only'])
+        # Recorded in the manifest by the main process, its only writer
+        item['manifest'] = (os.path.relpath(item['video_path'], settings['courses_dir']),
+                            {'signature': video_signature(item['video_path']), 'keyframes': count})
+    item['keyframes_dir'] = output_name
+
+def run_images(item, settings):
+    _, item['selection'] = dedup_video((item['video'], item['keyframes_dir'], settings['threshold'], settings['max_frames']))
+    if not item['selection']['frames']:
+        raise ValueError('no keyframes')
+
+# ResNet of the features stage, built once by each of its processes
+feature_encoder = {}
+
+def run_features(item, settings):
+    if settings['resnet_state'] is None:
+        return
+    if not feature_encoder:
+        import torch
+        from evaluate import get_eval_transform
+        from layers.encoding import ImageEmbedding
+        # Only the stage processes touch CUDA, which cannot be used in a process forked after its initialization
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        encoder = ImageEmbedding()
+        encoder.load_state_dict(settings['resnet_state'])
+        feature_encoder.update(encoder=encoder.to(device).eval(), transform=get_eval_transform(), device=device)
+    cache_features(item['course_path'], {item['video']: item['selection']}, feature_encoder['encoder'], settings['fingerprint'],
+                   feature_encoder['transform'], feature_encoder['device'])
+
+def run_audio(item, settings):
+    features_path = os.path.join(item['course_path'], AUDIO_FEATURES, item['video'] + '.pkl')
+    if settings['force'] or not os.path.exists(features_path):
+        os.makedirs(os.path.dirname(features_path), exist_ok=True)
+        samples = load_audio(get_audio_path(item['course_path'], item['video'], settings['audio_subdir']), settings['sample_rate'], settings['pcm_rate'])
+        features = mfcc(samples, settings['sample_rate'])
+        with open(features_path + '.tmp', 'wb') as f:
+            pickle.dump(features, f)
+        os.replace(features_path + '.tmp', features_path)
+
+def run_text(item, settings):
+    save_path = os.path.join(item['course_path'], 'processed_transcripts')
+    os.makedirs(save_path, exist_ok=True)
+    transcript = os.path.join(item['course_path'], 'transcripts', item['video'] + '.txt')
+    item['sentences'] = process_transcript(transcript, settings['words_set'], save_path)
+    if not item['sentences']:
+        raise ValueError('no sentences in ' + transcript)
+
+def run_targets(item, settings):
+    with open(os.path.join(item['course_path'], 'processed_transcripts', item['video'] + '.p'), 'rb') as f:
+        # The sentences of the packed store, see `preprocess_text.embed_course`
+        source_sentences = list(dict.fromkeys(sent for sent, _ in pickle.load(f)))
+    target_text = ' '.join(read_transcript(os.path.join(item['course_path'], 'ground-truth', item['video'] + '.txt')))
+    item['targets'] = len(get_target_indices(source_sentences, target_text, settings['words_set']))
+    if not item['targets']:
+        raise ValueError('no ground-truth sentence found in the transcript')
+
+STAGE_FUNCTIONS = {'keyframes': run_keyframes, 'images': run_images, 'features': run_features, 'audio': run_audio, 'text': run_text, 'targets': run_targets}
+
+def stage_worker(stage, settings, in_queue, out_queue):
+    """Run `stage` on the videos of `in_queue` until a None, passing them (with their error, if any) to `out_queue`."""
+    function = STAGE_FUNCTIONS[stage]
+    for item in iter(in_queue.get, None):
+        if 'error' not in item:
+            start = time.time()
+            try:
+                function(item, settings)
+            except Exception as e:
+                item['error'] = '{} stage : {}'.format(stage, e)
+            item['seconds'][stage] = time.time() - start
+        out_queue.put(item)
+
+def get_videos(course_path):
+    path = os.path.join(course_path, 'videos')
+    return sorted((fname[:-4] for fname in os.listdir(path) if fname.endswith('.mp4') and fname[:-4].isdigit()), key=int)
+
+def run_pipeline(items, settings, num_workers, queue_size=4):
+    """
+    Run `items` through the stages.
+
+    Args:
+        items (list) : The videos, as {'course', 'course_path', 'video', 'video_path'} dicts.
+        settings (dict) : Settings of the stage functions.
+        num_workers (dict) : Number of processes of every stage.
+        queue_size (int) : Capacity of the queues between the stages.
+
+    Yields:
+        item (dict) : Every video once through all the stages, in completion order, with an 'error' when a stage failed.
+    """
+    # Forked processes share the vocabulary with this process instead of unpickling a copy
+    context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else None)
+    queues = [context.Queue(queue_size) for _ in range(len(STAGES) + 1)]
+    workers = [[context.Process(target=stage_worker, args=(stage, settings, queues[k], queues[k + 1]), daemon=True)
+                for _ in range(max(1, num_workers[stage]))] for k, stage in enumerate(STAGES)]
+    for stage_workers in workers:
+        for worker in stage_workers:
+            worker.start()
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        # Stop every stage once the previous one is done
+        for k, stage_workers in enumerate(workers):
+            for _ in stage_workers:
+                queues[k].put(None)
+            for worker in stage_workers:
+                worker.join()
+        queues[-1].put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        for item in iter(queues[-1].get, None):
+            yield item
+    finally:
+        for stage_workers in workers:
+            for worker in stage_workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+def finalize_course(course_path, items, settings, model=None):
+    """Write the course-level outputs of the ingested videos of a course."""
+    selection = load_keyframe_selection(course_path) or {}
+    selection.update((item['video'], item['selection']) for item in items if 'selection' in item)
+    save_selection(course_path, selection, settings['threshold'], settings['max_frames'])
+    if model is not None and any('error' not in item for item in items):
+        embed_course(course_path, model)
+    if settings['pack_keyframes']:
+        pack_course(course_path, settings['keyframe_size'])
+
+def update_catalog(catalog_path, entries):
+    """Add 'course/video' entries to the catalog of videos read by the datasets."""
+    catalog = set()
+    if os.path.exists(catalog_path):
+        with open(catalog_path, 'rb') as f:
+            catalog = pickle.load(f)
+    catalog.update(entries)
+    with open(catalog_path + '.tmp', 'wb') as f:
+        pickle.dump(catalog, f)
+    os.replace(catalog_path + '.tmp', catalog_path)
+    return len(catalog)
+
+def main(args):
+    model = get_model(args.glove_path)
+    manifest_path = os.path.join(args.courses_dir, KEYFRAMES_MANIFEST)
+    settings = {'force': args.force, 'keyframes_only': args.keyframes_only, 'threshold': args.threshold, 'max_frames': args.max_frames,
+                'audio_subdir': args.audio_subdir, 'sample_rate': args.sample_rate, 'pcm_rate': args.pcm_rate,
+                'courses_dir': args.courses_dir, 'manifest': load_manifest(manifest_path), 'words_set': get_vocab(model), 'pack_keyframes': args.pack_keyframes, 'keyframe_size': args.keyframe_size}
+    # The ResNet weights are read once here and shared with the forked processes of the features stage
+    settings['resnet_state'] = get_resnet_state(args.load_path) if args.cache_features else None
+    settings['fingerprint'] = weights_fingerprint(settings['resnet_state']) if args.cache_features else None
+    num_workers = {'keyframes': args.keyframe_workers, 'images': args.image_workers, 'features': args.feature_workers, 'audio': args.audio_workers,
+                   'text': args.text_workers, 'targets': args.target_workers}
+
+    courses = args.courses or [fname for fname in os.listdir(args.courses_dir)
+                               if fname.isdigit() and os.path.isdir(os.path.join(args.courses_dir, fname, 'videos'))]
+    items = []
+    for course in sorted(courses, key=int):
+        course_path = os.path.join(args.courses_dir, course)
+        for video in get_videos(course_path):
+            items.append({'course': course, 'course_path': course_path, 'video': video, 'seconds': {},
+                          'video_path': os.path.join(course_path, 'videos', video + '.mp4')})
+    print('Ingesting {} videos of {} courses, {} processes per stage'.format(
+        len(items), len(courses), ', '.join('{} {}'.format(num_workers[stage], stage) for stage in STAGES)))
+
+    # Load the stop words and WordNet once, before the stage processes are forked
+    get_stop_words()
+    lemmatize('lectures')
+    start = time.time()
+    done = OrderedDict((course, []) for course in sorted(courses, key=int))
+    # Videos of every course still in the pipeline, the course is finalized when its last one is through
+    remaining = {course: sum(item['course'] == course for item in items) for course in done}
+    busy = dict.fromkeys(STAGES, 0.0)
+    entries = []
+    size = None
+    for count, item in enumerate(run_pipeline(items, settings, num_workers, args.queue_size), 1):
+        course = item['course']
+        done[course].append(item)
+        if 'manifest' in item:
+            key, entry = item.pop('manifest')
+            settings['manifest'][key] = entry
+            save_manifest(settings['manifest'], manifest_path)
+        for stage, seconds in item['seconds'].items():
+            busy[stage] += seconds
+        status = item['error'] if 'error' in item else '{} sentences, {} targets'.format(item['sentences'], item['targets'])
+        print('[{}/{}] {}/{} : {}'.format(count, len(items), course, item['video'], status))
+        remaining[course] -= 1
+        if remaining[course] == 0:
+            # While the later courses are still going through the stages
+            finalize_course(os.path.join(args.courses_dir, course), done[course], settings, model)
+            course_entries = ['{}/{}'.format(course, video_item['video']) for video_item in done[course] if 'error' not in video_item]
+            size = update_catalog(args.catalog, course_entries)
+            entries.extend(course_entries)
+            print('{} : finalized, {} of {} videos added to the catalog'.format(course, len(course_entries), len(done[course])))
+    if size is None:
+        size = update_catalog(args.catalog, [])
+
+    elapsed = time.time() - start
+    print('Ingested {} of {} videos in {:.1f}s ({:.1f} videos per minute), the catalog {} now has {} videos'.format(
+        len(entries), len(items), elapsed, 60 * len(items) / max(elapsed, 1e-9), args.catalog, size))
+    print('Busy time per stage : ' + ', '.join('{} {:.1f}s'.format(stage, busy[stage]) for stage in STAGES))
+
+if __name__ == '__main__':
+    main(get_ingest_args())
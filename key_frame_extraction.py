@@ -1,46 +1,156 @@
+import json
+import multiprocessing as mp
 import os
+import shutil
+import time
+
+import av
 import cv2
-import subprocess
-
-base_path = '/home/anish17281/NLP_Dataset/dataset/'
-
-def get_frame_types(video_fn):
-    command = 'ffprobe -v error -show_entries frame=pict_type -of default=noprint_wrappers=1'.split()
-    out = subprocess.check_output(command + [video_fn]).decode()
-    frame_types = out.replace('pict_type=','').split()
-    return zip(range(len(frame_types)), frame_types)
-
-def save_i_keyframes(video_fn, output_name):
-    frame_types = get_frame_types(video_fn)
-    i_frames = [x[0] for x in frame_types if x[1]=='I']
-    if i_frames:
-        basename = os.path.splitext(os.path.basename(video_fn))[0]
-        cap = cv2.VideoCapture(video_fn)
-        count_frame = 1
-        for frame_no in i_frames:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-            ret, frame = cap.read()
-            outname = output_name + basename + '_i_frame_' + str(count_frame) + '.jpg'
-            count_frame += 1
-            cv2.imwrite(outname, frame)
-            print ('Saved: '+outname)
-        cap.release()
+
+from args import get_keyframe_args
+
+# Record of the extracted videos, at the root of the dataset
+KEYFRAMES_MANIFEST = 'keyframes_manifest.json'
+
+# AV_PICTURE_TYPE_I of libavutil
+I_FRAME = 1
+
+def is_i_frame(frame):
+    # Older PyAV versions return a string ('I', 'P', ...), recent ones the libavutil picture type
+    return frame.pict_type in ('I', I_FRAME)
+
+def iter_i_frames(video_fn, keyframes_only=False):
+    """
+    Yield the I-frames of a video as BGR arrays, decoding the video once.
+
+    Args:
+        video_fn (str) : Path of the video.
+        keyframes_only (bool) : Let the decoder skip every non-key frame instead of decoding all of them and
+                                keeping the I-frames. Much faster, but I-frames that are not keyframes
+                                (open GOPs) are missed.
+    """
+    with av.open(video_fn) as container:
+        stream = container.streams.video[0]
+        if keyframes_only:
+            stream.codec_context.skip_frame = 'NONKEY'
+        for frame in container.decode(stream):
+            if keyframes_only or is_i_frame(frame):
+                yield frame.to_ndarray(format='bgr24')
+
+def save_i_keyframes(video_fn, output_name, keyframes_only=False):
+    """
+    Save the I-frames of a video as `<output_name>/<video>_i_frame_<n>.jpg`, n starting at 1.
+    The frames are written to a temporary directory which then replaces `output_name`, so that an
+    interrupted extraction never leaves a partial set of keyframes behind.
+
+    Returns:
+        count (int) : Number of saved keyframes.
+    """
+    basename = os.path.splitext(os.path.basename(video_fn))[0]
+    output_name = output_name.rstrip('/')
+    # Outside video_key_frames/, whose sub-directories must all be video ids
+    tmp_name = os.path.join(os.path.dirname(os.path.dirname(output_name)), '.keyframes_tmp_' + os.path.basename(output_name))
+    shutil.rmtree(tmp_name, ignore_errors=True)
+    os.makedirs(tmp_name)
+
+    count = 0
+    for frame in iter_i_frames(video_fn, keyframes_only):
+        count += 1
+        cv2.imwrite(os.path.join(tmp_name, basename + '_i_frame_' + str(count) + '.jpg'), frame)
+    if count == 0:
+        print('No I-frames in ' + video_fn)
+
+    shutil.rmtree(output_name, ignore_errors=True)
+    os.replace(tmp_name, output_name)
+    return count
+
+def get_videos(base_path):
+    """The (video, keyframe directory) pairs of every course of the dataset, in course and video order."""
+    videos = []
+    courses = [fname for fname in os.listdir(base_path) if fname.isdigit() and os.path.isdir(os.path.join(base_path, fname, 'videos'))]
+    for course in sorted(courses, key=int):
+        path = os.path.join(base_path, course, 'videos')
+        files = [item for item in os.listdir(path) if os.path.isfile(os.path.join(path, item)) and ('.mp4' in item and '_' not in item)]
+        for fname in sorted(files):
+            videos.append((os.path.join(path, fname), os.path.join(base_path, course, 'video_key_frames', fname[:-4])))
+    return videos
+
+def video_signature(video_fn):
+    # Size and modification time, hashing whole videos would cost as much as decoding them
+    stat = os.stat(video_fn)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def is_extracted(manifest, base_path, video_fn, output_name):
+    """Whether the manifest records the keyframes of `output_name` as extracted from the current `video_fn`."""
+    entry = manifest.get(os.path.relpath(video_fn, base_path))
+    return entry is not None and entry['signature'] == video_signature(video_fn) and os.path.isdir(output_name)
+
+def save_manifest(manifest, manifest_path):
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def extract_video(task):
+    """Pool worker : extract the keyframes of one video, returns (task, number of keyframes or None on failure)."""
+    video_fn, output_name, keyframes_only = task
+    try:
+        return task, save_i_keyframes(video_fn, output_name, keyframes_only)
+    except Exception as e:
+        print('Unable to extract keyframes from {}. Exception: {}'.format(video_fn, e))
+        return task, None
+
+def main(base_path, num_workers=1, keyframes_only=False, force=False, manifest_name=KEYFRAMES_MANIFEST):
+    """
+    Extract the keyframes of every video of the dataset with a pool of `num_workers` processes.
+
+    Finished videos are recorded in a manifest at the root of the dataset (with the size and modification
+    time of the video), and skipped by later runs unless the video changed or `force` is set, so an
+    interrupted extraction resumes where it stopped.
+    """
+    manifest_path = os.path.join(base_path, manifest_name)
+    manifest = {} if force else load_manifest(manifest_path)
+
+    videos = get_videos(base_path)
+    tasks = []
+    for video_fn, output_name in videos:
+        if is_extracted(manifest, base_path, video_fn, output_name):
+            continue
+        os.makedirs(os.path.dirname(output_name), exist_ok=True)
+        tasks.append((video_fn, output_name, keyframes_only))
+    print('Extracting keyframes of {} of {} videos'.format(len(tasks), len(videos)))
+
+    if num_workers > 1 and len(tasks) > 1:
+        pool = mp.Pool(num_workers)
+        results = pool.imap_unordered(extract_video, tasks)
     else:
-        print ('No I-frames in '+video_fn)
-
-def get_frames(cname):
-    path = cname + "videos/"
-    files = [item for item in os.listdir(path) if os.path.isfile(os.path.join(path, item)) and ('.mp4' in item and '_' not in item)]
-    for fname in files:
-        output_name = cname + 'video_key_frames/' + fname[:-4] + '/'
-        if not os.path.exists(output_name):
-            os.system('mkdir ' + output_name)
-        save_i_keyframes(path + fname, output_name)
-        
+        pool = None
+        results = map(extract_video, tasks)
+
+    start = time.time()
+    num_frames = 0
+    try:
+        for done, ((video_fn, output_name, _), count) in enumerate(results, 1):
+            if count is None:
+                continue
+            num_frames += count
+            manifest[os.path.relpath(video_fn, base_path)] = {'signature': video_signature(video_fn), 'keyframes': count}
+            save_manifest(manifest, manifest_path)
+            elapsed = time.time() - start
+            print('[{}/{}] Saved {} keyframes of {} ({:.1f} videos per minute)'.format(done, len(tasks), count, video_fn, 60 * done / elapsed))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    elapsed = time.time() - start
+    print('Extracted {} keyframes from {} videos in {:.1f}s ({:.1f} videos per minute)'.format(
+        num_frames, len(tasks), elapsed, 60 * len(tasks) / max(elapsed, 1e-9)))
+
 if __name__ == '__main__':
-    num_courses = 25
-    for idx in range(1, num_courses):
-        cname = base_path + str(idx) + '/'
-        if not os.path.exists(os.path.join(cname, 'video_key_frames')):
-            os.system('mkdir ' + cname + 'video_key_frames/')
-        get_frames(cname)
+    args = get_keyframe_args()
+    main(args.courses_dir, args.num_workers, args.keyframes_only, args.force)
@@ -0,0 +1,200 @@
+"""
+Drop the near-duplicate keyframes of every video and cache the ResNet features of the remaining ones.
+
+Lecture videos are mostly static slides, so many I-frames of a video show the same slide. Every keyframe
+gets a 64-bit difference hash (dHash) of its downscaled grayscale image. A keyframe is dropped when its
+hash is within `threshold` bits of a keyframe already kept for the video, then at most `max_frames`
+keyframes, evenly spread over the video, are kept. The selection of a course is written to
+`<course>/keyframes.json`, which `ImageDataset` reads instead of listing `video_key_frames/`.
+
+With `--cache_features`, the ResNet-101 features of the kept keyframes are computed with the evaluation
+transform and saved as `<course>/keyframe_features/<weights>/<sha1 of the keyframe>.npy`. The cache is
+content-addressed, so a keyframe repeated across the videos of a course is embedded once, and never again
+by later runs. `<weights>` is a fingerprint of the ResNet weights : the batch norm statistics of a trained
+checkpoint's ResNet differ from the ImageNet ones, and so do its features.
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from args import get_dedup_args
+from datasets import KEYFRAME_FEATURES, KEYFRAME_SELECTION, get_keyframe_num
+
+# Approximate cost of a ResNet-101 forward pass on one 256x256 image (7.8 GFLOPs at 224x224)
+RESNET_GFLOPS = 7.8 * (256 / 224) ** 2
+
+def dhash(image_path, hash_size=8):
+    """The difference hash of an image : whether each pixel of a (hash_size, hash_size + 1) grayscale thumbnail is brighter than its left neighbour."""
+    # Let the JPEG decoder downscale by 4, the hash only looks at a thumbnail
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None:
+        raise ValueError('Unable to read ' + image_path)
+    thumbnail = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+def select_keyframes(hashes, threshold=5, max_frames=None):
+    """
+    Pick the keyframes of a video to keep.
+
+    Args:
+        hashes (list) : The dHash of every keyframe, in order.
+        threshold (int) : Keyframes within this Hamming distance of a kept one are near-duplicates.
+        max_frames (int) : Maximum number of keyframes to keep, None for no limit.
+
+    Returns:
+        kept (list) : Positions of the kept keyframes, in order.
+        num_duplicates (int) : Number of keyframes dropped as near-duplicates (the others are over the budget).
+    """
+    kept = []
+    for position, frame_hash in enumerate(hashes):
+        if all(hamming(frame_hash, hashes[other]) > threshold for other in kept):
+            kept.append(position)
+    num_duplicates = len(hashes) - len(kept)
+    if max_frames is not None and len(kept) > max_frames:
+        kept = [kept[k] for k in np.linspace(0, len(kept) - 1, max_frames).round().astype(int)]
+    return kept, num_duplicates
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def dedup_video(task):
+    """Pool worker : select the keyframes of one video directory."""
+    video, video_dir, threshold, max_frames = task
+    frames = sorted((fname for fname in os.listdir(video_dir) if os.path.isfile(os.path.join(video_dir, fname))), key=get_keyframe_num)
+    kept, num_duplicates = select_keyframes([dhash(os.path.join(video_dir, fname)) for fname in frames], threshold, max_frames)
+    return video, {'frames': [frames[k] for k in kept],
+                   'content': [file_sha1(os.path.join(video_dir, frames[k])) for k in kept],
+                   'num_keyframes': len(frames),
+                   'num_duplicates': num_duplicates}
+
+def dedup_course(course_path, threshold=5, max_frames=None, pool=None):
+    """
+    Select the keyframes of every video of a course and write the selection to `<course>/keyframes.json`.
+
+    Returns:
+        videos (dict) : {video: {'frames', 'content', 'num_keyframes', 'num_duplicates'}}.
+    """
+    keyframes_path = os.path.join(course_path, 'video_key_frames')
+    tasks = [(video, os.path.join(keyframes_path, video), threshold, max_frames)
+             for video in sorted(os.listdir(keyframes_path), key=int)]
+    results = pool.imap(dedup_video, tasks) if pool is not None else map(dedup_video, tasks)
+    videos = dict(results)
+    save_selection(course_path, videos, threshold, max_frames)
+    return videos
+
+def save_selection(course_path, videos, threshold, max_frames):
+    selection = {'threshold': threshold, 'max_frames': max_frames, 'videos': videos}
+    selection_path = os.path.join(course_path, KEYFRAME_SELECTION)
+    with open(selection_path + '.tmp', 'w') as f:
+        json.dump(selection, f)
+    os.replace(selection_path + '.tmp', selection_path)
+
+def get_resnet_state(load_path=None):
+    """The state dict of the ResNet-101 of a checkpoint, or of the ImageNet one when `load_path` is None."""
+    if load_path is None:
+        from layers.encoding import ImageEmbedding
+        return ImageEmbedding().state_dict()
+    model_state = torch.load(load_path, map_location='cpu')['model_state']
+    prefix = 'image_keyframes_emb.'
+    # The keys of a DataParallel checkpoint start with 'module.'
+    return {key[key.index(prefix) + len(prefix):]: value for key, value in model_state.items() if prefix in key}
+
+def weights_fingerprint(state_dict):
+    """A short hash of the ResNet weights (parameters and batch norm statistics), naming their feature cache."""
+    digest = hashlib.sha1()
+    for key in sorted(state_dict):
+        digest.update(key.encode())
+        digest.update(state_dict[key].detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+def cache_features(course_path, videos, encoder, fingerprint, transform, device, batch_size=32):
+    """
+    Embed the kept keyframes of a course missing from its feature cache, each distinct keyframe once.
+
+    Returns:
+        num_embedded (int) : Number of keyframes embedded by this call.
+    """
+    features_dir = os.path.join(course_path, KEYFRAME_FEATURES, fingerprint)
+    os.makedirs(features_dir, exist_ok=True)
+    # One keyframe per distinct content
+    todo = {}
+    for video, entry in sorted(videos.items(), key=lambda item: int(item[0])):
+        for fname, content in zip(entry['frames'], entry['content']):
+            if content not in todo and not os.path.exists(os.path.join(features_dir, content + '.npy')):
+                todo[content] = os.path.join(course_path, 'video_key_frames', video, fname)
+
+    todo = list(todo.items())
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        images = torch.stack([transform(Image.open(path)) for _, path in batch]).to(device)
+        with torch.no_grad():
+            features = encoder(images).cpu().numpy()
+        for (content, _), feature in zip(batch, features):
+            feature_path = os.path.join(features_dir, content + '.npy')
+            # Per process, the ingestion pipeline may embed the same keyframe in two processes at once
+            tmp_path = '{}.{}.tmp'.format(feature_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, feature)
+            os.replace(tmp_path, feature_path)
+    return len(todo)
+
+def get_courses(courses_dir):
+    courses = [fname for fname in os.listdir(courses_dir) if fname.isdigit() and os.path.isdir(os.path.join(courses_dir, fname, 'video_key_frames'))]
+    return [os.path.join(courses_dir, course) for course in sorted(courses, key=int)]
+
+def main(args):
+    courses = get_courses(args.courses_dir)
+    encoder = None
+    if args.cache_features:
+        from evaluate import get_eval_transform
+        from layers.encoding import ImageEmbedding
+        state_dict = get_resnet_state(args.load_path)
+        fingerprint = weights_fingerprint(state_dict)
+        encoder = ImageEmbedding()
+        encoder.load_state_dict(state_dict)
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        encoder = encoder.to(device).eval()
+        transform = get_eval_transform()
+        print('Caching the ResNet features of weights {}'.format(fingerprint))
+
+    num_keyframes = num_kept = num_duplicates = num_distinct = num_embedded = 0
+    pool = mp.Pool(args.num_workers) if args.num_workers > 1 else None
+    try:
+        for course_path in courses:
+            videos = dedup_course(course_path, args.threshold, args.max_frames, pool)
+            course_keyframes = sum(entry['num_keyframes'] for entry in videos.values())
+            course_kept = sum(len(entry['frames']) for entry in videos.values())
+            num_keyframes += course_keyframes
+            num_kept += course_kept
+            num_duplicates += sum(entry['num_duplicates'] for entry in videos.values())
+            num_distinct += len(set(content for entry in videos.values() for content in entry['content']))
+            if encoder is not None:
+                num_embedded += cache_features(course_path, videos, encoder, fingerprint, transform, device, args.batch_size)
+            print('{} : kept {} of {} keyframes'.format(course_path, course_kept, course_keyframes))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    num_removed = num_keyframes - num_kept
+    print('Kept {} of {} keyframes : {} near-duplicates and {} over the budget of {} per video removed'.format(
+        num_kept, num_keyframes, num_duplicates, num_removed - num_duplicates, args.max_frames))
+    print('ResNet forward passes per pass over the dataset : {} -> {} ({:.1f}% and {:.0f} GFLOPs saved)'.format(
+        num_keyframes, num_kept, 100 * num_removed / max(1, num_keyframes), num_removed * RESNET_GFLOPS))
+    if encoder is not None:
+        print('Feature cache : {} distinct keyframes, {} embedded now, {} repeated keyframes embedded once'.format(
+            num_distinct, num_embedded, num_kept - num_distinct))
+
+if __name__ == '__main__':
+    main(get_dedup_args())
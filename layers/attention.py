@@ -6,6 +6,8 @@ import torch.nn.functional as F
 
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
+from profiling import stage
+
 class BiDAFAttention(nn.Module):
     """
     Bidirectional attention computes attention in two directions:
@@ -74,6 +76,13 @@ class BiDAFAttention(nn.Module):
 
         return s
 
+    def get_flops(self, text, modality, text_mask, modality_mask):
+        """Estimate of the FLOPs of the matrix products of `forward`, see profiling.py."""
+        batch_size, text_length, hidden_size = text.size()
+        modality_length = modality.size(1)
+        # Similarity matrix and text-to-modality attention, then the modality-to-text attention through the text
+        return 2 * batch_size * text_length * (2 * modality_length * hidden_size + text_length * modality_length + text_length * hidden_size)
+
 
 def masked_softmax(logits, mask, dim=-1, log_softmax=False):
     """Take the softmax of `logits` over given dimension, and set
@@ -141,46 +150,57 @@ class MultimodalAttentionDecoder(nn.Module):
         self.lstm = nn.LSTM(self.text_embedding_size + 2*self.hidden_size, self.hidden_size, self.num_layers, batch_first=True)
         self.out = nn.Linear(self.hidden_size, self.output_size)
         self.softmax = nn.Softmax()
-
-    def forward(self, sent_embed, decoder_hidden, decoder_cell_state, text_audio_enc_out, text_img_enc_out, coverage_vec, mask): # sent_embed : (batch, 1, text_embedding_size); decoder_hidden (batch, num_dir * num_layers, hidden_size)
-        # For the text-audio attention
-        e1 = self.v1(self.tanh(self.W1(text_audio_enc_out) + self.W2(decoder_hidden) + self.Wc1(coverage_vec))) # (batch, max_seq_len, 1)
-        att_weights_1 = F.softmax(e1, dim=1)        # (batch, max_seq_len, 1)
-        c1 = att_weights_1 * text_audio_enc_out     # (batch, max_seq_len, 2 * hidden_size)
-        c1 = torch.sum(c1, dim=1)                   # (batch, 2 * hidden_size)
-
-        # For the text-image attention
-        e2 = self.v2(self.tanh(self.W3(text_img_enc_out) + self.W4(decoder_hidden) + self.Wc2(coverage_vec)))
-        att_weights_2 = F.softmax(e2, dim=1)
-        c2 = att_weights_2 * text_img_enc_out
-        c2 = torch.sum(c2, dim=1)       # (batch, 2 * hidden_size)
-
-        # For the multimodal attention
-        # e3 = self.v3(self.tanh(self.W5(c1) + self.W2(c2)))      # (batch, 1)
-        # c3 = e3 * c1 + e3 * c2              # (batch, 2 * hidden_size)
-        e_beta_1 = self.v_beta_1(self.tanh(self.W_beta_1(c1.unsqueeze(1)) + self.W_beta_2(decoder_hidden)))  # (batch, num_dir*num_layers, 1)
-        e_beta_2 = self.v_beta_2(self.tanh(self.W_beta_3(c2.unsqueeze(1)) + self.W_beta_4(decoder_hidden)))  # (batch, num_dir*num_layers, 1)
-        e_beta = torch.cat((e_beta_1, e_beta_2), dim=1)         # (batch, 2, 1)
-        att_beta = F.softmax(e_beta, dim=1)                     # (batch, 2, 1)
-        c3 = torch.stack((c1, c2), dim=1) * att_beta            # (batch, 2, 2 * hidden_size)
-        c3 = torch.sum(c3, dim=1)                               # (batch, 2 * hidden_size)
-        att_cov_dist = torch.bmm(torch.cat((att_weights_1, att_weights_2), dim=2), att_beta)            # (batch, max_seq_len, 1)
-        # beta_1 = e_beta_1 * c1          # (batch, num_dir*num_layers, 2 * hidden_size)
-        # beta_1 = torch.sum(beta_1, dim=1)       # (batch, 2 * hidden_size)
-
-        # e_beta_2 = self.v_beta_2(self.tanh(self.W_beta_3(c2.unsqueeze(1)) + self.W_beta_4(decoder_hidden)))  # (batch, num_dir*num_layers, 1)
-        # beta_2 = e_beta_2 * c2          # (batch, num_layers*num_dir, 2 * hidden_size)
-        # beta_2 = torch.sum(beta_2, dim=1)   # (batch, 2 * hidden_size)
-
-        # c3 = beta_1*c1 + beta_2*c2            # (batch, 2 * hidden_size)
-        # att_cov_dist = e_beta_1*att_weights_1 + e_beta_2*att_weights_2          # (batch, max_seq_len, 1)
-        coverage_vec = coverage_vec + att_cov_dist          # (batch, max_seq_len, 1)
+        self.profiler = None            # Set by MMBiDAF.set_profiler
+
+    def forward(self, sent_embed, decoder_hidden, decoder_cell_state, text_audio_enc_out, text_img_enc_out, coverage_vec, mask, candidates=None): # sent_embed : (batch, 1, text_embedding_size); decoder_hidden (batch, num_dir * num_layers, hidden_size)
+        # With `candidates` (batch, num_candidates), the encodings, coverage vector and mask are those of the candidate sentences only,
+        # and the output distribution is over the candidates
+        with stage(self.profiler, 'decoder/attention'):
+            # For the text-audio attention
+            e1 = self.v1(self.tanh(self.W1(text_audio_enc_out) + self.W2(decoder_hidden) + self.Wc1(coverage_vec))) # (batch, max_seq_len, 1)
+            att_weights_1 = F.softmax(e1, dim=1)        # (batch, max_seq_len, 1)
+            c1 = att_weights_1 * text_audio_enc_out     # (batch, max_seq_len, 2 * hidden_size)
+            c1 = torch.sum(c1, dim=1)                   # (batch, 2 * hidden_size)
+
+            # For the text-image attention
+            e2 = self.v2(self.tanh(self.W3(text_img_enc_out) + self.W4(decoder_hidden) + self.Wc2(coverage_vec)))
+            att_weights_2 = F.softmax(e2, dim=1)
+            c2 = att_weights_2 * text_img_enc_out
+            c2 = torch.sum(c2, dim=1)       # (batch, 2 * hidden_size)
+
+            # For the multimodal attention
+            # e3 = self.v3(self.tanh(self.W5(c1) + self.W2(c2)))      # (batch, 1)
+            # c3 = e3 * c1 + e3 * c2              # (batch, 2 * hidden_size)
+            e_beta_1 = self.v_beta_1(self.tanh(self.W_beta_1(c1.unsqueeze(1)) + self.W_beta_2(decoder_hidden)))  # (batch, num_dir*num_layers, 1)
+            e_beta_2 = self.v_beta_2(self.tanh(self.W_beta_3(c2.unsqueeze(1)) + self.W_beta_4(decoder_hidden)))  # (batch, num_dir*num_layers, 1)
+            e_beta = torch.cat((e_beta_1, e_beta_2), dim=1)         # (batch, 2, 1)
+            att_beta = F.softmax(e_beta, dim=1)                     # (batch, 2, 1)
+            c3 = torch.stack((c1, c2), dim=1) * att_beta            # (batch, 2, 2 * hidden_size)
+            c3 = torch.sum(c3, dim=1)                               # (batch, 2 * hidden_size)
+            att_cov_dist = torch.bmm(torch.cat((att_weights_1, att_weights_2), dim=2), att_beta)            # (batch, max_seq_len, 1)
+            # beta_1 = e_beta_1 * c1          # (batch, num_dir*num_layers, 2 * hidden_size)
+            # beta_1 = torch.sum(beta_1, dim=1)       # (batch, 2 * hidden_size)
+
+            # e_beta_2 = self.v_beta_2(self.tanh(self.W_beta_3(c2.unsqueeze(1)) + self.W_beta_4(decoder_hidden)))  # (batch, num_dir*num_layers, 1)
+            # beta_2 = e_beta_2 * c2          # (batch, num_layers*num_dir, 2 * hidden_size)
+            # beta_2 = torch.sum(beta_2, dim=1)   # (batch, 2 * hidden_size)
+
+            # c3 = beta_1*c1 + beta_2*c2            # (batch, 2 * hidden_size)
+            # att_cov_dist = e_beta_1*att_weights_1 + e_beta_2*att_weights_2          # (batch, max_seq_len, 1)
+            coverage_vec = coverage_vec + att_cov_dist          # (batch, max_seq_len, 1)
         
-        cat_input = torch.cat((c3.unsqueeze(1), sent_embed), dim=2)        # (batch, 1, 2*hidden_size + text_embedding_size)
-
-        decoder_out, (decoder_hidden, decoder_cell_state) = self.lstm(cat_input, (decoder_hidden.transpose(0,1), decoder_cell_state))                       # (batch, 1, hidden_size)
-        decoder_out = decoder_out.view(-1, decoder_out.size(-1))    # (batch*1, hidden_size)
-
-        final_out = masked_softmax(self.out(decoder_out), mask)       # (batch, max_transcript_len) # TODO use masked softmax
+            cat_input = torch.cat((c3.unsqueeze(1), sent_embed), dim=2)        # (batch, 1, 2*hidden_size + text_embedding_size)
+
+        with stage(self.profiler, 'decoder/lstm'):
+            decoder_out, (decoder_hidden, decoder_cell_state) = self.lstm(cat_input, (decoder_hidden.transpose(0,1), decoder_cell_state))                   # (batch, 1, hidden_size)
+            decoder_out = decoder_out.view(-1, decoder_out.size(-1))    # (batch*1, hidden_size)
+
+        with stage(self.profiler, 'decoder/output'):
+            if candidates is None:
+                out = self.out(decoder_out)                             # (batch, max_transcript_len)
+            else:
+                # Only the output units of the candidate sentences
+                out = torch.bmm(self.out.weight[candidates], decoder_out.unsqueeze(2)).squeeze(2) + self.out.bias[candidates]    # (batch, num_candidates)
+            final_out = masked_softmax(out, mask)       # (batch, max_transcript_len) # TODO use masked softmax
 
         return final_out, decoder_hidden.transpose(0,1), decoder_cell_state, att_cov_dist, coverage_vec
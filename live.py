@@ -0,0 +1,236 @@
+"""
+Summarize a lecture while it is being given : its sentences, audio frames and keyframes arrive in chunks and
+the summary is updated after every chunk.
+
+`MMBiDAF.summarize` encodes a whole lecture with bidirectional LSTMs, so summarizing after every chunk that way
+costs more and more as the lecture goes on. `LiveSummarizer` keeps the encodings of what it has already seen
+instead. A chunk is encoded together with the `lookback` latest items of its modality, whose cached encodings
+it replaces (older encodings are final, they no longer see what comes after them). The new and lookback
+sentences attend to the latest `memory` encoded audio frames and keyframes and go through the modeling LSTMs,
+and the summary is decoded from the cached modeled encodings of the sentences. The encoding work of an update
+thus depends on the size of the chunk and on the lookbacks and memories, not on the length of the lecture. The
+decoding work grows with the number of sentences the decoder attends over, until `decoder_memory` of them (by
+default the 408 sentences of the decoder output) : the latency of an update ramps up over the first
+`decoder_memory` sentences of a lecture and stays flat afterwards, and only the latest `decoder_memory`
+sentences can be selected.
+
+Run as a script, it replays a video of the catalog chunk by chunk and reports the latency of every update :
+
+    python live.py --load_path <checkpoint_path> --video <course>/<video> --chunk_sentences 10 --compare
+"""
+import time
+from collections import OrderedDict
+from json import dumps
+
+import numpy as np
+import torch
+
+import util
+from args import get_live_args
+from summarize import get_datasets, load_summarizer, load_video, select_videos
+
+class LiveSummarizer:
+    """
+    The encoder state of a lecture received in chunks, and its summary.
+
+    Args:
+        model (MMBiDAF) : The model, in evaluation mode.
+        text_lookback (int) : Number of the latest sentences encoded again with every chunk.
+        audio_lookback (int) : Number of the latest audio frames encoded again with every chunk of audio.
+        image_lookback (int) : Number of the latest keyframes encoded again with every chunk of keyframes.
+        audio_memory (int) : Number of the latest audio frames the sentences attend to.
+        image_memory (int) : Number of the latest keyframes the sentences attend to.
+        decoder_memory (int) : Number of the latest sentences the decoder attends over and selects from, at most (and by default)
+                               max_transcript_length - 1.
+        max_sentences (int) : Maximum number of sentences of the summary.
+        beam_size (int) : Number of hypotheses of the beam search, 1 for greedy decoding.
+    """
+    def __init__(self, model, text_lookback=8, audio_lookback=256, image_lookback=2, audio_memory=2048, image_memory=16, decoder_memory=None,
+                 max_sentences=30, beam_size=1):
+        if audio_memory < audio_lookback or image_memory < image_lookback:
+            raise ValueError('The memories must hold at least the lookbacks')
+        self.model = model
+        self.device = model.device
+        self.text_lookback, self.audio_lookback, self.image_lookback = text_lookback, audio_lookback, image_lookback
+        self.audio_memory, self.image_memory = audio_memory, image_memory
+        self.max_sentences, self.beam_size = max_sentences, beam_size
+        # The decoder output holds max_transcript_length sentences, the last one is the EOS
+        self.capacity = model.max_transcript_length - 1 if decoder_memory is None else min(decoder_memory, model.max_transcript_length - 1)
+        encoded_size = 2 * model.multimodal_att_decoder.hidden_size
+
+        self.eos = torch.zeros(1, 300, device=self.device) - 1                      # End of summary token embedding, as TextDataset
+        self.offset = 0                                                             # Position in the lecture of the first kept sentence
+        self.sentences = []
+        self.text = torch.zeros(0, 300, device=self.device)                         # (num_sentences, 300) embeddings of the kept sentences
+        self.mod_text_audio = torch.zeros(0, encoded_size, device=self.device)      # (num_sentences, 2 * hidden_size)
+        self.mod_text_image = torch.zeros(0, encoded_size, device=self.device)
+        self.eos_encoded = None                                                     # Modeled encodings of the EOS, for the audio and the images
+        self.modeling_hidden = None                                                 # Final hidden states of the modeling LSTMs
+        self.audio = torch.zeros(0, 128, device=self.device)                        # The audio_lookback latest frames
+        self.audio_encoded = torch.zeros(0, encoded_size, device=self.device)       # The audio_memory latest encoded frames
+        self.images = torch.zeros(0, 1000, device=self.device)                      # ResNet features of the image_lookback latest keyframes
+        self.image_encoded = torch.zeros(0, encoded_size, device=self.device)
+
+    @property
+    def num_sentences(self):
+        """Number of sentences received so far."""
+        return self.offset + len(self.sentences)
+
+    def extend(self, inputs, encoded, new_inputs, embedding, encoder, lookback, memory):
+        """
+        Encode new frames of a modality after the `lookback` latest ones and replace the encodings of those.
+
+        Returns:
+            inputs (torch.Tensor) : The lookback latest frames.
+            encoded (torch.Tensor) : The memory latest encodings.
+        """
+        num_lookback = min(lookback, inputs.size(0))
+        window = torch.cat((inputs[inputs.size(0) - num_lookback:], new_inputs))
+        window_encoded, _ = encoder(embedding(window.unsqueeze(0)), [window.size(0)])          # (1, window_length, 2 * hidden_size)
+        encoded = torch.cat((encoded[:encoded.size(0) - num_lookback], window_encoded[0]))
+        return window[max(0, window.size(0) - lookback):], encoded[max(0, encoded.size(0) - memory):]
+
+    def attend(self, bidaf_att, mod_enc, text_encoded, modality_encoded):
+        """BiDAF attention of the window sentences over the memory of a modality, followed by the modeling LSTM."""
+        if not modality_encoded.size(0):
+            # Nothing received yet for this modality
+            modality_encoded = torch.zeros(1, text_encoded.size(-1), device=self.device)
+        text_mask = torch.ones(1, text_encoded.size(1), dtype=torch.bool, device=self.device)
+        modality_mask = torch.ones(1, modality_encoded.size(0), dtype=torch.bool, device=self.device)
+        return self.model.attend_and_model(bidaf_att, mod_enc, text_encoded, modality_encoded.unsqueeze(0), text_mask, modality_mask, [text_encoded.size(1)])
+
+    def update(self, embeddings=None, sentences=None, audio=None, images=None):
+        """
+        Add a chunk of the lecture. Any of its modalities may be missing.
+
+        Args:
+            embeddings (torch.Tensor) : (num_sentences, 300) embeddings of the new sentences.
+            sentences (list) : The new sentences.
+            audio (torch.Tensor) : (num_frames, 128) new MFCC frames.
+            images (torch.Tensor) : (num_keyframes, 1000) ResNet features or (num_keyframes, 3, 256, 256) transformed new keyframes.
+        """
+        model = self.model
+        with torch.no_grad():
+            if audio is not None and len(audio):
+                self.audio, self.audio_encoded = self.extend(self.audio, self.audio_encoded, audio.to(self.device), model.a_emb, model.audio_enc,
+                                                             self.audio_lookback, self.audio_memory)
+            if images is not None and len(images):
+                images = images.to(self.device)
+                if images.dim() == 4:
+                    images = model.image_keyframes_emb(images)                              # (num_keyframes, encoded_image_size=1000)
+                self.images, self.image_encoded = self.extend(self.images, self.image_encoded, images, model.i_emb, model.image_enc,
+                                                              self.image_lookback, self.image_memory)
+
+            new_text = torch.zeros(0, 300, device=self.device) if embeddings is None else embeddings.to(self.device)
+            if not len(new_text) and not len(self.sentences):
+                return
+            # The lookback sentences are modeled again with the new ones (and the new audio and keyframes), followed by the EOS
+            num_lookback = min(self.text_lookback, len(self.sentences))
+            window = torch.cat((self.text[self.text.size(0) - num_lookback:], new_text, self.eos))
+            text_encoded, _ = model.text_enc(model.emb(window.unsqueeze(0)), [window.size(0)])   # (1, window_length, 2 * hidden_size)
+            mod_text_audio, text_audio_hidden = self.attend(model.bidaf_att_audio, model.mod_t_a, text_encoded, self.audio_encoded)
+            mod_text_image, text_img_hidden = self.attend(model.bidaf_att_image, model.mod_t_i, text_encoded, self.image_encoded)
+
+        kept = len(self.sentences) - num_lookback
+        self.text = torch.cat((self.text, new_text))
+        self.sentences.extend(sentences if sentences is not None else [None] * len(new_text))
+        self.mod_text_audio = torch.cat((self.mod_text_audio[:kept], mod_text_audio[0, :-1]))
+        self.mod_text_image = torch.cat((self.mod_text_image[:kept], mod_text_image[0, :-1]))
+        self.eos_encoded = (mod_text_audio[0, -1:], mod_text_image[0, -1:])
+        self.modeling_hidden = (text_audio_hidden, text_img_hidden)
+
+        # Forget the oldest sentences beyond the decoder memory
+        excess = len(self.sentences) - self.capacity
+        if excess > 0:
+            self.offset += excess
+            self.sentences = self.sentences[excess:]
+            self.text, self.mod_text_audio, self.mod_text_image = self.text[excess:], self.mod_text_audio[excess:], self.mod_text_image[excess:]
+
+    def summarize(self):
+        """
+        Decode the summary of the kept sentences.
+
+        Returns:
+            summary (OrderedDict) : The positions in the lecture and the text of the selected sentences, and the log-probability of the summary.
+        """
+        if not self.sentences:
+            return OrderedDict([('indices', []), ('sentences', []), ('log_prob', 0.0)])
+        text = torch.cat((self.text, self.eos)).unsqueeze(0)                                    # (1, num_sentences + 1, 300)
+        text_mask = torch.ones(1, text.size(1), dtype=torch.bool, device=self.device)
+        with torch.no_grad():
+            decoder_state, decoder_mask = self.model.init_decoder(*self.modeling_hidden, text_mask, text.size(-1))
+            decoder_context = (torch.cat((self.mod_text_audio, self.eos_encoded[0])).unsqueeze(0),
+                               torch.cat((self.mod_text_image, self.eos_encoded[1])).unsqueeze(0), decoder_mask)
+            [(indices, log_prob)] = self.model.decode(decoder_state, decoder_context, text, [text.size(1)], self.max_sentences, self.beam_size)
+        return OrderedDict([('indices', [self.offset + k for k in indices]), ('sentences', [self.sentences[k] for k in indices]), ('log_prob', log_prob)])
+
+def get_chunks(sentences, text, audio, images, chunk_sentences):
+    """Split a lecture into chunks of `chunk_sentences` sentences, with the audio frames and keyframes of the same share of the lecture."""
+    num_chunks = max(1, -(-len(sentences) // chunk_sentences))
+    bounds = lambda length: np.linspace(0, length, num_chunks + 1).round().astype(int)
+    text_bounds = np.minimum(np.arange(num_chunks + 1) * chunk_sentences, len(sentences))
+    audio_bounds, image_bounds = bounds(len(audio)), bounds(len(images))
+    return [(text[text_bounds[k]:text_bounds[k + 1]], sentences[text_bounds[k]:text_bounds[k + 1]],
+             audio[audio_bounds[k]:audio_bounds[k + 1]], images[image_bounds[k]:image_bounds[k + 1]]) for k in range(num_chunks)]
+
+def main(args, model_kwargs):
+    torch.set_num_threads(args.num_threads)
+    model = load_summarizer(model_kwargs, args.load_path)
+    image_features = None
+    if args.image_features:
+        from keyframe_dedup import get_resnet_state, weights_fingerprint
+        image_features = weights_fingerprint(get_resnet_state(args.load_path))
+    datasets = get_datasets(args.courses_dir, model_kwargs['max_transcript_length'], image_features)
+    idx = select_videos(datasets[0], videos={args.video})[0]
+    sentences, (text, _), (audio, _), (images, _) = load_video(datasets, idx)
+    # Drop the EOS embedding, and replay the lecture `repeat` times to simulate a longer one
+    sentences, text = list(sentences) * args.repeat, text[:-1].repeat(args.repeat, 1)
+    audio, images = audio.repeat(args.repeat, 1), torch.cat([images] * args.repeat)
+    chunks = get_chunks(sentences, text, audio, images, args.chunk_sentences)
+    print('Replaying {} in {} chunks : {} sentences, {} audio frames, {} keyframes'.format(args.video, len(chunks), len(sentences), len(audio), len(images)))
+
+    live = LiveSummarizer(model, args.text_lookback, args.audio_lookback, args.image_lookback, args.audio_memory, args.image_memory,
+                          args.decoder_memory, args.max_sentences, args.beam_size)
+    latencies, full_latencies = [], []
+    seen = [0, 0, 0]
+    for number, (chunk_text, chunk_sentences, chunk_audio, chunk_images) in enumerate(chunks, 1):
+        start = time.time()
+        live.update(chunk_text, chunk_sentences, chunk_audio, chunk_images)
+        encoded = time.time()
+        summary = live.summarize()
+        latencies.append(time.time() - start)
+        message = 'Update {} : {} sentences, {:.0f} ms (encode {:.0f} ms, decode {:.0f} ms), summary {}'.format(
+            number, live.num_sentences, 1000 * latencies[-1], 1000 * (encoded - start), 1000 * (time.time() - encoded), summary['indices'])
+
+        seen = [seen[0] + len(chunk_text), seen[1] + len(chunk_audio), seen[2] + len(chunk_images)]
+        if args.compare:
+            # Encode everything received so far (the kept sentences) again, as MMBiDAF.summarize would
+            start = time.time()
+            first = max(0, seen[0] - live.capacity)
+            full_text = torch.cat((text[first:seen[0]], live.eos.cpu())).unsqueeze(0)
+            with torch.no_grad():
+                [(indices, _)] = model.summarize(full_text.to(live.device), [full_text.size(1)], audio[:max(1, seen[1])].unsqueeze(0).to(live.device), [max(1, seen[1])],
+                                                 images[:max(1, seen[2])].unsqueeze(0).to(live.device), [max(1, seen[2])], args.max_sentences, args.beam_size)
+            full_latencies.append(time.time() - start)
+            indices = [first + k for k in indices]
+            overlap = len(set(summary['indices']) & set(indices)) / max(1, len(set(indices)))
+            message += ', full re-encoding {:.0f} ms ({})'.format(1000 * full_latencies[-1],
+                                                                   'same summary' if indices == summary['indices'] else 'summary overlap {:.0%}'.format(overlap))
+        print(message)
+
+    quarter = max(1, len(latencies) // 4)
+    report = OrderedDict([('updates', len(latencies)),
+                          ('first_quarter_ms', round(1000 * float(np.mean(latencies[:quarter])), 1)),
+                          ('last_quarter_ms', round(1000 * float(np.mean(latencies[-quarter:])), 1))])
+    if full_latencies:
+        report['full_first_quarter_ms'] = round(1000 * float(np.mean(full_latencies[:quarter])), 1)
+        report['full_last_quarter_ms'] = round(1000 * float(np.mean(full_latencies[-quarter:])), 1)
+    print('Mean update latency : {}'.format(dumps(report)))
+    print('Final summary : {}'.format(dumps(live.summarize(), indent=4)))
+
+if __name__ == '__main__':
+    args = get_live_args()
+    device = util.get_available_devices()[0]
+    model_kwargs = dict(hidden_size=args.hidden_size, text_embedding_size=300, audio_embedding_size=128, image_embedding_size=1000,
+                        device=device, drop_prob=0.2, max_transcript_length=409)
+    main(args, model_kwargs)
@@ -0,0 +1,89 @@
+"""
+Load test a running `serve.py` : send summarization requests from concurrent clients and report the
+throughput and the latencies seen by the clients, then the statistics of the server.
+
+Every client sends its next request as soon as it gets the previous response. The requests ask for the
+videos of `--videos` in turn, or carry random features of `--num_sentences` sentences, `--num_frames`
+audio frames and `--num_keyframes` keyframes (with `--npz_dir`, saved there and sent as paths).
+"""
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from json import dumps, loads
+
+import numpy as np
+
+from args import get_load_generator_args
+from serve import percentiles
+
+def random_payload(rng, num_sentences, num_frames, num_keyframes):
+    return {'text': rng.randn(num_sentences, 300).astype(np.float32).round(4).tolist(),
+            'audio': rng.randn(num_frames, 128).astype(np.float32).round(4).tolist(),
+            'images': rng.randn(num_keyframes, 1000).astype(np.float32).round(4).tolist()}
+
+def post(url, body, timeout=600):
+    """
+    POST a JSON body, returns the status and the decoded response. A request failing without an HTTP response
+    (refused or reset connection, timeout) gets the name of its error as status.
+    """
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, loads(e.read() or b'{}')
+    except (urllib.error.URLError, OSError) as e:
+        reason = getattr(e, 'reason', e)
+        error = reason if isinstance(reason, Exception) else e
+        return type(error).__name__, {'error': str(error)}
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    if args.videos:
+        bodies = [dumps({'video': video}).encode() for video in args.videos]
+    else:
+        # A few distinct payloads, encoded once so that the clients only measure the server
+        payloads = [random_payload(rng, args.num_sentences, args.num_frames, args.num_keyframes) for _ in range(4)]
+        if args.npz_dir:
+            os.makedirs(args.npz_dir, exist_ok=True)
+            paths = [os.path.abspath(os.path.join(args.npz_dir, 'lecture_{}.npz'.format(k))) for k in range(len(payloads))]
+            for path, payload in zip(paths, payloads):
+                np.savez(path, **{key: np.asarray(value, dtype=np.float32) for key, value in payload.items()})
+            payloads = [{'path': path} for path in paths]
+        bodies = [dumps(payload).encode() for payload in payloads]
+
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+    counter = iter(range(args.num_requests))
+
+    def client():
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                return
+            start = time.time()
+            status, _ = post(args.url + '/summarize', bodies[number % len(bodies)])
+            with lock:
+                latencies.append(time.time() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    print('Sending {} requests from {} clients to {}'.format(args.num_requests, args.concurrency, args.url))
+    start = time.time()
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - start
+
+    print('{} requests in {:.1f}s : {:.2f} requests/sec, responses {}'.format(
+        len(latencies), elapsed, len(latencies) / elapsed, dict(sorted(statuses.items(), key=lambda item: str(item[0])))))
+    print('Client latency (ms) : {}'.format(dumps(percentiles(latencies))))
+    with urllib.request.urlopen(args.url + '/stats') as response:
+        print('Server stats : {}'.format(dumps(loads(response.read()), indent=4)))
+
+if __name__ == '__main__':
+    main(get_load_generator_args())
@@ -4,6 +4,13 @@ import torch
 from layers.encoding import *
 from layers.attention import *
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from profiling import stage
+
+# Blocks of MMBiDAF whose activations can be recomputed in the backward pass instead of stored
+CHECKPOINT_BLOCKS = ('encoders', 'bidaf', 'decoder')
+# First-stage scorers of the two-stage decoding, see `MMBiDAF.select_candidates`
+CANDIDATE_SCORERS = ('centrality', 'decoder')
 
 class MMBiDAF(nn.Module):
     """
@@ -24,13 +31,24 @@ class MMBiDAF(nn.Module):
         audio_vectors (torch.Tensor) : Pre-trained audio features (MFCC).
         hidden_size (int) : Number of features in the hidden state at each layer.
         drop_prob (float) : Dropout probability.
+        checkpoint_activations (iterable) : Blocks from `CHECKPOINT_BLOCKS` (or 'all') to run with activation checkpointing
+                                            during training. 'encoders' covers the three BiLSTM encoders, 'bidaf' covers
+                                            each BiDAF attention together with its modeling LSTM and 'decoder' covers
+                                            every decoder timestep.
     """
 
-    def __init__(self, hidden_size, text_embedding_size, audio_embedding_size, image_embedding_size, device, drop_prob=0., max_transcript_length=405):
+    def __init__(self, hidden_size, text_embedding_size, audio_embedding_size, image_embedding_size, device, drop_prob=0., max_transcript_length=405, checkpoint_activations=()):
         super(MMBiDAF, self).__init__()
 
         self.device = device
         self.max_transcript_length = max_transcript_length
+        if 'all' in checkpoint_activations:
+            checkpoint_activations = CHECKPOINT_BLOCKS
+        for block in checkpoint_activations:
+            if block not in CHECKPOINT_BLOCKS:
+                raise ValueError(f'Unrecognized checkpoint block: "{block}"')
+        self.checkpoint_activations = set(checkpoint_activations)
+        self.profiler = None
 
         self.emb = Embedding(embedding_size=text_embedding_size,
                              hidden_size=hidden_size,
@@ -83,6 +101,34 @@ class MMBiDAF(nn.Module):
                                                                  num_layers=1)
 
 
+    def set_profiler(self, profiler):
+        """Record the stages of the model with a `profiling.StageProfiler`, or stop recording them with None."""
+        if self.profiler is not None:
+            self.profiler.detach()
+        self.profiler = self.multimodal_att_decoder.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
+
+    def run_block(self, block, fn, *args):
+        """
+        Run `fn(*args)`, dropping its intermediate activations and recomputing them during backward
+        when `block` is checkpointed. The RNG state is restored for the recomputation so dropout masks match.
+        """
+        if self.training and block in self.checkpoint_activations and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant=False)
+        return fn(*args)
+
+    def attend_and_model(self, bidaf_att, mod_enc, text_encoded, modality_encoded, text_mask, modality_mask, text_lengths):
+        """
+        BiDAF attention followed by its modeling LSTM. Kept as one block so that the similarity matrix and
+        the (batch_size, num_sentences, 8 * hidden_size) attention output need not be stored when checkpointed.
+        """
+        modality = 'audio' if bidaf_att is self.bidaf_att_audio else 'image'
+        with stage(self.profiler, 'bidaf/' + modality):
+            att = bidaf_att(text_encoded, modality_encoded, text_mask, modality_mask)      # (batch_size, num_sentences, 8 * hidden_size)
+        with stage(self.profiler, 'modeling/' + modality):
+            return mod_enc(att, text_lengths)                                               # (batch_size, num_sentences, 2 * hidden_size)
+
     def get_mask(self, X, X_len):
         X_len = torch.LongTensor(X_len)
         maxlen = X.size(1)
@@ -91,48 +137,52 @@ class MMBiDAF(nn.Module):
         mask = idx < len_expanded
         return mask
 
-    def forward(self, embedded_text, original_text_lengths, embedded_audio, original_audio_lengths, transformed_images, original_image_lengths, batch_target_indices, original_target_len, max_dec_len):
-        text_emb = self.emb(embedded_text)                                                          # (batch_size, num_sentences, hidden_size)
-        # print("Highway Embedded text")
-        text_encoded, _ = self.text_enc(text_emb, original_text_lengths)                               # (batch_size, num_sentences, 2 * hidden_size)
-        # print("Text encoding")
-
-        audio_emb = self.a_emb(embedded_audio)                                                      # (batch_size, num_audio_envelopes, hidden_size)
-        # print("Highway Embedded Audio")
-        audio_encoded, _ = self.audio_enc(audio_emb, original_audio_lengths)                           # (batch_size, num_audio_envelopes, 2 * hidden_size)
-        # print("Audio encoding")
-
-        original_images_size = transformed_images.size()                                             # (batch_size, num_keyframes, num_channels, transformed_image_size, transformed_image_size)
-        # Combine images across videos in a batch into a single dimension to be embedded by ResNet
-        transformed_images = torch.reshape(transformed_images, (-1, transformed_images.size(2), transformed_images.size(3), transformed_images.size(4)))    # (batch_size * num_keyframes, num_channels, transformed_image_size, transformed_image_size)
-        image_emb = self.image_keyframes_emb(transformed_images)                                    # (batch_size * num_keyframes, encoded_image_size=1000)
-        # print("Resnet Image")
-        image_emb = torch.reshape(image_emb, (original_images_size[0], original_images_size[1], -1))  # (batch_size, num_keyframes, 300)
-        image_emb = self.i_emb(image_emb)                                                             # (batch_size, num_keyframes, hidden_size)
-        # print("Highway Image")
-        image_encoded, _ = self.image_enc(image_emb, original_image_lengths)                           # (batch_size, num_keyframes, 2 * hidden_size)
-        # print("Image Encoding")
+    def encode(self, embedded_text, original_text_lengths, embedded_audio, original_audio_lengths, transformed_images, original_image_lengths):
+        """
+        Run the embedding, encoder and BiDAF layers, everything up to the first decoder timestep.
+
+        Returns:
+            decoder_state (tuple) : The decoder input, hidden state, cell state and coverage vector of the first timestep.
+            decoder_context (tuple) : The text-audio and text-image modality aware encodings and the decoder mask, shared by all the timesteps.
+        """
+        with stage(self.profiler, 'embedding/text'):
+            text_emb = self.emb(embedded_text)                                                      # (batch_size, num_sentences, hidden_size)
+        with stage(self.profiler, 'encoder/text'):
+            text_encoded, _ = self.run_block('encoders', self.text_enc, text_emb, original_text_lengths)      # (batch_size, num_sentences, 2 * hidden_size)
+
+        with stage(self.profiler, 'embedding/audio'):
+            audio_emb = self.a_emb(embedded_audio)                                                  # (batch_size, num_audio_envelopes, hidden_size)
+        with stage(self.profiler, 'encoder/audio'):
+            audio_encoded, _ = self.run_block('encoders', self.audio_enc, audio_emb, original_audio_lengths)  # (batch_size, num_audio_envelopes, 2 * hidden_size)
+
+        if transformed_images.dim() == 3:
+            # ResNet features cached by keyframe_dedup.py
+            image_emb = transformed_images                                                            # (batch_size, num_keyframes, encoded_image_size=1000)
+        else:
+            original_images_size = transformed_images.size()                                         # (batch_size, num_keyframes, num_channels, transformed_image_size, transformed_image_size)
+            # Combine images across videos in a batch into a single dimension to be embedded by ResNet
+            transformed_images = torch.reshape(transformed_images, (-1, transformed_images.size(2), transformed_images.size(3), transformed_images.size(4)))    # (batch_size * num_keyframes, num_channels, transformed_image_size, transformed_image_size)
+            with stage(self.profiler, 'embedding/resnet'):
+                image_emb = self.image_keyframes_emb(transformed_images)                            # (batch_size * num_keyframes, encoded_image_size=1000)
+            image_emb = torch.reshape(image_emb, (original_images_size[0], original_images_size[1], -1))  # (batch_size, num_keyframes, 300)
+        with stage(self.profiler, 'embedding/image'):
+            image_emb = self.i_emb(image_emb)                                                         # (batch_size, num_keyframes, hidden_size)
+        with stage(self.profiler, 'encoder/image'):
+            image_encoded, _ = self.run_block('encoders', self.image_enc, image_emb, original_image_lengths)  # (batch_size, num_keyframes, 2 * hidden_size)
 
         text_mask = self.get_mask(embedded_text, original_text_lengths)
         audio_mask = self.get_mask(embedded_audio, original_audio_lengths)
         image_mask = self.get_mask(image_emb, original_image_lengths)
 
-        # Generate mask with size = max_transcript_length for the decoder
-        text_mask_pad = torch.zeros(text_mask.size(0), self.max_transcript_length - text_mask.size(1))
-        text_mask_pad = text_mask_pad.type(text_mask.type())
-        decoder_mask = torch.cat((text_mask, text_mask_pad), dim=1)
-        
         # Loading the tensors to device
         text_mask = text_mask.to(self.device)
         audio_mask = audio_mask.to(self.device)
         image_mask = image_mask.to(self.device)
-        decoder_mask = decoder_mask.to(self.device)
 
-        text_audio_att = self.bidaf_att_audio(text_encoded, audio_encoded, text_mask, audio_mask)   # (batch_size, num_sentences, 8 * hidden_size)
-        text_image_att = self.bidaf_att_image(text_encoded, image_encoded, text_mask, image_mask)   # (batch_size, num_sentences, 8 * hidden_size)
-
-        mod_text_audio, text_audio_hidden = self.mod_t_a(text_audio_att, original_text_lengths)                        # (batch_size, num_sentences, 2 * hidden_size
-        mod_text_image, text_img_hidden = self.mod_t_i(text_image_att, original_text_lengths)                        # (batch_size, num_sentences, 2 * hidden_size)
+        mod_text_audio, text_audio_hidden = self.run_block('bidaf', self.attend_and_model, self.bidaf_att_audio, self.mod_t_a,
+                                                           text_encoded, audio_encoded, text_mask, audio_mask, original_text_lengths)   # (batch_size, num_sentences, 2 * hidden_size)
+        mod_text_image, text_img_hidden = self.run_block('bidaf', self.attend_and_model, self.bidaf_att_image, self.mod_t_i,
+                                                         text_encoded, image_encoded, text_mask, image_mask, original_text_lengths)     # (batch_size, num_sentences, 2 * hidden_size)
 
         # if hidden_gru is None:
         #     hidden_gru = self.multimodal_att_decoder.initHidden()
@@ -140,18 +190,38 @@ class MMBiDAF(nn.Module):
         # else:
         #     hidden_gru, final_out, sentence_dist = self.multimodal_att_decoder(mod_text_audio, mod_text_image, hidden_gru, text_mask)
 
+        decoder_state, decoder_mask = self.init_decoder(text_audio_hidden, text_img_hidden, text_mask, embedded_text.size(-1))
+        return decoder_state, (mod_text_audio, mod_text_image, decoder_mask)
+
+    def init_decoder(self, text_audio_hidden, text_img_hidden, text_mask, embedding_size):
+        """
+        The decoder input, hidden state, cell state and coverage vector of the first timestep, from the final hidden
+        states of the two modeling LSTMs, and the decoder mask (the text mask padded to max_transcript_length).
+        """
+        # Generate mask with size = max_transcript_length for the decoder
+        text_mask_pad = torch.zeros(text_mask.size(0), self.max_transcript_length - text_mask.size(1))
+        text_mask_pad = text_mask_pad.type(text_mask.type())
+        decoder_mask = torch.cat((text_mask, text_mask_pad.to(text_mask.device)), dim=1)
+
         decoder_hidden = (text_audio_hidden.sum(1) + text_img_hidden.sum(1)).unsqueeze(1)           # (batch_size, num_layers*num_dir, hidden_size)
         # decoder_hidden = decoder_hidden.transpose(0,1)                                              # To get the decoder input hidden state in required form
-        decoder_cell_state = torch.zeros(1, text_emb.size(0), decoder_hidden.size(-1))              # (num_layer*num_dir, batch, hidden_size)
+        decoder_cell_state = torch.zeros(1, text_mask.size(0), decoder_hidden.size(-1))             # (num_layer*num_dir, batch, hidden_size)
 
-        decoder_input = torch.zeros(text_emb.size(0), 1, embedded_text.size(-1))                    # (batch, num_dir*num_layers, embedding_size)
+        decoder_input = torch.zeros(text_mask.size(0), 1, embedding_size)                           # (batch, num_dir*num_layers, embedding_size)
 
-        coverage_vec = torch.zeros(text_emb.size(0), text_emb.size(1), 1)                           # (batch_size, max_seq_len, 1)
+        coverage_vec = torch.zeros(text_mask.size(0), text_mask.size(1), 1)                         # (batch_size, max_seq_len, 1)
         # Loading the tensors to the GPU
         decoder_hidden = decoder_hidden.to(self.device)
         decoder_cell_state = decoder_cell_state.to(self.device)
         decoder_input = decoder_input.to(self.device)
         coverage_vec = coverage_vec.to(self.device)
+        decoder_mask = decoder_mask.to(self.device)
+
+        return (decoder_input, decoder_hidden, decoder_cell_state, coverage_vec), decoder_mask
+
+    def forward(self, embedded_text, original_text_lengths, embedded_audio, original_audio_lengths, transformed_images, original_image_lengths, batch_target_indices, original_target_len, max_dec_len):
+        (decoder_input, decoder_hidden, decoder_cell_state, coverage_vec), (mod_text_audio, mod_text_image, decoder_mask) = \
+            self.encode(embedded_text, original_text_lengths, embedded_audio, original_audio_lengths, transformed_images, original_image_lengths)
 
         eps = 1e-12
         loss = 0
@@ -160,7 +230,7 @@ class MMBiDAF(nn.Module):
 
         if self.training:          # Teacher forcing
             for idx in range(batch_target_indices.size(1)):
-                out_distribution, decoder_hidden, decoder_cell_state, att_cov_dist, coverage_vec = self.multimodal_att_decoder(decoder_input, decoder_hidden, decoder_cell_state, mod_text_audio, mod_text_image, coverage_vec, decoder_mask) 
+                out_distribution, decoder_hidden, decoder_cell_state, att_cov_dist, coverage_vec = self.run_block('decoder', self.multimodal_att_decoder, decoder_input, decoder_hidden, decoder_cell_state, mod_text_audio, mod_text_image, coverage_vec, decoder_mask)
 
                 decoder_input = list()
                 for batch_idx in range(batch_target_indices.size(0)):
@@ -183,7 +253,7 @@ class MMBiDAF(nn.Module):
                 out_distribution, decoder_hidden, decoder_cell_state, att_cov_dist, coverage_vec = self.multimodal_att_decoder(decoder_input, decoder_hidden, decoder_cell_state, mod_text_audio, mod_text_image, coverage_vec, decoder_mask)
                 _, max_prob_idx = torch.max(out_distribution, 1)
                 decoder_input = list()
-                for batch_idx in range(text_emb.size(0)):
+                for batch_idx in range(embedded_text.size(0)):
                     # Loss calculation
                     prob = out_distribution[batch_idx, int(batch_target_indices[batch_idx, idx])]
                     # print("Prob = {}".format(prob))
@@ -204,3 +274,128 @@ class MMBiDAF(nn.Module):
 #         print(out_distributions[0].size())
         out_distributions = torch.stack(out_distributions).transpose(0,1)       # (batch_size, max_timesteps, toal_max_len)
         return out_distributions, loss
+
+    def summarize(self, embedded_text, original_text_lengths, embedded_audio, original_audio_lengths, transformed_images, original_image_lengths, max_dec_len, beam_size=1,
+                  num_candidates=None, candidate_scorer='centrality'):
+        """
+        Decode extractive summaries without targets : every timestep feeds back the sentence it selected, until
+        the EOS sentence (the last one of every transcript) is selected or `max_dec_len` sentences are.
+
+        Args:
+            max_dec_len (int) : Maximum number of decoder timesteps.
+            beam_size (int) : Number of hypotheses kept per video, 1 for greedy decoding.
+            num_candidates (int) : Decode in two stages, the decoder attending and pointing only within the `num_candidates`
+                                   sentences of every video ranked best by `candidate_scorer` (see `select_candidates`).
+
+        Returns:
+            summaries (list) : For every video, the sentence indices of its best hypothesis (without the EOS) and its log-probability.
+        """
+        decoder_state, decoder_context = self.encode(embedded_text, original_text_lengths, embedded_audio, original_audio_lengths, transformed_images, original_image_lengths)
+        candidates = None
+        if num_candidates is not None:
+            decoder_state, decoder_context, embedded_text, original_text_lengths, candidates = \
+                self.select_candidates(decoder_state, decoder_context, embedded_text, original_text_lengths, num_candidates, candidate_scorer)
+        return self.decode(decoder_state, decoder_context, embedded_text, original_text_lengths, max_dec_len, beam_size, candidates)
+
+    def select_candidates(self, decoder_state, decoder_context, embedded_text, original_text_lengths, num_candidates, scorer='centrality'):
+        """
+        First stage of the two-stage decoding : score all the sentences in one pass and keep the `num_candidates` best ones
+        of every video, and its EOS, in transcript order. Every decoder timestep then attends over the candidates only and
+        its output distribution is over the candidates only, instead of all the max_transcript_length outputs.
+
+        The scorers are
+            'centrality' : the mean cosine similarity of the sentence embedding to those of the other sentences of the lecture.
+            'decoder' : the output distribution of the first decoder timestep.
+
+        Returns:
+            decoder_state, decoder_context, embedded_text, original_text_lengths : Their candidate rows, for `decode`. A video with
+                                                                                    fewer sentences than `num_candidates` keeps them all.
+            candidates (torch.LongTensor) : (batch_size, num_candidates) sentence index of every candidate.
+        """
+        if scorer not in CANDIDATE_SCORERS:
+            raise ValueError(f'Unrecognized candidate scorer: "{scorer}"')
+        decoder_input, decoder_hidden, decoder_cell_state, coverage_vec = decoder_state
+        mod_text_audio, mod_text_image, decoder_mask = decoder_context
+        num_sentences = embedded_text.size(1)
+        lengths = torch.as_tensor(original_text_lengths, device=self.device).unsqueeze(1)
+        positions = torch.arange(num_sentences, device=self.device).unsqueeze(0)            # (1, num_sentences)
+
+        if scorer == 'centrality':
+            sentence_mask = positions < lengths - 1                                             # Without the EOS
+            normalized = nn.functional.normalize(embedded_text, dim=2)
+            similarity = torch.bmm(normalized, normalized.transpose(1, 2))                      # (batch_size, num_sentences, num_sentences)
+            scores = (similarity * sentence_mask.unsqueeze(1)).sum(2) / sentence_mask.sum(1, keepdim=True).clamp(min=1)
+        else:
+            out_distribution = self.multimodal_att_decoder(decoder_input, decoder_hidden, decoder_cell_state, mod_text_audio, mod_text_image, coverage_vec, decoder_mask)[0]
+            scores = out_distribution[:, :num_sentences]
+        # The EOS is always a candidate, the padding never is
+        scores = scores.masked_fill(positions >= lengths, float('-inf')).masked_fill(positions == lengths - 1, float('inf'))
+
+        top_scores, candidates = scores.topk(min(num_candidates, num_sentences), dim=1)
+        candidates, order = candidates.sort(dim=1)                                              # Transcript order, the padding last
+        candidate_mask = top_scores.gather(1, order) > float('-inf')                            # (batch_size, num_candidates)
+
+        def take(tensor):
+            return tensor.gather(1, candidates.unsqueeze(2).expand(-1, -1, tensor.size(2)))
+        return ((decoder_input, decoder_hidden, decoder_cell_state, take(coverage_vec)), (take(mod_text_audio), take(mod_text_image), candidate_mask),
+                take(embedded_text), candidate_mask.sum(1).tolist(), candidates)
+
+    def decode(self, decoder_state, decoder_context, embedded_text, original_text_lengths, max_dec_len, beam_size=1, candidates=None):
+        """
+        Target-free decoding from the outputs of `encode` (or of an incremental encoder, see `live.py`), see `summarize`.
+        With the `candidates` of `select_candidates`, the decoder points within the candidates and their sentence indices are returned.
+        """
+        eps = 1e-12
+        batch_size = embedded_text.size(0)
+        decoder_input, decoder_hidden, decoder_cell_state, coverage_vec = decoder_state
+        mod_text_audio, mod_text_image, decoder_mask = decoder_context
+
+        # The hypotheses of all the videos are decoded as one batch of batch_size * beam_size rows
+        rows = torch.arange(batch_size, device=self.device).repeat_interleave(beam_size)
+        mod_text_audio, mod_text_image, decoder_mask = mod_text_audio[rows], mod_text_image[rows], decoder_mask[rows]
+        decoder_input, decoder_hidden, coverage_vec = decoder_input[rows], decoder_hidden[rows], coverage_vec[rows]
+        decoder_cell_state = decoder_cell_state[:, rows]
+        embedded_text = embedded_text[rows]
+        eos = (torch.as_tensor(original_text_lengths, device=self.device) - 1)[rows]
+        if candidates is not None:
+            candidates = candidates[rows]
+
+        # Only the first hypothesis of every video is expanded at the first timestep
+        scores = torch.full((batch_size, beam_size), float('-inf'), device=self.device)
+        scores[:, 0] = 0
+        finished = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=self.device)
+        sequences = torch.zeros(batch_size * beam_size, 0, dtype=torch.long, device=self.device)
+        for _ in range(max_dec_len):
+            out_distribution, decoder_hidden, decoder_cell_state, _, coverage_vec = self.multimodal_att_decoder(decoder_input, decoder_hidden, decoder_cell_state, mod_text_audio, mod_text_image, coverage_vec, decoder_mask, candidates)
+            log_probs = torch.log(out_distribution + eps).masked_fill(~decoder_mask, float('-inf'))     # (batch_size * beam_size, max_transcript_length or num_candidates)
+            # A finished hypothesis keeps its score and repeats its EOS
+            log_probs[finished] = float('-inf')
+            log_probs[finished, eos[finished]] = 0
+
+            num_outputs = log_probs.size(1)
+            expanded = (scores.view(-1, 1) + log_probs).view(batch_size, -1)                           # (batch_size, beam_size * max_transcript_length)
+            scores, best = expanded.topk(beam_size, dim=1)
+            parents = (best // num_outputs + torch.arange(batch_size, device=self.device).unsqueeze(1) * beam_size).view(-1)
+            selected = (best % num_outputs).view(-1)
+            # A video with fewer possible continuations than beam_size fills its beam with -inf picks, which can point past
+            # its sentences : they select its EOS instead and keep their -inf score
+            selected = torch.where(torch.isinf(scores.view(-1)), eos[parents], selected)
+
+            sequences = torch.cat((sequences[parents], selected.unsqueeze(1)), dim=1)
+            finished = finished[parents] | (selected == eos)
+            decoder_hidden, decoder_cell_state, coverage_vec = decoder_hidden[parents], decoder_cell_state[:, parents], coverage_vec[parents]
+            decoder_input = embedded_text[parents, selected].unsqueeze(1)                               # (batch_size * beam_size, 1, embedding_size)
+            if finished.all():
+                break
+
+        # The hypotheses of every video are sorted by score, the best one comes first
+        summaries = []
+        for batch_idx in range(batch_size):
+            sequence = sequences[batch_idx * beam_size].tolist()
+            video_eos = int(eos[batch_idx * beam_size])
+            if video_eos in sequence:
+                sequence = sequence[:sequence.index(video_eos)]
+            if candidates is not None:
+                sequence = candidates[batch_idx * beam_size, sequence].tolist()
+            summaries.append((sequence, scores[batch_idx, 0].item()))
+        return summaries
@@ -0,0 +1,144 @@
+"""
+Pack the keyframes of every course into one memory-mappable uint8 array at model resolution.
+
+The keyframes of `<course>/video_key_frames/` are resized to a short side of `--size`, keeping their aspect
+ratio (as `transforms.Resize(size)`), and written, in video and keyframe order, to
+`<course>/keyframe_store.<version>.npy`, a (num_keyframes, height, width, 3) RGB array of the largest packed height
+and width of the course. Keyframes of another aspect ratio are centered and padded with black, so the center crop
+of every row is that of its keyframe. The name and shape of the array, the videos, their first row, their keyframe
+names and the size and modification time of every keyframe are in `<course>/keyframe_store.json`, replaced once
+the new array is written : readers switch to the new store at once, and an interrupted run leaves the previous
+one whole. `ImageDataset(..., packed=True)` then reads the keyframes of
+a video as a copy of rows of the memory-mapped array instead of decoding JPEGs.
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from args import get_pack_args
+from datasets import KEYFRAME_STORE, get_keyframe_num
+
+def short_side_size(image_size, size):
+    """The (width, height) of an image of `image_size` resized to a short side of `size`, keeping its aspect ratio."""
+    width, height = image_size
+    if width < height:
+        return size, int(round(size * height / width))
+    return int(round(size * width / height)), size
+
+def get_image_size(path):
+    # Only reads the header
+    with Image.open(path) as image:
+        return image.size
+
+def read_keyframe(path, size):
+    """A keyframe resized to a short side of `size`, as a (height, width, 3) uint8 RGB array."""
+    image = Image.open(path)
+    width, height = short_side_size(image.size, size)
+    # Let the JPEG decoder downscale by up to 8 while staying larger than the output
+    image.draft('RGB', (width, height))
+    image = image.convert('RGB')
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.BILINEAR)
+    return np.asarray(image)
+
+def get_keyframes(course_path):
+    """The videos of a course and the names of their keyframes, in order."""
+    keyframes_path = os.path.join(course_path, 'video_key_frames')
+    videos, frames = [], []
+    for video in sorted(os.listdir(keyframes_path), key=int):
+        video_path = os.path.join(keyframes_path, video)
+        videos.append(video)
+        frames.append(sorted((fname for fname in os.listdir(video_path) if os.path.isfile(os.path.join(video_path, fname))), key=get_keyframe_num))
+    return videos, frames
+
+def get_file_stats(course_path, videos, frames):
+    """The [size, modification time in ns] of every keyframe, per video, to tell a changed keyframe from the packed one."""
+    stats = []
+    for video, names in zip(videos, frames):
+        video_path = os.path.join(course_path, 'video_key_frames', video)
+        stats.append([[stat.st_size, stat.st_mtime_ns] for stat in (os.stat(os.path.join(video_path, name)) for name in names)])
+    return stats
+
+def pack_video(task):
+    """Pool worker : write the keyframes of one video to their rows of the store being built."""
+    store_path, start, paths, size = task
+    images = np.load(store_path, mmap_mode='r+')
+    height, width = images.shape[1:3]
+    for row, path in enumerate(paths, start):
+        image = read_keyframe(path, size)
+        # Rounded as the center crop of `KeyframeBatchTransform`, which then stays within the keyframe
+        top, left = int(round((height - image.shape[0]) / 2.)), int(round((width - image.shape[1]) / 2.))
+        images[row, top:top + image.shape[0], left:left + image.shape[1]] = image
+    images.flush()
+    return len(paths)
+
+def pack_course(course_path, size=256, pool=None, force=False):
+    """
+    Write the keyframe store of a course, unless it is up to date (same size, same keyframe files, sizes and
+    modification times).
+
+    Returns:
+        num_keyframes (int) : Number of packed keyframes, 0 when the store was up to date.
+    """
+    videos, frames = get_keyframes(course_path)
+    file_stats = get_file_stats(course_path, videos, frames)
+    meta_path = os.path.join(course_path, KEYFRAME_STORE + '.json')
+    if not force and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('size') == size and meta['videos'] == videos and meta['frames'] == frames \
+                and meta.get('file_stats') == file_stats:
+            return 0
+
+    num_keyframes = sum(len(names) for names in frames)
+    if num_keyframes == 0:
+        return 0
+    # Every keyframe is checked, the videos of a course can differ in aspect ratio
+    packed_sizes = [short_side_size(get_image_size(os.path.join(course_path, 'video_key_frames', video, name)), size)
+                    for video, names in zip(videos, frames) for name in names]
+    width, height = max(width for width, _ in packed_sizes), max(height for _, height in packed_sizes)
+
+    offsets = np.cumsum([0] + [len(names) for names in frames]).tolist()
+    tmp_path = os.path.join(course_path, KEYFRAME_STORE + '.tmp.npy')
+    np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(num_keyframes, height, width, 3)).flush()
+    tasks = [(tmp_path, start, [os.path.join(course_path, 'video_key_frames', video, name) for name in names], size)
+             for video, start, names in zip(videos, offsets, frames) if names]
+    list(pool.imap_unordered(pack_video, tasks) if pool is not None else map(pack_video, tasks))
+    meta = {'size': size, 'num_keyframes': num_keyframes, 'height': height, 'width': width, 'videos': videos, 'offsets': offsets,
+            'frames': frames, 'file_stats': file_stats}
+    store_name = '{}.{}.npy'.format(KEYFRAME_STORE, hashlib.sha1(json.dumps(meta).encode()).hexdigest()[:12])
+    os.replace(tmp_path, os.path.join(course_path, store_name))
+    meta['store'] = store_name
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    # The arrays of the previous stores (`keyframe_store.npy` before they were versioned)
+    for fname in os.listdir(course_path):
+        if fname.startswith(KEYFRAME_STORE + '.') and fname.endswith('.npy') and fname != store_name:
+            os.remove(os.path.join(course_path, fname))
+    return num_keyframes
+
+def main(args):
+    courses = [fname for fname in os.listdir(args.courses_dir) if fname.isdigit() and os.path.isdir(os.path.join(args.courses_dir, fname, 'video_key_frames'))]
+    pool = mp.Pool(args.num_workers) if args.num_workers > 1 else None
+    start = time.time()
+    num_keyframes = 0
+    try:
+        for course in sorted(courses, key=int):
+            course_path = os.path.join(args.courses_dir, course)
+            count = pack_course(course_path, args.size, pool, args.force)
+            num_keyframes += count
+            print('{} : packed {} keyframes'.format(course_path, count) if count else '{} : up to date'.format(course_path))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('Packed {} keyframes in {:.1f}s'.format(num_keyframes, time.time() - start))
+
+if __name__ == '__main__':
+    main(get_pack_args())
@@ -1,95 +1,207 @@
+import hashlib
+import json
+import multiprocessing as mp
 import os
 import pickle
 import re
+import time
 from gensim.scripts.glove2word2vec import glove2word2vec
 from gensim.models import KeyedVectors
 from nltk import download
-from nltk.corpus import stopwords, words
-from nltk.tokenize import sent_tokenize, word_tokenize, TweetTokenizer
-from nltk.stem import WordNetLemmatizer
 import numpy as np
-import os
 import sys
 import torch
 import logging
 
+import text_normalization
+from args import get_preprocess_args
+from datasets import SENTENCE_STORE
+from functools import lru_cache
+from text_normalization import normalize_text, read_transcript
+
 def get_pretrained_model(glove_input_file):
     word2vec_output_file = glove_input_file + '.word2vec'
     glove2word2vec(glove_input_file, word2vec_output_file)
     return word2vec_output_file
-    
-def get_model(glove_path):
-    filename = get_pretrained_model(glove_path)
-    model = KeyedVectors.load_word2vec_format(filename, binary=False)
-    return model
-
-def preprocess(text, stop_words):
-    sentences = sent_tokenize(text)
-    tweet_tokenizer = TweetTokenizer()
-    document = []
-    for sentence in sentences:
-        sentence = sentence.lower()
-        words = tweet_tokenizer.tokenize(sentence)
-        doc = [word for word in words if word not in stop_words]
-        document.append(doc)
-    return document
+
+def convert_model(glove_path, kv_path):
+    """
+    Convert GloVe vectors to gensim's native format : a pickled `KeyedVectors` at `kv_path` and its vectors
+    in a separate .npy file next to it, which `get_model` memory-maps. Both files are written atomically.
+    """
+    model = KeyedVectors.load_word2vec_format(get_pretrained_model(glove_path), binary=False)
+    tmp_path = kv_path + '.tmp'
+    model.save(tmp_path, sep_limit=0)
+    os.remove(glove_path + '.word2vec')
+    # The arrays are found from the name of the main file when loading, rename them first
+    prefix = os.path.basename(tmp_path)
+    for fname in os.listdir(os.path.dirname(os.path.abspath(tmp_path))):
+        if fname.startswith(prefix + '.') and fname.endswith('.npy'):
+            directory = os.path.dirname(os.path.abspath(tmp_path))
+            os.replace(os.path.join(directory, fname), os.path.join(directory, os.path.basename(kv_path) + fname[len(prefix):]))
+    os.replace(tmp_path, kv_path)
+
+def get_model(glove_path, kv_path=None):
+    """
+    Load GloVe vectors, converting the text file once to `<glove_path>.kv` (see `convert_model`).
+    The vectors are memory-mapped read-only, so processes loading the same model share them through the page cache.
+    """
+    kv_path = kv_path or glove_path + '.kv'
+    if not os.path.exists(kv_path):
+        print("Converting {} to {} (once)".format(glove_path, kv_path))
+        convert_model(glove_path, kv_path)
+    return KeyedVectors.load(kv_path, mmap='r')
+
+def get_vocab(model):
+    """Word -> index mapping of a `KeyedVectors` (`vocab` before gensim 4, `key_to_index` since)."""
+    # Tested by presence : an empty key_to_index is still gensim 4, whose `vocab` raises
+    return model.key_to_index if hasattr(model, 'key_to_index') else model.vocab
+
+def preprocess(text, stop_words=None):
+    """Tokenized sentences of `text` without stop words, see `text_normalization.normalize_text`."""
+    return normalize_text(text, stop_words)
 
 def document_vector(glove_model, doc):
     # remove out-of-vocabulary words
-    doc = [word for word in doc if word in glove_model.vocab]
+    vocab = get_vocab(glove_model)
+    doc = [word for word in doc if word in vocab]
     return np.mean(glove_model[doc], axis = 0)
 
-def is_blank_sentence(sentence, words_set, lemmatizer):
-    for token in sentence:
-        if lemmatizer.lemmatize(token) in words_set:
-            return False
+def is_blank_sentence(sentence, words_set):
+    if not text_normalization.is_blank_sentence(sentence, words_set):
+        return False
     print("Found blank sentence!: " + str(sentence))
     return True
 
-def generate_embeddings(path, glove_path, sentence_path, words_set, model, lemmatizer, save_trans_path):
-    files = [os.path.join(path, item) for item in os.listdir(path) if os.path.isfile(os.path.join(path, item)) and '.txt' in item]
-    for file in files:
-        # if '21.txt' not in file:
-            # continue
+def process_transcript(file, words_set, save_trans_path):
+    """
+    Tokenize a transcript and save its non-blank sentences, as (processed sentence, original line) pairs,
+    to `save_trans_path/<transcript id>.p`. The file is written atomically.
+
+    Returns:
+        num_sentences (int) : Number of sentences saved, None if the transcript could not be read.
+    """
+    try:
+        lines = read_transcript(file)
+    except Exception as e:
+        logging.error('Unable to open file. Exception: ' + str(e))
+        return None
+    text = ' '.join(lines)
+    doc = preprocess(text)
+
+    idx = os.path.basename(file)[:-4]
+    sents = []
+    for sentence, line in zip(doc, lines):
+        if is_blank_sentence(sentence, words_set):
+            continue
+        sents.append((' '.join(sentence), line))
+
+    save_path = os.path.join(save_trans_path, str(idx) + '.p')
+    with open(save_path + '.tmp', 'wb') as f:
+        pickle.dump(sents, f)
+    os.replace(save_path + '.tmp', save_path)
+    return len(sents)
+
+def generate_embeddings(path, glove_path, sentence_path, words_set, model, save_trans_path):
+    for file in get_transcript_files(path):
         print("Processing transcript: " + str(file))
-        lines = []
-        try:
-            with open(file) as f:
-                for line in f:
-                    if re.match('\d+:\d+', line) is None:
-                        line = line.replace('[MUSIC]', '')
-                        lines.append(line.strip())
-        except Exception as e:
-            logging.error('Unable to open file. Exception: ' + str(e))
-        else:
-            text = ' '.join(lines)
-            
-            stop_words = stopwords.words('english')
-            doc = preprocess(text, stop_words)
-            
-            embedding_matrix = {}
-            idx = os.path.basename(file)[:-4]
-            sents = []
-            for sentence, line in zip(doc, lines):
-                if is_blank_sentence(sentence, words_set, lemmatizer):
-                    continue
-#                 single_sentence_embed = document_vector(model, sentence)
-    #             x.append(single_sentence_embed)
-                sents.append((' '.join(sentence), line))
-        
-#                 sentence_embeddings = np.array(single_sentence_embed)
-#                 sentence_embeddings = torch.from_numpy(sentence_embeddings)
-#                 sentence_list = " ".join(sentence)
-#                 embedding_matrix[sentence_list] = sentence_embeddings
-            with open(save_trans_path + str(idx) + '.p', 'wb') as f:
-                pickle.dump(sents, f)
-            
-            # Save the embedding dictionary for faster loading
-#             idx = os.path.basename(file)[:-4]
-#             save_path = sentence_path + str(idx) + '.pt'
-#             torch.save(embedding_matrix, save_path)
-#             print("Saved " + str(save_path))
-        
+        process_transcript(file, words_set, save_trans_path)
+
+@lru_cache(maxsize=1)
+def get_word_ids(model):
+    """Word -> row of `model.vectors`."""
+    vocab = get_vocab(model)
+    if hasattr(model, 'key_to_index'):
+        return vocab
+    return {word: entry.index for word, entry in vocab.items()}
+
+def embed_course(course_path, model, video_ids=None):
+    """
+    Embed every sentence of a course as the mean GloVe vector of its in-vocabulary words, in one pass.
+
+    The processed sentences of all the videos (processed_transcripts/<video>.p, repeated sentences kept once
+    per video) are turned into one array of vocabulary ids, and all the sentence means are computed with a
+    single `np.add.reduceat` over it, straight into one contiguous (num_sentences, 300) float32 matrix saved as
+    `<course_path>/sentence_embeddings.<version>.npy`. `sentence_embeddings.json` holds the name of that matrix,
+    the video ids, the offset of every video's first row, the sentences (see `datasets.SentenceEmbeddingStore`)
+    and the content hash of every embedded processed transcript (see `embeddings_up_to_date`). Sentences without
+    any in-vocabulary word get a zero vector.
+
+    The new matrix is written under its own name and the metadata is replaced last, switching readers to the new
+    store at once : an interrupted run leaves the previous store whole, never its offsets over the new rows.
+
+    Args:
+        course_path (str) : Course directory.
+        model (KeyedVectors) : GloVe vectors.
+        video_ids (list) : Videos to embed, all the processed transcripts of the course by default.
+
+    Returns:
+        num_sentences (int) : Number of embedded sentences.
+    """
+    processed_path = os.path.join(course_path, 'processed_transcripts')
+    if video_ids is None:
+        video_ids = sorted((fname[:-2] for fname in os.listdir(processed_path) if fname.endswith('.p')),
+                           key=lambda video: int(re.search(r'\d+', video).group()))
+    offsets = [0]
+    sentences = []
+    digests = {}
+    for video in video_ids:
+        with open(os.path.join(processed_path, video + '.p'), 'rb') as f:
+            data = f.read()
+        digests[video] = hashlib.sha1(data).hexdigest()
+        video_sentences = list(dict.fromkeys(sent for sent, _ in pickle.loads(data)))
+        sentences.append(video_sentences)
+        offsets.append(offsets[-1] + len(video_sentences))
+
+    # Vocabulary id of every token of the course, -1 when out of vocabulary
+    word_ids = get_word_ids(model)
+    tokens = [sentence.split() for video_sentences in sentences for sentence in video_sentences]
+    ids = np.fromiter((word_ids.get(token, -1) for sentence in tokens for token in sentence), dtype=np.int64)
+    owners = np.repeat(np.arange(len(tokens)), [len(sentence) for sentence in tokens])
+    in_vocab = ids >= 0
+    ids, owners = ids[in_vocab], owners[in_vocab]
+    counts = np.bincount(owners, minlength=len(tokens))
+
+    vectors = model.vectors
+    tmp_path = os.path.join(course_path, SENTENCE_STORE + '.tmp.npy')
+    embeddings = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(tokens), vectors.shape[1]))
+    embeddings[:] = 0
+    non_empty = counts > 0
+    if non_empty.any():
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        embeddings[non_empty] = np.add.reduceat(vectors[ids], starts, axis=0)
+        embeddings[non_empty] /= counts[non_empty, None]
+    embeddings.flush()
+    del embeddings
+
+    version = hashlib.sha1(json.dumps(digests, sort_keys=True).encode()).hexdigest()[:12]
+    embeddings_name = '{}.{}.npy'.format(SENTENCE_STORE, version)
+    os.replace(tmp_path, os.path.join(course_path, embeddings_name))
+    meta_path = os.path.join(course_path, SENTENCE_STORE + '.json')
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({'embeddings': embeddings_name, 'videos': list(video_ids), 'offsets': offsets, 'sentences': sentences,
+                   'digests': digests}, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    # The matrices of the previous stores (`sentence_embeddings.npy` before they were versioned)
+    for fname in os.listdir(course_path):
+        if fname.startswith(SENTENCE_STORE + '.') and fname.endswith('.npy') and fname != embeddings_name:
+            os.remove(os.path.join(course_path, fname))
+    return len(tokens)
+
+def embeddings_up_to_date(course_path):
+    """Whether the sentence embeddings of a course were computed from exactly its current processed transcripts."""
+    meta_path = os.path.join(course_path, SENTENCE_STORE + '.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    embedded = meta.get('digests')
+    if embedded is None or not os.path.exists(os.path.join(course_path, meta.get('embeddings', SENTENCE_STORE + '.npy'))):
+        return False
+    processed_path = os.path.join(course_path, 'processed_transcripts')
+    current = {fname[:-2]: file_hash(os.path.join(processed_path, fname)) for fname in os.listdir(processed_path) if fname.endswith('.p')}
+    return embedded == current
+
 def download_data():
     """
     This needs to be exectuted if the nltk library data and the stopwords are not installed
@@ -97,22 +209,120 @@ def download_data():
     download('punkt') #tokenizer, run once
     download('stopwords') #stopwords dictionary, run once
 
-def main(base_path, glove_path, words_set, model, lemmatizer):
-    start_idx, end_idx = 1, 25
-    # start_idx, end_idx = 4, 5
-    for idx in range(start_idx, end_idx):
-        print("Processing course " + str(idx))
-        transcript_path = base_path + str(idx) + "/" + "transcripts/"
-        sentence_path = base_path + str(idx) + '/' + 'sentence_features4/'
-        save_path = base_path + str(idx) + '/' + 'processed_transcripts/'
-        os.system('mkdir ' + sentence_path)
-        os.system('mkdir ' + save_path)
-        generate_embeddings(transcript_path, glove_path, sentence_path, words_set, model, lemmatizer, save_path)
+def get_courses(base_path):
+    """Course directories of the dataset (numbered directories holding a transcripts/ directory), in order."""
+    courses = [fname for fname in os.listdir(base_path)
+               if fname.isdigit() and os.path.isdir(os.path.join(base_path, fname, 'transcripts'))]
+    return sorted(courses, key=int)
+
+def get_transcript_files(path):
+    return sorted(os.path.join(path, item) for item in os.listdir(path) if os.path.isfile(os.path.join(path, item)) and '.txt' in item)
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_manifest(manifest_path):
+    """Transcript path (relative to the dataset) -> content hash and sentence count of its last processing."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# Vocabulary used by the pool processes, set before forking so that it is shared rather than copied
+worker_words_set = None
+
+def init_worker(words_set=None):
+    global worker_words_set
+    if words_set is not None:
+        worker_words_set = words_set
+
+def run_transcript(task):
+    key, file, digest, save_path = task
+    return key, digest, process_transcript(file, worker_words_set, save_path)
+
+def main(base_path, words_set, num_workers=1, force=False, manifest_name='preprocess_manifest.json', model=None):
+    """
+    Preprocess the transcripts of every course of `base_path` into its processed_transcripts/ directory.
+
+    Transcripts whose content hash and output are unchanged since the last run (as recorded in the manifest
+    at the root of the dataset) are skipped, so adding a course only processes that course.
+
+    Args:
+        base_path (str) : The dataset directory, with one numbered directory per course.
+        words_set (set) : Vocabulary deciding which sentences are blank.
+        num_workers (int) : Number of processes.
+        force (bool) : Process every transcript, even unchanged ones.
+        model (KeyedVectors) : If given, the sentences of every course whose embeddings were not computed from
+                               its current processed transcripts are embedded with it, see `embed_course`.
+    """
+    manifest_path = os.path.join(base_path, manifest_name)
+    manifest = {} if force else load_manifest(manifest_path)
+
+    tasks = []
+    num_transcripts = 0
+    for course in get_courses(base_path):
+        transcript_path = os.path.join(base_path, course, 'transcripts')
+        save_path = os.path.join(base_path, course, 'processed_transcripts')
+        os.makedirs(save_path, exist_ok=True)
+        for file in get_transcript_files(transcript_path):
+            num_transcripts += 1
+            key = os.path.relpath(file, base_path)
+            digest = file_hash(file)
+            output = os.path.join(save_path, os.path.basename(file)[:-4] + '.p')
+            if manifest.get(key, {}).get('sha1') == digest and os.path.exists(output):
+                continue
+            tasks.append((key, file, digest, save_path))
+    print("Processing {} of {} transcripts ({} unchanged)".format(len(tasks), num_transcripts, num_transcripts - len(tasks)))
+
+    global worker_words_set
+    worker_words_set = words_set
+    if num_workers > 1 and len(tasks) > 1:
+        # Forked processes share the vocabulary (and the loaded NLTK data) with this process
+        fork = 'fork' in mp.get_all_start_methods()
+        context = mp.get_context('fork' if fork else None)
+        pool = context.Pool(num_workers, initializer=init_worker, initargs=(None if fork else words_set,))
+        results = pool.imap_unordered(run_transcript, tasks, chunksize=max(1, min(16, len(tasks) // (4 * num_workers))))
+    else:
+        pool = None
+        results = map(run_transcript, tasks)
+
+    start = time.time()
+    num_failed = 0
+    try:
+        for done, (key, digest, num_sentences) in enumerate(results, 1):
+            if num_sentences is None:
+                num_failed += 1
+                continue
+            manifest[key] = {'sha1': digest, 'sentences': num_sentences}
+            # Record progress regularly, so an interrupted run resumes where it stopped
+            if done % 100 == 0:
+                save_manifest(manifest, manifest_path)
+                print("Processed {} / {} transcripts ({:.1f} per second)".format(done, len(tasks), done / (time.time() - start)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        save_manifest(manifest, manifest_path)
+    print("Processed {} transcripts in {:.1f}s, {} failed".format(len(tasks) - num_failed, time.time() - start, num_failed))
+
+    if model is not None:
+        # Against the processed transcripts on disk rather than those of this run, which may follow an
+        # interrupted embedding or a run with --no_embeddings
+        for course in get_courses(base_path):
+            course_path = os.path.join(base_path, course)
+            if not embeddings_up_to_date(course_path):
+                start = time.time()
+                num_sentences = embed_course(course_path, model)
+                print("Embedded {} sentences of course {} in {:.2f}s".format(num_sentences, course, time.time() - start))
 
 if __name__ == "__main__":
-    base_path = '/home/anish17281/NLP_Dataset/dataset/'
-    glove_path = '/home/amankhullar/glove_data/glove.6B.300d.txt'
-    model = get_model(glove_path)
-    words_set = model.vocab
-    lemmatizer = WordNetLemmatizer()
-    main(base_path, glove_path, words_set, model, lemmatizer)
+    args = get_preprocess_args()
+    model = get_model(args.glove_path)
+    words_set = get_vocab(model)
+    main(args.courses_dir, words_set, args.num_workers, args.force, model=None if args.no_embeddings else model)
@@ -0,0 +1,157 @@
+"""
+Opt-in profiling of the stages of MMBiDAF.
+
+The model marks its stages with `stage(self.profiler, name)`. Without a profiler, the default, that is a shared
+no-op context, so the stages cost nothing until a `StageProfiler` is set with `MMBiDAF.set_profiler`. For every
+named stage, the profiler records the number of calls, the wall time, an estimate of the FLOPs and the bytes of
+the activations produced (and on GPU the change of allocated memory). The FLOPs and the activation bytes are
+counted by forward hooks on the Linear, convolution and LSTM layers and on the layers defining `get_flops(*inputs)`
+(the BiDAF attention), and attributed to the innermost running stage. The hooks are only registered while a
+profiler is set.
+
+The stages of MMBiDAF are
+    embedding/text, embedding/audio, embedding/image    The highway embeddings.
+    embedding/resnet                                    The ResNet of the keyframes (absent with cached features).
+    encoder/text, encoder/audio, encoder/image          The BiLSTM encoders.
+    bidaf/audio, bidaf/image                            The BiDAF attention layers.
+    modeling/audio, modeling/image                      The modeling LSTMs.
+    decoder/attention, decoder/lstm, decoder/output     Every decoder timestep, one call per timestep.
+With activation checkpointing, the stages recomputed in the backward pass are recorded again.
+"""
+import contextlib
+import time
+from collections import OrderedDict
+from json import dumps
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import PackedSequence
+
+NULL_STAGE = contextlib.nullcontext()
+
+# Layers whose FLOPs and outputs are counted, along with the layers defining get_flops
+COUNTED_LAYERS = (nn.Linear, nn.Conv2d, nn.LSTM)
+
+def stage(profiler, name):
+    """The context of a named stage, recorded by `profiler` unless it is None."""
+    return NULL_STAGE if profiler is None else profiler.stage(name)
+
+def lstm_flops(lstm, num_tokens):
+    """FLOPs of the gates of an LSTM over `num_tokens` timesteps of all its sequences."""
+    flops, input_size = 0, lstm.input_size
+    num_directions = 2 if lstm.bidirectional else 1
+    for _ in range(lstm.num_layers):
+        flops += 2 * num_directions * num_tokens * 4 * lstm.hidden_size * (input_size + lstm.hidden_size)
+        input_size = num_directions * lstm.hidden_size
+    return flops
+
+def layer_flops(module, inputs, output):
+    """Estimate of the FLOPs of the matrix products of a layer, from its inputs and output."""
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+    if isinstance(module, nn.Conv2d):
+        return 2 * output.numel() * module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+    if isinstance(module, nn.LSTM):
+        x = inputs[0]
+        return lstm_flops(module, x.data.size(0) if isinstance(x, PackedSequence) else x.size(0) * x.size(1))
+    return module.get_flops(*inputs)
+
+def tensor_bytes(output):
+    """Bytes of the tensors of a layer output."""
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(tensor_bytes(item) for item in output)
+    return 0
+
+class StageProfiler:
+    """
+    Aggregates the calls, wall time, FLOPs and activation bytes of the named stages of a model.
+
+    Args:
+        cuda (bool) : The model runs on GPU : wait for its kernels at the boundaries of the stages, so that the wall
+                      times are theirs, and record the change of allocated memory.
+    """
+    def __init__(self, cuda=False):
+        self.cuda = cuda
+        self.stats = OrderedDict()
+        self.active = []                # Names of the running stages, the innermost last
+        self.handles = []
+
+    def attach(self, model):
+        """Register the counting hooks on the layers of `model`."""
+        for module in model.modules():
+            if isinstance(module, COUNTED_LAYERS) or hasattr(module, 'get_flops'):
+                self.handles.append(module.register_forward_hook(self.count))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def reset(self):
+        self.stats = OrderedDict()
+
+    def get_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = dict(calls=0, seconds=0., flops=0, activation_bytes=0, allocated_bytes=0)
+        return self.stats[name]
+
+    def count(self, module, inputs, output):
+        if self.active:
+            stats = self.get_stats(self.active[-1])
+            stats['flops'] += layer_flops(module, inputs, output)
+            stats['activation_bytes'] += tensor_bytes(output)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.cuda:
+            torch.cuda.synchronize()
+            allocated = torch.cuda.memory_allocated()
+        self.active.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            self.active.pop()
+            stats = self.get_stats(name)
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            if self.cuda:
+                stats['allocated_bytes'] += torch.cuda.memory_allocated() - allocated
+
+    def summary(self):
+        """
+        Returns:
+            summary (OrderedDict) : For every stage in order of first call, its calls, total and mean wall time in ms, share of the
+                                    time of all the stages, GFLOPs, GFLOP/s and MB of activations (and of allocated memory on GPU).
+        """
+        total_seconds = sum(stats['seconds'] for stats in self.stats.values())
+        summary = OrderedDict()
+        for name, stats in self.stats.items():
+            seconds = stats['seconds']
+            row = OrderedDict([('calls', stats['calls']),
+                               ('total_ms', round(1000 * seconds, 3)),
+                               ('mean_ms', round(1000 * seconds / max(1, stats['calls']), 4)),
+                               ('time_share', round(seconds / total_seconds, 4) if total_seconds else 0.),
+                               ('gflops', round(stats['flops'] / 1e9, 4)),
+                               ('gflops_per_sec', round(stats['flops'] / 1e9 / seconds, 2) if seconds else 0.),
+                               ('activation_mb', round(stats['activation_bytes'] / 2 ** 20, 3))])
+            if self.cuda:
+                row['allocated_mb'] = round(stats['allocated_bytes'] / 2 ** 20, 3)
+            summary[name] = row
+        return summary
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            f.write(dumps(self.summary(), indent=4))
+
+    def add_scalars(self, tbx, step, prefix='profile'):
+        """Write the mean time, time share, GFLOP/s and activation MB of every stage to a tensorboardX SummaryWriter."""
+        for name, row in self.summary().items():
+            for key in ('mean_ms', 'time_share', 'gflops_per_sec', 'activation_mb'):
+                tbx.add_scalar(f'{prefix}/{name}/{key}', row[key], step)
@@ -0,0 +1,252 @@
+"""
+Vectorized ROUGE-1/2/L scorer.
+
+Gives the same numbers as `rouge.Rouge().get_scores(hyp, ref)` (the `rouge` package,
+default `exclusive=True`) for a hypothesis and a reference text, but:
+
+    - references are tokenized, (optionally) stemmed and turned into integer n-gram
+      hashes once and cached, so a ground-truth file is read once per run,
+    - n-gram overlaps are computed with NumPy set operations on the integer hashes,
+    - the LCS tables of all (reference sentence, hypothesis sentence) pairs of a batch
+      are filled together, one NumPy operation per reference word position.
+
+A summary given as a list of lines is scored as the text `'. '.join(lines)`, i.e. every line
+is at least one sentence for ROUGE-L.
+"""
+import numpy as np
+
+from collections import namedtuple
+
+# Token ids are below 2 ** 31 so that bigram hashes fit in an int64
+ID_BITS = 31
+# Maximum number of LCS table cells filled at once
+MAX_LCS_CELLS = 2 ** 24
+
+# words : int64 token ids of the whole text, sentences : list of int64 arrays (one per sentence)
+# ngrams : {n: (unique hashes, counts)} for n = 1, 2
+Text = namedtuple('Text', ['words', 'sentences', 'ngrams'])
+
+METRICS = ('rouge-1', 'rouge-2', 'rouge-l')
+STATS = ('p', 'r', 'f')
+
+def read_lines(path):
+    """Default reference reader: the stripped lines of a text file."""
+    with open(path, 'r') as f:
+        return [line.strip() for line in f]
+
+def split_sentences(text):
+    """Split a text into sentences exactly as `rouge.Rouge.get_scores` does."""
+    return [' '.join(sent.split()) for sent in text.split('.') if len(sent) > 0]
+
+def f_score(p, r):
+    return 2.0 * ((p * r) / (p + r + 1e-8))
+
+class RougeScorer:
+    """
+    Batched ROUGE scorer with a per-reference cache.
+
+    Args:
+        stemmer (callable) : Optional token -> stem function applied to every whitespace separated token
+                             (e.g. a memoized Porter stemmer), before the ROUGE tokenization.
+        exclusive (bool) : Count unique n-grams / words like `rouge.Rouge(exclusive=True)` (its default).
+        reader (callable) : path -> list of lines, used to load references.
+    """
+    def __init__(self, stemmer=None, exclusive=True, reader=read_lines):
+        self.stemmer = stemmer
+        self.exclusive = exclusive
+        self.reader = reader
+        self.vocab = {}
+        self.references = {}
+
+    def token_ids(self, tokens):
+        vocab = self.vocab
+        return np.fromiter((vocab.setdefault(token, len(vocab)) for token in tokens), dtype=np.int64, count=len(tokens))
+
+    def ngram_counts(self, words, n):
+        if len(words) < n:
+            hashes = np.zeros(0, dtype=np.int64)
+        elif n == 1:
+            hashes = words
+        else:
+            hashes = (words[:-1] << ID_BITS) | words[1:]
+        return np.unique(hashes, return_counts=True)
+
+    def prepare(self, lines):
+        """
+        Tokenize a summary given as a list of lines (or a single string).
+
+        Returns:
+            text (Text) : Token ids, sentences and n-gram counts. None for an empty summary.
+        """
+        if isinstance(lines, str):
+            lines = [lines]
+        if self.stemmer is not None:
+            lines = [' '.join(self.stemmer(token) for token in line.split()) for line in lines]
+        sentences = split_sentences('. '.join(line for line in lines if line))
+        if not sentences:
+            return None
+        sentences = [self.token_ids(sentence.split(' ')) for sentence in sentences]
+        words = np.concatenate(sentences)
+        return Text(words, sentences, {n: self.ngram_counts(words, n) for n in (1, 2)})
+
+    def reference(self, path, lines=None):
+        """
+        Get the prepared reference for `path`, reading (or taking `lines`) and tokenizing it on first use only.
+        """
+        ref = self.references.get(path)
+        if ref is None:
+            ref = self.prepare(self.reader(path) if lines is None else lines)
+            self.references[path] = ref
+        return ref
+
+    def overlap(self, hyp_ngrams, ref_ngrams):
+        hyp_hashes, hyp_counts = hyp_ngrams
+        ref_hashes, ref_counts = ref_ngrams
+        if self.exclusive:
+            return len(hyp_hashes), len(ref_hashes), len(np.intersect1d(hyp_hashes, ref_hashes, assume_unique=True))
+        _, hyp_idx, ref_idx = np.intersect1d(hyp_hashes, ref_hashes, assume_unique=True, return_indices=True)
+        return hyp_counts.sum(), ref_counts.sum(), np.minimum(hyp_counts[hyp_idx], ref_counts[ref_idx]).sum()
+
+    def score_batch(self, hyps, refs):
+        """
+        Score a batch of summaries.
+
+        Args:
+            hyps (list) : Generated summaries, each a list of sentences, a string or a prepared `Text`.
+            refs (list) : References, each a `Text` from `reference`/`prepare`, a list of lines or a string.
+
+        Returns:
+            scores (np.ndarray) : (batch_size, 3, 3) array, indexed by `METRICS` and `STATS`.
+                                  Empty summaries or references score 0 (the `rouge` package raises instead).
+        """
+        hyps = [hyp if isinstance(hyp, Text) or hyp is None else self.prepare(hyp) for hyp in hyps]
+        refs = [ref if isinstance(ref, Text) or ref is None else self.prepare(ref) for ref in refs]
+        scores = np.zeros((len(hyps), len(METRICS), len(STATS)))
+        valid = [idx for idx, (hyp, ref) in enumerate(zip(hyps, refs)) if hyp is not None and ref is not None]
+
+        # ROUGE-N from the n-gram hashes
+        for idx in valid:
+            for metric_idx, n in enumerate((1, 2)):
+                evaluated_count, reference_count, overlapping_count = self.overlap(hyps[idx].ngrams[n], refs[idx].ngrams[n])
+                p = overlapping_count / evaluated_count if evaluated_count else 0.0
+                r = overlapping_count / reference_count if reference_count else 0.0
+                scores[idx, metric_idx] = (p, r, f_score(p, r))
+
+        # Summary level ROUGE-L from the union LCS of every (reference sentence, hypothesis sentence) pair
+        if valid:
+            llcs = self.union_lcs([hyps[idx] for idx in valid], [refs[idx] for idx in valid])
+            for llcs_val, idx in zip(llcs, valid):
+                n = self.num_words(hyps[idx])
+                m = self.num_words(refs[idx])
+                p, r = llcs_val / n, llcs_val / m
+                scores[idx, 2] = (p, r, f_score(p, r))
+
+        return scores
+
+    def score(self, hyp, ref):
+        """Score one summary, in the format of `rouge.Rouge().get_scores(hyp, ref)[0]`."""
+        scores = self.score_batch([hyp], [ref])[0]
+        return {metric: {stat: scores[m, s] for s, stat in enumerate(STATS)} for m, metric in enumerate(METRICS)}
+
+    def num_words(self, text):
+        return len(text.ngrams[1][0]) if self.exclusive else len(text.words)
+
+    def union_lcs(self, hyps, refs):
+        """
+        Sum over the reference sentences of the union LCS with the hypothesis sentences, as computed by
+        `rouge.rouge_score.rouge_l_summary_level`, for every (hyp, ref) pair.
+        """
+        # Flatten all (reference sentence, hypothesis sentence) pairs of the batch
+        xs, ys, owner = [], [], []
+        for text_idx, (hyp, ref) in enumerate(zip(hyps, refs)):
+            for ref_sentence in ref.sentences:
+                for hyp_sentence in hyp.sentences:
+                    xs.append(ref_sentence)
+                    ys.append(hyp_sentence)
+                    owner.append(text_idx)
+        owner = np.asarray(owner, dtype=np.int64)
+
+        llcs = np.zeros(len(hyps))
+        recorded = []
+        # Chunk the pairs so that the LCS tables stay within MAX_LCS_CELLS
+        lengths = np.array([(len(x) + 1) * (len(y) + 1) for x, y in zip(xs, ys)])
+        order = np.argsort(lengths, kind='stable')
+        start = 0
+        while start < len(order):
+            end = start + 1
+            max_x, max_y = len(xs[order[start]]), len(ys[order[start]])
+            while end < len(order):
+                max_x_new = max(max_x, len(xs[order[end]]))
+                max_y_new = max(max_y, len(ys[order[end]]))
+                if (end - start + 1) * (max_x_new + 1) * (max_y_new + 1) > MAX_LCS_CELLS:
+                    break
+                max_x, max_y = max_x_new, max_y_new
+                end += 1
+            chunk = order[start:end]
+            lcs_len, words = lcs_batch([xs[k] for k in chunk], [ys[k] for k in chunk], reconstruct=self.exclusive)
+            if self.exclusive:
+                pair_idx, word_ids = words
+                recorded.append((owner[chunk][pair_idx] << ID_BITS) | word_ids)
+            else:
+                np.add.at(llcs, owner[chunk], lcs_len)
+            start = end
+
+        if self.exclusive and recorded:
+            # The union is a set of words shared by all reference sentences of a text
+            unique = np.unique(np.concatenate(recorded))
+            llcs = np.bincount(unique >> ID_BITS, minlength=len(hyps)).astype(np.float64)
+        return llcs
+
+def lcs_batch(xs, ys, reconstruct=True):
+    """
+    Longest common subsequences of a batch of integer sequences.
+
+    Row i of every table is filled at once: table[i, j] = max_{k <= j} a[k] with
+    a[k] = table[i - 1, k - 1] + 1 if x[i - 1] == y[k - 1] else table[i - 1, k], which equals
+    the usual DP recurrence since a match never scores less than its neighbours.
+
+    Args:
+        xs (list) : First sequences (int64 arrays).
+        ys (list) : Second sequences (int64 arrays).
+        reconstruct (bool) : Also trace the LCS back, with the tie-breaking of `rouge.rouge_score._recon_lcs`.
+
+    Returns:
+        lengths (np.ndarray) : LCS length of every pair.
+        words (tuple) : (pair indices, token ids of `xs`) of the LCS elements if `reconstruct`, else None.
+    """
+    batch_size = len(xs)
+    x_len = np.array([len(x) for x in xs])
+    y_len = np.array([len(y) for y in ys])
+    X = np.full((batch_size, x_len.max()), -1, dtype=np.int64)
+    Y = np.full((batch_size, y_len.max()), -2, dtype=np.int64)
+    for b, (x, y) in enumerate(zip(xs, ys)):
+        X[b, :len(x)] = x
+        Y[b, :len(y)] = y
+
+    table = np.zeros((X.shape[1] + 1, batch_size, Y.shape[1] + 1), dtype=np.int32)
+    for i in range(1, X.shape[1] + 1):
+        a = np.where(X[:, i - 1:i] == Y, table[i - 1, :, :-1] + 1, table[i - 1, :, 1:])
+        np.maximum.accumulate(a, axis=1, out=table[i, :, 1:])
+
+    batch_idx = np.arange(batch_size)
+    lengths = table[x_len, batch_idx, y_len]
+    if not reconstruct:
+        return lengths, None
+
+    # Walk back from (len(x), len(y)) for all pairs at once
+    i, j = x_len.copy(), y_len.copy()
+    pair_idx, word_ids = [], []
+    active = batch_idx[(i > 0) & (j > 0)]
+    while len(active):
+        ii, jj = i[active], j[active]
+        match = X[active, ii - 1] == Y[active, jj - 1]
+        pair_idx.append(active[match])
+        word_ids.append(X[active[match], ii[match] - 1])
+        up = ~match & (table[ii - 1, active, jj] > table[ii, active, jj - 1])
+        i[active[match | up]] -= 1
+        j[active[~up]] -= 1
+        active = active[(i[active] > 0) & (j[active] > 0)]
+
+    if not pair_idx:
+        return lengths, (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    return lengths, (np.concatenate(pair_idx), np.concatenate(word_ids))
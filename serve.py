@@ -0,0 +1,301 @@
+"""
+Serve summaries over HTTP with a model loaded once, decoding concurrent requests together.
+
+    POST /summarize  {"video": "<course>/<video>"}
+                     or {"path": "<features>.npz"}, with the same arrays as the payload below
+                     or {"text": [[300 floats] per sentence], "audio": [[128 floats] per frame],
+                         "images": [[1000 floats] per keyframe], "sentences": [...] (optional)}
+    GET /stats       Queue depth, request and batch counts, latency percentiles.
+    GET /health
+
+A video of the catalog is read by the request's own thread with the datasets of `summarize.py`. A feature
+payload gives the sentence embeddings, the MFCC frames and the ResNet features of the keyframes, inline or
+in a local .npz file (which saves parsing megabytes of JSON).
+The requests are queued and a single batching thread runs the model : it takes the oldest request, waits
+until `--max_wait_ms` after its arrival for more (or takes the ones already waiting when the model was
+busy for longer), pads up to `--max_batch_size` of them into one batch and decodes them together with
+`MMBiDAF.summarize`. Requests beyond `--max_queue` waiting ones are refused with a 503, and requests without a
+summary after `--request_timeout` get a 504 and are dropped from the queue if they are still waiting.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+
+import numpy as np
+import torch
+
+import util
+from args import get_serve_args
+from datasets import collator, final_indices_path
+from summarize import get_datasets, get_video_name, load_summarizer, load_video, select_videos
+
+class SummaryRequest:
+    """A request waiting for its summary, with the padded-batch items of its lecture."""
+    def __init__(self, text, audio, images, sentences=None, video=None):
+        """
+        Args:
+            text (torch.Tensor) : (num_sentences + 1, 300) sentence embeddings, ending with the EOS embedding.
+            audio (torch.Tensor) : (num_frames, 128) MFCC frames.
+            images (torch.Tensor) : (num_keyframes, 1000) ResNet features or (num_keyframes, 3, 256, 256) transformed keyframes.
+            sentences (list) : The processed sentences, to return the text of the summary.
+            video (str) : The '<course>/<video>' name of a video of the catalog.
+        """
+        self.text, self.audio, self.images = text, audio, images
+        self.sentences = sentences
+        self.video = video
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.cancelled = False          # Timed out while waiting, no longer decoded
+        self.result = None
+        self.error = None
+
+def make_payload_request(payload, max_transcript_length=409):
+    """
+    A request from the features of a JSON payload. Its shapes and length are checked so that it cannot fail the batch it
+    joins (`MMBiDAF.summarize` decodes lectures of any length with any beam size).
+    """
+    text, audio, images = (torch.from_numpy(np.asarray(payload[key], dtype=np.float32)) for key in ('text', 'audio', 'images'))
+    if text.dim() != 2 or text.size(1) != 300 or audio.dim() != 2 or audio.size(1) != 128 or images.dim() != 2 or images.size(1) != 1000:
+        raise ValueError('Expected (num_sentences, 300) text, (num_frames, 128) audio and (num_keyframes, 1000) image features')
+    if not len(text) or not len(audio) or not len(images):
+        raise ValueError('Empty text, audio or images')
+    if len(text) >= max_transcript_length:
+        raise ValueError('At most {} sentences per lecture'.format(max_transcript_length - 1))
+    text = torch.cat((text, torch.zeros(1, 300) - 1))                   # End of summary token embedding, as TextDataset
+    sentences = payload.get('sentences')
+    return SummaryRequest(text, audio, images, None if sentences is None else list(sentences))
+
+def percentiles(values, points=(50, 90, 99)):
+    """Percentiles of durations in seconds, in milliseconds."""
+    if not values:
+        return OrderedDict(('p{}'.format(point), None) for point in points)
+    return OrderedDict(('p{}'.format(point), round(1000 * float(value), 2)) for point, value in zip(points, np.percentile(values, points)))
+
+class SummarizationService:
+    """
+    Decodes the queued requests in padded batches, on one thread running the model.
+
+    Args:
+        model (MMBiDAF) : The model, in evaluation mode.
+        device (torch.device) : Device of the model.
+        max_batch_size (int) : Maximum number of requests decoded together.
+        max_wait (float) : Seconds a request may wait for others to join its batch.
+        max_sentences (int) : Maximum number of sentences of a summary.
+        beam_size (int) : Number of hypotheses of the beam search, 1 for greedy decoding.
+        num_candidates (int) : Number of first-stage candidates the decoder points within, all the sentences by default.
+        candidate_scorer (str) : First-stage scorer, see `MMBiDAF.select_candidates`.
+        max_queue (int) : Maximum number of waiting requests.
+        history (int) : Number of latest requests and batches the statistics are computed on.
+    """
+    def __init__(self, model, device, max_batch_size=8, max_wait=0.02, max_sentences=30, beam_size=1, num_candidates=None, candidate_scorer='centrality',
+                 max_queue=256, history=10000):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_sentences = max_sentences
+        self.beam_size = beam_size
+        self.num_candidates = num_candidates
+        self.candidate_scorer = candidate_scorer
+        self.requests = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=history)          # (total, queue wait, decode) seconds of every request
+        self.batch_sizes = deque(maxlen=history)
+        self.num_requests = self.num_errors = self.num_rejected = self.num_timed_out = 0
+        self.start = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request, timeout=None):
+        """
+        Queue a request and wait for its summary. Raises `queue.Full` when too many requests are waiting.
+        A request without a summary after `timeout` seconds is cancelled : if it is still waiting, it is never decoded.
+        """
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            with self.lock:
+                self.num_rejected += 1
+            raise
+        if not request.done.wait(timeout):
+            request.cancelled = True
+            with self.lock:
+                self.num_timed_out += 1
+        return request
+
+    def get_request(self, deadline=None):
+        """The next waiting request that was not cancelled, waiting until the `deadline` time if given (raises `queue.Empty` then)."""
+        while True:
+            if deadline is None:
+                request = self.requests.get()
+            else:
+                timeout = deadline - time.time()
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            if not request.cancelled:
+                return request
+
+    def next_batch(self):
+        """The oldest request and the ones arriving within its latency budget, or already waiting."""
+        batch = [self.get_request()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.get_request(deadline))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            # Transformed keyframes and ResNet features cannot share a batch
+            groups = OrderedDict()
+            for request in batch:
+                groups.setdefault(request.images.dim(), []).append(request)
+            for group in groups.values():
+                self.decode(group)
+
+    def decode(self, batch):
+        start = time.time()
+        try:
+            batch_text, text_lengths = collator([(request.text,) for request in batch])
+            batch_audio, audio_lengths = collator([(request.audio,) for request in batch])
+            batch_images, image_lengths = collator([(request.images,) for request in batch])
+            with torch.no_grad():
+                summaries = self.model.summarize(batch_text.to(self.device), text_lengths, batch_audio.to(self.device), audio_lengths,
+                                                 batch_images.to(self.device), image_lengths, self.max_sentences, self.beam_size,
+                                                 self.num_candidates, self.candidate_scorer)
+            for request, (indices, log_prob) in zip(batch, summaries):
+                result = OrderedDict([('video', request.video), ('indices', indices), ('log_prob', log_prob)])
+                if request.sentences is not None:
+                    result['sentences'] = [request.sentences[k] for k in indices if k < len(request.sentences)]
+                request.result = result
+        except Exception as e:
+            logging.error('Unable to summarize a batch of {} requests. Exception: {}'.format(len(batch), e))
+            for request in batch:
+                request.error = str(e)
+        end = time.time()
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+            for request in batch:
+                self.latencies.append((end - request.arrival, start - request.arrival, end - start))
+                self.num_requests += 1
+                self.num_errors += request.error is not None
+        for request in batch:
+            request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            counts = self.num_requests, self.num_errors, self.num_rejected, self.num_timed_out
+        total, wait, decode = zip(*latencies) if latencies else ((), (), ())
+        return OrderedDict([('queue_depth', self.requests.qsize()),
+                            ('requests', counts[0]),
+                            ('errors', counts[1]),
+                            ('rejected', counts[2]),
+                            ('timed_out', counts[3]),
+                            ('batches', len(batch_sizes)),
+                            ('mean_batch_size', float(np.mean(batch_sizes)) if batch_sizes else None),
+                            ('requests_per_sec', counts[0] / (time.time() - self.start)),
+                            ('latency_ms', percentiles(total)),
+                            ('queue_wait_ms', percentiles(wait)),
+                            ('decode_ms', percentiles(decode))])
+
+class SummarizationHandler(BaseHTTPRequestHandler):
+    """The HTTP endpoints of the `SummarizationService` of the server."""
+    def send_json(self, status, body):
+        data = dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.service.stats())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'Unknown endpoint ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/summarize':
+            self.send_json(404, {'error': 'Unknown endpoint ' + self.path})
+            return
+        try:
+            payload = loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            request = self.make_request(payload)
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            self.server.service.submit(request, self.server.request_timeout)
+        except queue.Full:
+            self.send_json(503, {'error': 'Too many requests waiting'})
+            return
+        if request.error is not None:
+            self.send_json(500, {'error': request.error})
+        elif request.result is None:
+            self.send_json(504, {'error': 'No summary after {}s'.format(self.server.request_timeout)})
+        else:
+            self.send_json(200, request.result)
+
+    def make_request(self, payload):
+        max_transcript_length = self.server.service.model.max_transcript_length
+        if 'path' in payload:
+            with np.load(payload['path'], allow_pickle=False) as arrays:
+                return make_payload_request({key: arrays[key] for key in arrays.files}, max_transcript_length)
+        if 'video' not in payload:
+            return make_payload_request(payload, max_transcript_length)
+        datasets = self.server.datasets
+        if datasets is None:
+            raise ValueError('No catalog ({}) to read videos from, send their features'.format(final_indices_path))
+        idx = select_videos(datasets[0], videos={payload['video']})[0]
+        sentences, (text, _), (audio, _), (images, _) = load_video(datasets, idx)
+        return SummaryRequest(text, audio, images, sentences, get_video_name(datasets[0].text_embedding_paths[idx]))
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+def main(args, model_kwargs):
+    torch.set_num_threads(args.num_threads)
+    start = time.time()
+    model = load_summarizer(model_kwargs, args.load_path)
+    image_features = None
+    if args.image_features:
+        # The cached features of the checkpoint's own ResNet weights, see evaluate.py
+        from keyframe_dedup import get_resnet_state, weights_fingerprint
+        image_features = weights_fingerprint(get_resnet_state(args.load_path))
+    datasets = None
+    if os.path.exists(final_indices_path):
+        datasets = get_datasets(args.courses_dir, model_kwargs['max_transcript_length'], image_features)
+    print('Loaded {} in {:.1f}s, {}'.format(args.load_path, time.time() - start,
+          'serving {} videos of the catalog and feature payloads'.format(len(datasets[0])) if datasets is not None else 'serving feature payloads'))
+
+    service = SummarizationService(model, model_kwargs['device'], args.max_batch_size, args.max_wait_ms / 1000,
+                                   args.max_sentences, args.beam_size, args.num_candidates, args.candidate_scorer, args.max_queue)
+    server = ThreadingHTTPServer((args.host, args.port), SummarizationHandler)
+    server.daemon_threads = True
+    server.service, server.datasets, server.request_timeout = service, datasets, args.request_timeout
+    print('Listening on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Stats: {}'.format(dumps(service.stats(), indent=4)))
+
+if __name__ == '__main__':
+    args = get_serve_args()
+    device = util.get_available_devices()[0]
+    model_kwargs = dict(hidden_size=args.hidden_size, text_embedding_size=300, audio_embedding_size=128, image_embedding_size=1000,
+                        device=device, drop_prob=0.2, max_transcript_length=409)
+    main(args, model_kwargs)
@@ -0,0 +1,168 @@
+"""
+Summarize lectures with a trained checkpoint, without ground-truth summaries.
+
+The videos (of the catalog read by the datasets, see `ingest.py`) are sorted by the size of their processed
+transcripts and cut into batches of similar sizes, so little of every batch is padding. The batches are
+spread over `--num_workers` processes, each with its own copy of the model, and decoded greedily or with a
+beam search (`MMBiDAF.summarize`) until the EOS sentence or `--max_sentences`, over all the sentences or, with
+`--num_candidates`, over the best candidates of a first-stage scorer (see `candidates.py`). Every summary is appended
+to `--out_file` as one JSON line as soon as its batch is done :
+    {"video": "<course>/<video>", "indices": [...], "sentences": [...], "text": [...], "log_prob": ...}
+with the selected sentence indices, their processed sentences and the original transcript lines.
+"""
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from json import dumps
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import util
+from args import get_summarize_args
+from datasets import AudioDataset, ImageDataset, TextDataset, collator, get_image_collator
+from evaluate import get_eval_transform, get_transcript_paths
+from models import MMBiDAF
+
+def get_video_name(embedding_path):
+    """The 'course/video' name of a sentence embedding path, as in the catalog."""
+    course_path, fname = os.path.split(os.path.dirname(embedding_path))[0], os.path.basename(embedding_path)
+    return os.path.basename(course_path) + '/' + fname[:-len('.pt')]
+
+def get_batches(text_dataset, indices, batch_size):
+    """Cut `indices` into batches of videos of similar transcript sizes, the largest first."""
+    transcript_paths = get_transcript_paths(text_dataset.text_embedding_paths)
+    indices = sorted(indices, key=lambda idx: os.path.getsize(transcript_paths[idx]), reverse=True)
+    return [indices[start:start + batch_size] for start in range(0, len(indices), batch_size)]
+
+def get_original_lines(transcript_path):
+    """The original transcript line of every processed sentence (the first one for repeated sentences)."""
+    with open(transcript_path, 'rb') as f:
+        lines = OrderedDict()
+        for sentence, line in pickle.load(f):
+            lines.setdefault(sentence, line)
+    return lines
+
+def load_summarizer(model_kwargs, checkpoint_path):
+    """Build the model and load the (EMA) weights of a checkpoint, in evaluation mode."""
+    model = nn.DataParallel(MMBiDAF(**model_kwargs), [])
+    model = util.load_model(model, checkpoint_path, model_kwargs['device'], [], return_step=False)
+    return model.module.to(model_kwargs['device']).eval()
+
+def load_video(datasets, idx):
+    """The sentences of a video and its text, audio and image items."""
+    text_dataset, audio_dataset, image_dataset = datasets
+    sentences, word_vectors, length = text_dataset.get_with_sentences(idx)
+    return sentences, (word_vectors, length), audio_dataset[idx], image_dataset[idx]
+
+# Model and data of a summarization process, set once by `init_summarize_worker`
+worker_state = {}
+
+def init_summarize_worker(model_kwargs, checkpoint_path, datasets, max_sentences, beam_size, num_threads, num_candidates=None, candidate_scorer='centrality'):
+    """Pool initializer : build and load this process' own copy of the model once."""
+    torch.set_num_threads(num_threads)
+    worker_state.update(model=load_summarizer(model_kwargs, checkpoint_path), device=model_kwargs['device'], datasets=datasets,
+                        image_collator=get_image_collator(datasets[2]), max_sentences=max_sentences, beam_size=beam_size,
+                        num_candidates=num_candidates, candidate_scorer=candidate_scorer)
+
+def summarize_batch(indices):
+    """
+    Summarize one batch of videos.
+
+    Returns:
+        records (list) : The summary of every video of the batch, as an OrderedDict.
+    """
+    text_dataset = worker_state['datasets'][0]
+    device = worker_state['device']
+    sentences, text_items, audio_items, image_items = zip(*[load_video(worker_state['datasets'], idx) for idx in indices])
+    batch_text, text_lengths = collator(text_items)
+    batch_audio, audio_lengths = collator(audio_items)
+    batch_images, image_lengths = worker_state['image_collator'](image_items)
+
+    with torch.no_grad():
+        summaries = worker_state['model'].summarize(batch_text.to(device), text_lengths, batch_audio.to(device), audio_lengths,
+                                                    batch_images.to(device), image_lengths, worker_state['max_sentences'], worker_state['beam_size'],
+                                                    worker_state['num_candidates'], worker_state['candidate_scorer'])
+
+    records = []
+    for idx, video_sentences, (summary_indices, log_prob) in zip(indices, sentences, summaries):
+        embedding_path = text_dataset.text_embedding_paths[idx]
+        lines = get_original_lines(get_transcript_paths([embedding_path])[0])
+        selected = [video_sentences[k] for k in summary_indices]
+        records.append(OrderedDict([('video', get_video_name(embedding_path)), ('indices', summary_indices), ('sentences', selected),
+                                    ('text', [lines.get(sentence, sentence) for sentence in selected]), ('log_prob', log_prob)]))
+    return records
+
+def run_summarize_batch(indices):
+    try:
+        return indices, summarize_batch(indices), None
+    except Exception as e:
+        return indices, [], str(e)
+
+def select_videos(text_dataset, videos=(), courses=()):
+    """Dataset indices of the requested 'course/video' videos and of the videos of the requested courses, all of them by default."""
+    names = [get_video_name(path) for path in text_dataset.text_embedding_paths]
+    if not videos and not courses:
+        return list(range(len(names)))
+    missing = set(videos) - set(names)
+    if missing:
+        raise ValueError('Videos not in the catalog (run ingest.py first) : {}'.format(', '.join(sorted(missing))))
+    return [idx for idx, name in enumerate(names) if name in videos or name.split('/')[0] in courses]
+
+def get_datasets(courses_dir, max_text_length, image_features=None, packed_keyframes=False):
+    """The text, audio and image datasets, with a deterministic image transform (see `evaluate.get_datasets`)."""
+    return (TextDataset(courses_dir, max_text_length), AudioDataset(courses_dir),
+            ImageDataset(courses_dir, get_eval_transform(), features=image_features, packed=packed_keyframes))
+
+def main(args, model_kwargs):
+    datasets = get_datasets(args.courses_dir, model_kwargs['max_transcript_length'], packed_keyframes=args.packed_keyframes)
+    text_dataset = datasets[0]
+    indices = select_videos(text_dataset, set(args.videos), set(args.courses))
+    batches = get_batches(text_dataset, indices, args.batch_size)
+    decoding = 'greedy decoding' if args.beam_size == 1 else 'a beam search of {} hypotheses'.format(args.beam_size)
+    if args.num_candidates is not None:
+        decoding += ' within {} {} candidates'.format(args.num_candidates, args.candidate_scorer)
+    print('Summarizing {} videos in {} batches with {} processes of {} threads, {}'.format(
+        len(indices), len(batches), args.num_workers, args.threads_per_worker, decoding))
+
+    initargs = (model_kwargs, args.load_path, datasets, args.max_sentences, args.beam_size, args.threads_per_worker, args.num_candidates, args.candidate_scorer)
+    num_workers = min(args.num_workers, len(batches))
+    start = time.time()
+    num_done = 0
+    if num_workers > 1:
+        pool = mp.get_context('spawn').Pool(num_workers, initializer=init_summarize_worker, initargs=initargs)
+        results = pool.imap_unordered(run_summarize_batch, batches)
+    else:
+        pool = None
+        init_summarize_worker(*initargs)
+        results = map(run_summarize_batch, batches)
+    os.makedirs(os.path.dirname(args.out_file) or '.', exist_ok=True)
+    try:
+        with open(args.out_file, 'w') as f:
+            for batch, records, error in results:
+                if error is not None:
+                    logging.error('Unable to summarize the batch of videos {}. Exception: {}'.format(batch, error))
+                    continue
+                for record in records:
+                    f.write(dumps(record) + '\n')
+                f.flush()
+                num_done += len(records)
+                print('{}/{} videos, {:.2f} lectures/sec'.format(num_done, len(indices), num_done / (time.time() - start)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    print('Summarized {} of {} videos in {:.1f}s ({:.2f} lectures/sec), written to {}'.format(
+        num_done, len(indices), elapsed, num_done / max(elapsed, 1e-9), args.out_file))
+
+if __name__ == '__main__':
+    args = get_summarize_args()
+    device = util.get_available_devices()[0]
+    model_kwargs = dict(hidden_size=args.hidden_size, text_embedding_size=300, audio_embedding_size=128, image_embedding_size=1000,
+                        device=device, drop_prob=0.2, max_transcript_length=409)
+    main(args, model_kwargs)
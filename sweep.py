@@ -0,0 +1,145 @@
+"""
+Evaluate every checkpoint saved by a training run on the same videos.
+
+The evaluation inputs (the text, audio, image and target items of every video, the transcript
+sentences and the tokenized ground truths) are read once and shared by the evaluation processes,
+each of which builds its model once and loads the checkpoints it is given one after the other.
+
+Usage:
+    python sweep.py --sweep_dir ./save/train/temp-01 --split val
+"""
+import glob
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from json import dumps
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import evaluate
+import util
+from args import get_sweep_args
+from datasets import PreloadedDataset
+from models import MMBiDAF
+
+def get_checkpoint_paths(save_dir):
+    """The step_*.pth.tar checkpoints of `save_dir`, by increasing step."""
+    paths = glob.glob(os.path.join(save_dir, 'step_*.pth.tar'))
+    return sorted(paths, key=lambda path: int(re.search(r'step_(\d+)', os.path.basename(path)).group(1)))
+
+def preload_inputs(datasets, indices, num_workers=0):
+    """
+    Read everything the evaluation of a checkpoint needs from disk, once.
+
+    Returns:
+        datasets (tuple) : The text, audio, image and target items of the videos, as `PreloadedDataset`s.
+        sentences (dict) : Transcript path -> source sentences, for the generated summaries.
+        scorer (RougeScorer) : The ROUGE scorer of `evaluate`, with every ground truth tokenized.
+    """
+    datasets = tuple(PreloadedDataset(dataset, indices, num_workers) for dataset in datasets)
+    sentences = {}
+    for idx in indices:
+        _, source_path, target_path, _ = datasets[3][idx]
+        transcript_path = evaluate.get_transcript_paths([source_path])[0]
+        sentences[transcript_path] = evaluate.load_source_sentences(transcript_path)
+        evaluate.rouge_scorer.reference(target_path)
+    return datasets, sentences, evaluate.rouge_scorer
+
+# Model and inputs of a sweep process, set once by `init_sweep_worker`
+worker_state = {}
+
+def init_sweep_worker(model_kwargs, inputs, indices, batch_size, num_threads):
+    """Pool initializer : install the preloaded inputs and build this process' model once."""
+    torch.set_num_threads(num_threads)
+    datasets, sentences, scorer = inputs
+    evaluate.preloaded_sentences.update(sentences)
+    evaluate.rouge_scorer = scorer
+    device = model_kwargs['device']
+    worker_state.update(model=nn.DataParallel(MMBiDAF(**model_kwargs), []).to(device), device=device,
+                        data_loaders=evaluate.get_loaders(datasets, indices, batch_size))
+
+def evaluate_checkpoint(checkpoint_path):
+    """
+    Returns:
+        result (OrderedDict) : Checkpoint path, step, running time and the scores of `evaluate.validate`
+                               (only the path and the error if the evaluation failed).
+    """
+    start = time.time()
+    try:
+        model, step = util.load_model(worker_state['model'], checkpoint_path, worker_state['device'], [])
+        scores = evaluate.validate(model, worker_state['data_loaders'], worker_state['device'])
+    except Exception as e:
+        logging.error('Unable to evaluate {}. Exception: {}'.format(checkpoint_path, e))
+        return OrderedDict([('checkpoint', checkpoint_path), ('error', str(e))])
+    return OrderedDict([('checkpoint', checkpoint_path), ('step', step), ('seconds', time.time() - start)]
+                       + [(name, float(score)) for name, score in scores.items()])
+
+def format_table(results):
+    """Tab separated metric-vs-step table, with a last row giving the best step of every metric."""
+    names = ['NLL'] + list(evaluate.METRIC_NAMES)
+    lines = ['\t'.join(['step'] + names)]
+    for result in results:
+        lines.append('\t'.join([str(result['step'])] + ['{:.4f}'.format(result[name]) for name in names]))
+    if results:
+        best = [min(results, key=lambda result: result[name]) if name == 'NLL' else max(results, key=lambda result: result[name])
+                for name in names]
+        lines.append('\t'.join(['best'] + [str(result['step']) for result in best]))
+    return '\n'.join(lines) + '\n'
+
+def main(args, model_kwargs):
+    # Next to the sweep tables, without appending to the log.txt of the training run
+    log = util.get_logger(args.sweep_dir, 'sweep', file_name='sweep_{}.log'.format(args.split))
+    log.info(f'Args: {dumps(vars(args), indent=4, sort_keys=True)}')
+
+    checkpoint_paths = get_checkpoint_paths(args.sweep_dir)
+    if not checkpoint_paths:
+        raise ValueError('No step_*.pth.tar checkpoint in {}'.format(args.sweep_dir))
+
+    start = time.time()
+    datasets = evaluate.get_datasets(args.courses_dir, model_kwargs['max_transcript_length'], packed_keyframes=args.packed_keyframes)
+    indices = evaluate.get_indices(datasets[0], args.split, args.seed)
+    inputs = preload_inputs(datasets, indices, args.num_workers)
+    log.info('Preloaded {} {} videos in {:.1f}s'.format(len(indices), args.split, time.time() - start))
+
+    num_workers = max(1, min(args.eval_workers, len(checkpoint_paths)))
+    num_threads = args.threads_per_worker or max(1, os.cpu_count() // num_workers)
+    log.info('Evaluating {} checkpoints with {} processes of {} threads...'.format(len(checkpoint_paths), num_workers, num_threads))
+    initargs = (model_kwargs, inputs, indices, args.batch_size, num_threads)
+    start = time.time()
+    if num_workers > 1:
+        with mp.get_context('spawn').Pool(num_workers, initializer=init_sweep_worker, initargs=initargs) as pool:
+            results = list(pool.imap_unordered(evaluate_checkpoint, checkpoint_paths))
+    else:
+        init_sweep_worker(*initargs)
+        results = [evaluate_checkpoint(checkpoint_path) for checkpoint_path in checkpoint_paths]
+    log.info('Evaluated {} checkpoints in {:.1f}s'.format(len(checkpoint_paths), time.time() - start))
+
+    failed = [result['checkpoint'] for result in results if 'error' in result]
+    if failed:
+        log.warning('Could not evaluate {}'.format(failed))
+    results = sorted([result for result in results if 'error' not in result], key=lambda result: result['step'])
+
+    table = format_table(results)
+    table_path = os.path.join(args.sweep_dir, 'sweep_{}.tsv'.format(args.split))
+    with open(table_path, 'w') as f:
+        f.write(table)
+    with open(os.path.join(args.sweep_dir, 'sweep_{}.json'.format(args.split)), 'w') as f:
+        f.write(dumps(results, indent=4))
+    log.info('Scores by step (saved to {}):\n{}'.format(table_path, table))
+    return results
+
+if __name__ == '__main__':
+    text_embedding_size = 300
+    audio_embedding_size = 128
+    image_embedding_size = 1000
+    drop_prob = 0.2
+    max_text_length = 409
+    args = get_sweep_args()
+    device = util.get_available_devices()[0]
+    model_kwargs = dict(hidden_size=args.hidden_size, text_embedding_size=text_embedding_size, audio_embedding_size=audio_embedding_size,
+                        image_embedding_size=image_embedding_size, device=device, drop_prob=drop_prob, max_transcript_length=max_text_length)
+    main(args, model_kwargs)
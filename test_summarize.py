@@ -0,0 +1,64 @@
+"""
+Regression checks of the target-free decoding (`MMBiDAF.summarize`) of its service and of live summarization, run with `python -m pytest test_summarize.py`.
+"""
+import threading
+
+import pytest
+import torch
+
+from datasets import collator
+from live import LiveSummarizer
+from models import MMBiDAF
+from serve import SummarizationService, make_payload_request
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    return MMBiDAF(hidden_size=16, text_embedding_size=300, audio_embedding_size=128, image_embedding_size=1000,
+                   device=torch.device('cpu'), max_transcript_length=409).eval()
+
+def random_batch(text_lengths, num_frames=20, num_keyframes=3):
+    """A padded batch of random lectures with ResNet features, every transcript ending with the EOS embedding."""
+    texts = [torch.cat((torch.randn(length - 1, 300), torch.zeros(1, 300) - 1)) for length in text_lengths]
+    text, text_lengths = collator([(item,) for item in texts])
+    audio, audio_lengths = collator([(torch.randn(num_frames, 128),) for _ in texts])
+    images, image_lengths = collator([(torch.randn(num_keyframes, 1000),) for _ in texts])
+    return text, text_lengths, audio, audio_lengths, images, image_lengths
+
+@pytest.mark.parametrize('beam_size', [1, 2, 5, 12])
+def test_beam_wider_than_shortest_lecture(model, beam_size):
+    batch = random_batch([10, 3, 7])
+    with torch.no_grad():
+        summaries = model.summarize(*batch, 8, beam_size)
+    for (indices, log_prob), length in zip(summaries, batch[1]):
+        assert all(0 <= idx < length - 1 for idx in indices)
+        assert log_prob > float('-inf')
+
+def random_payload(num_sentences, num_frames=20, num_keyframes=3):
+    return {'text': torch.randn(num_sentences, 300).numpy(), 'audio': torch.randn(num_frames, 128).numpy(),
+            'images': torch.randn(num_keyframes, 1000).numpy()}
+
+def test_service_batches_short_payloads_and_skips_cancelled(model):
+    service = SummarizationService(model, torch.device('cpu'), max_batch_size=4, max_wait=0.2, max_sentences=8, beam_size=5)
+    cancelled = make_payload_request(random_payload(6))
+    cancelled.cancelled = True
+    service.requests.put(cancelled)
+    requests = [make_payload_request(random_payload(num_sentences)) for num_sentences in (2, 9)]
+    threads = [threading.Thread(target=service.submit, args=(request, 60)) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(request.error is None and request.result is not None for request in requests)
+    assert cancelled.result is None and cancelled.error is None
+    assert service.stats()['requests'] == 2
+
+def test_live_beam_and_decoder_memory(model):
+    live = LiveSummarizer(model, decoder_memory=6, beam_size=5)
+    for num_sentences in (3, 4, 4):
+        live.update(torch.randn(num_sentences, 300), list(range(live.num_sentences, live.num_sentences + num_sentences)),
+                    torch.randn(10, 128), torch.randn(1, 1000))
+        summary = live.summarize()
+        assert all(live.num_sentences - len(live.sentences) <= idx < live.num_sentences for idx in summary['indices'])
+        assert summary['sentences'] == summary['indices']
+    assert len(live.sentences) == 6 and live.num_sentences == 11
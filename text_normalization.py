@@ -0,0 +1,77 @@
+"""
+Text normalization shared by the preprocessing, the datasets and the ROUGE scripts.
+
+Transcripts and ground-truth summaries are all cleaned the same way : timestamp lines and [MUSIC]
+tags are dropped, the text is split into sentences, each sentence is lower-cased, tokenized with
+NLTK's `TweetTokenizer` and stripped of English stop words. A sentence is blank when none of its
+lemmatized tokens is in the vocabulary.
+
+The stop words are a frozenset and lemmas/stems are memoized per token, since lecture transcripts
+reuse a small vocabulary over and over.
+"""
+import re
+
+from functools import lru_cache
+from nltk import PorterStemmer
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize import sent_tokenize, TweetTokenizer
+
+# Maximum number of memoized lemmas and stems
+CACHE_SIZE = 2 ** 18
+
+tweet_tokenizer = TweetTokenizer()
+lemmatizer = WordNetLemmatizer()
+stemmer = PorterStemmer()
+
+@lru_cache(maxsize=None)
+def get_stop_words(language='english'):
+    """The NLTK stop words of `language`, as a frozenset (read on first use)."""
+    return frozenset(stopwords.words(language))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def lemmatize(token):
+    return lemmatizer.lemmatize(token)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def stem(token):
+    return stemmer.stem(token)
+
+def clean_lines(lines):
+    """Drop the timestamp lines of a transcript and its [MUSIC] tags, and strip the other lines."""
+    return [line.replace('[MUSIC]', '').strip() for line in lines if re.match(r'\d+:\d+', line) is None]
+
+def read_transcript(path):
+    """The cleaned lines of a transcript or ground-truth file, see `clean_lines`."""
+    with open(path) as f:
+        return clean_lines(f)
+
+def tokenize(sentence, stop_words=None):
+    """Lower-case and tokenize a sentence, dropping the stop words."""
+    stop_words = get_stop_words() if stop_words is None else stop_words
+    return [word for word in tweet_tokenizer.tokenize(sentence.lower()) if word not in stop_words]
+
+def tokenize_sentences(sentences, stop_words=None):
+    """Batch version of `tokenize`."""
+    stop_words = get_stop_words() if stop_words is None else stop_words
+    return [tokenize(sentence, stop_words) for sentence in sentences]
+
+def normalize_text(text, stop_words=None):
+    """Split a text into sentences and tokenize each of them, see `tokenize`."""
+    return tokenize_sentences(sent_tokenize(text), stop_words)
+
+def is_blank_sentence(tokens, words_set):
+    """A sentence is blank if none of its lemmatized tokens is in `words_set`."""
+    return not any(lemmatize(token) in words_set for token in tokens)
+
+def blank_sentences(sentences, words_set):
+    """Batch version of `is_blank_sentence`, over lists of tokens."""
+    return [is_blank_sentence(tokens, words_set) for tokens in sentences]
+
+def stem_line(line):
+    """Stem every whitespace separated token of a line."""
+    return ' '.join(stem(token) for token in line.split())
+
+def stem_lines(lines):
+    """Batch version of `stem_line`."""
+    return [stem_line(line) for line in lines]
@@ -6,6 +6,7 @@ import logging
 import os
 import pickle
 import random
+import time
 from collections import OrderedDict
 from json import dumps
 
@@ -30,16 +31,26 @@ from nltk.tokenize import sent_tokenize
 
 import util
 from args import get_train_args
-from evaluate import get_generated_summaries
+from evaluate import AsyncValidator
+from profiling import StageProfiler
 
 def main(course_dir, text_embedding_size, audio_embedding_size, image_embedding_size, hidden_size, drop_prob, max_text_length, out_heatmaps_dir, args, batch_size=3, num_epochs=100):
+    # Set up distributed training (no-op unless launched with torchrun)
+    rank, world_size = util.init_distributed(args.dist_backend)
+    is_main = util.is_main_process()
+
     # Set up logging and devices
-    args.save_dir = util.get_save_dir(args.save_dir, args.name, training=True)
-    log = util.get_logger(args.save_dir, args.name)
-    tbx = SummaryWriter(args.save_dir)
+    if is_main:
+        args.save_dir = util.get_save_dir(args.save_dir, args.name, training=True)
+    args.save_dir = util.broadcast_object(args.save_dir)
+    log = util.get_logger(args.save_dir, args.name, rank)
+    tbx = SummaryWriter(args.save_dir) if is_main else None
     device, args.gpu_ids = util.get_available_devices()
     log.info(f'Args: {dumps(vars(args), indent=4, sort_keys=True)}')
-    args.batch_size *= max(1, len(args.gpu_ids))
+    if world_size > 1:
+        log.info(f'Distributed training with {world_size} processes ({args.dist_backend})')
+    else:
+        args.batch_size *= max(1, len(args.gpu_ids))
 
     # Set random seed
     log.info(f'Using random seed {args.seed}...')
@@ -55,32 +66,33 @@ def main(course_dir, text_embedding_size, audio_embedding_size, image_embedding_
     # Preprocess the image in prescribed format
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     transform = transforms.Compose([transforms.RandomResizedCrop(256), transforms.RandomHorizontalFlip(), transforms.ToTensor(), normalize,])
-    image_dataset = ImageDataset(course_dir, transform)
+    # Packed keyframes get the same transform as tensor operations on whole batches
+    image_dataset = ImageDataset(course_dir, transform, packed=args.packed_keyframes)
 
     assert len(text_dataset) == len(audio_dataset) and len(audio_dataset) == len(image_dataset) and len(image_dataset) == len(target_dataset), "Unequal dataset lengths"
 
-    # Creating data indices for training and validation splits:
+    # Creating data indices for training and validation splits (identical on every rank since the seed is shared):
     train_indices, val_indices = gen_train_val_indices(text_dataset)
 
-    # Creating PT data samplers and loaders:
-    train_sampler = torch.utils.data.SequentialSampler(train_indices)
-    val_sampler = torch.utils.data.SequentialSampler(val_indices)
+    # Creating PT data samplers and loaders, each rank reads its own shard of the training indices
+    # (the validation indices are loaded by the validation process):
+    train_sampler = ShardedIndexSampler(train_indices, num_replicas=world_size, rank=rank, shuffle=True, seed=args.seed)
+
+    # Worker seeds are drawn from this generator rather than the global RNG, so creating
+    # the loader iterators does not shift the model's RNG stream when resuming mid-epoch
+    loader_generator = torch.Generator()
 
     # Get sentence embeddings
-    train_text_loader = torch.utils.data.DataLoader(text_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=train_sampler)
-    val_text_loader = torch.utils.data.DataLoader(text_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=val_sampler)
+    train_text_loader = torch.utils.data.DataLoader(text_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=train_sampler, generator=loader_generator)
 
     # Get Audio embeddings
-    train_audio_loader = torch.utils.data.DataLoader(audio_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=train_sampler)
-    val_audio_loader = torch.utils.data.DataLoader(audio_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=val_sampler)
+    train_audio_loader = torch.utils.data.DataLoader(audio_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=train_sampler, generator=loader_generator)
 
     # Get images
-    train_image_loader = torch.utils.data.DataLoader(image_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=train_sampler)
-    val_image_loader = torch.utils.data.DataLoader(image_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=collator, sampler=val_sampler)
+    train_image_loader = torch.utils.data.DataLoader(image_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=get_image_collator(image_dataset, train=True), sampler=train_sampler, generator=loader_generator)
 
     # Load Target text
-    train_target_loader = torch.utils.data.DataLoader(target_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=target_collator, sampler=train_sampler)
-    val_target_loader = torch.utils.data.DataLoader(target_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=target_collator, sampler=val_sampler)
+    train_target_loader = torch.utils.data.DataLoader(target_dataset, batch_size=batch_size, shuffle=False, num_workers=2, collate_fn=target_collator, sampler=train_sampler, generator=loader_generator)
 
     # print("lens - train_text_loader {}, val_text_loader {}".format(len(train_text_loader), len(val_text_loader)))
     # print("lens - train_audio_loader {}, val_audio_loader {}".format(len(train_audio_loader), len(val_audio_loader)))
@@ -88,44 +100,97 @@ def main(course_dir, text_embedding_size, audio_embedding_size, image_embedding_
     # print("lens - train_target_loader {}, val_target_loader {}".format(len(train_target_loader), len(val_target_loader)))
 
     # Create model
-    model = MMBiDAF(hidden_size, text_embedding_size, audio_embedding_size, image_embedding_size, device, drop_prob, max_text_length)
-    model = nn.DataParallel(model, args.gpu_ids)
+    model_kwargs = dict(hidden_size=hidden_size, text_embedding_size=text_embedding_size, audio_embedding_size=audio_embedding_size,
+                        image_embedding_size=image_embedding_size, device=device, drop_prob=drop_prob, max_transcript_length=max_text_length)
+    model = MMBiDAF(**model_kwargs, checkpoint_activations=args.checkpoint_activations)
+    if world_size > 1:
+        model = nn.parallel.DistributedDataParallel(model)
+    else:
+        model = nn.DataParallel(model, args.gpu_ids)
     if args.load_path:
         log.info(f'Loading checkpoint from {args.load_path}...')
-        model, step = util.load_model(model, args.load_path, args.gpu_ids)
+        model, step = util.load_model(model, args.load_path, device, args.gpu_ids, use_ema=False)
+        train_state, ema_state = util.load_training_state(args.load_path, device)
     else:
         step = 0
+        train_state, ema_state = None, None
     model = model.to(device)
     model.train()
-    ema = util.EMA(model, args.ema_decay)           # For exponential moving average
 
-    # Get saver
-    saver = util.CheckpointSaver(args.save_dir,
-                                 max_checkpoints=args.max_checkpoints,
-                                 metric_name=args.metric_name,
-                                 maximize_metric=args.maximize_metric,
-                                 log=log)           # Need to change the metric name
+    # Per-stage profile of the forward passes of the main process
+    profiler = None
+    if args.profile and is_main:
+        profiler = StageProfiler(cuda=device.type == 'cuda')
+        model.module.set_profiler(profiler)
+
+    # EMA and checkpoints are only kept by rank 0, the replicas hold identical weights
+    if is_main:
+        ema = util.EMA(model, args.ema_decay)           # For exponential moving average
+        if ema_state is not None:
+            ema.load_state_dict(ema_state)
+
+        # Get saver
+        saver = util.CheckpointSaver(args.save_dir,
+                                     max_checkpoints=args.max_checkpoints,
+                                     metric_name=args.metric_name,
+                                     maximize_metric=args.maximize_metric,
+                                     log=log)
+
+        # Validation runs on EMA weight snapshots in its own process
+        validator = AsyncValidator(model_kwargs, (text_dataset, audio_dataset, image_dataset, target_dataset),
+                                   val_indices, batch_size, num_threads=args.val_num_threads)
 
     # Get optimizer and scheduler
     optimizer = optim.Adadelta(model.parameters(), args.lr, weight_decay=args.l2_wd)
     scheduler = sched.LambdaLR(optimizer, lambda s: 1.)  # Constant LR
 
+    # Restore the optimizer, scheduler, RNG and the position in the interrupted epoch
+    if train_state is not None:
+        optimizer.load_state_dict(train_state['optimizer'])
+        scheduler.load_state_dict(train_state['scheduler'])
+        rng_states = train_state['rng_states']
+        if len(rng_states) != world_size:
+            log.warning(f'Checkpoint was saved with {len(rng_states)} processes, resuming with {world_size}')
+        util.set_rng_state(rng_states[rank % len(rng_states)])
+        epoch = train_state['epoch'] - 1
+        start_sample = train_state['samples_done'] if len(rng_states) == world_size else 0
+        steps_till_eval = train_state['steps_till_eval']
+        log.info(f'Resuming epoch {epoch + 1} after {start_sample} samples per process...')
+    else:
+        epoch = step // len(text_dataset)
+        start_sample = 0
+        steps_till_eval = args.eval_steps
+
+    def report_validation(results):
+        """Log validation scores and pass the chosen metric to the saver."""
+        for val_step, scores in results:
+            if scores is None:
+                saver.report(val_step, None)
+                continue
+            log.info(f'Dev scores at step {val_step}: ' + ', '.join(f'{k}: {v:05.4f}' for k, v in scores.items()))
+            for k, v in scores.items():
+                tbx.add_scalar(f'dev/{k}', v, val_step)
+            saver.report(val_step, scores[args.metric_name])
+
     # Let's do this!
     loss = 0
     eps = 1e-8
     log.info("Training...")
-    steps_till_eval = args.eval_steps
-    epoch = step // len(TextDataset(course_dir, max_text_length))
 
     while epoch != args.num_epochs:
         epoch += 1
-        log.info("Starting epoch {epoch}...")
+        train_sampler.set_epoch(epoch, start=start_sample)
+        loader_generator.manual_seed(args.seed + epoch)
+        log.info(f"Starting epoch {epoch}...")
         count_item = 0
+        samples_done = start_sample
+        start_sample = 0
         loss_epoch = 0
-        with torch.enable_grad(), tqdm(total=len(train_text_loader.dataset)) as progress_bar:
+        epoch_start = time.time()
+        with torch.enable_grad(), tqdm(total=len(train_sampler) * world_size, disable=not is_main) as progress_bar:
             for (batch_text, original_text_lengths), (batch_audio, original_audio_lengths), (batch_images, original_img_lengths), (batch_target_indices, batch_source_paths, batch_target_paths, original_target_len) in zip(train_text_loader, train_audio_loader, train_image_loader, train_target_loader):
                 loss = 0
-                max_dec_len = torch.max(original_target_len)             # TODO check error : max decoder timesteps for each batch 
+                max_dec_len = max(original_target_len)             # TODO check error : max decoder timesteps for each batch 
 
                 # Transfer tensors to GPU
                 batch_text = batch_text.to(device)
@@ -144,8 +209,9 @@ def main(course_dir, text_embedding_size, audio_embedding_size, image_embedding_
                 log.info("Starting forward pass")
                 # Forward
                 batch_out_distributions, loss = model(batch_text, original_text_lengths, batch_audio, original_audio_lengths, batch_images, original_img_lengths, batch_target_indices, original_target_len, max_dec_len)
-                loss_val = loss.item()           # numerical value of loss
+                loss_val = util.all_reduce_mean(loss.detach()).item()           # numerical value of loss, averaged over ranks
                 loss_epoch = loss_epoch + loss_val
+                count_item += 1
                 
                 log.info("Starting backward")
 
@@ -154,38 +220,53 @@ def main(course_dir, text_embedding_size, audio_embedding_size, image_embedding_
                 nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)        # To tackle exploding gradients
                 optimizer.step()
                 scheduler.step(step // batch_size)
-                ema(model, step // batch_size)
+                if is_main:
+                    ema(model, step // batch_size)
 
-                # Log info
-                step += batch_size
-                progress_bar.update(batch_size)
+                # Log info, step counts examples seen by all ranks
+                step += batch_size * world_size
+                samples_done += batch_size
+                progress_bar.update(batch_size * world_size)
                 progress_bar.set_postfix(epoch=epoch,
                                          NLL=loss_val)
-                tbx.add_scalar('train/NL', loss_val, step)
-                tbx.add_scalar('train/LR',
-                               optimizer.param_groups[0]['lr'],
-                               step)
-                
-                steps_till_eval -= batch_size
+                if is_main:
+                    tbx.add_scalar('train/NL', loss_val, step)
+                    tbx.add_scalar('train/LR',
+                                   optimizer.param_groups[0]['lr'],
+                                   step)
+                    tbx.add_scalar('train/examples_per_sec',
+                                   count_item * batch_size * world_size / (time.time() - epoch_start),
+                                   step)
+
+                steps_till_eval -= batch_size * world_size
                 if steps_till_eval <= 0:
                     steps_till_eval = args.eval_steps
 
-                    # Evaluate and save checkpoint
-                    log.info(f'Evaluating at step {step}...')
-                    ema.assign(model)
-                    # TODO
-                    # scores, results = evaluate(model, dev_loader, device,
-                    #                               args.dev_eval_file,
-                    #                               args.max_ans_len,
-                    #                               args.use_squad_v2)
-                    saver.save(step, model, device)
-                    ema.resume(model)
-
-                # Generate summary
-                print('Generated summary for iteration {}: '.format(epoch))
-                summaries = get_generated_summaries(batch_out_distributions, original_text_lengths, batch_source_paths)
-                print(summaries)
-                
+                    # Every rank contributes its RNG state so that training resumes exactly
+                    rng_states = util.all_gather_object(util.get_rng_state())
+                    if is_main:
+                        # Evaluate and save checkpoint
+                        log.info(f'Evaluating at step {step}...')
+                        train_state = {
+                            'epoch': epoch,
+                            'samples_done': samples_done,
+                            'steps_till_eval': steps_till_eval,
+                            'optimizer': optimizer.state_dict(),
+                            'scheduler': scheduler.state_dict(),
+                            'rng_states': rng_states,
+                        }
+                        saver.save(step, model, device, ema=ema, train_state=train_state, report_later=True)
+                        if profiler is not None:
+                            profiler.add_scalars(tbx, step)
+                            profiler.write_json(os.path.join(args.save_dir, 'profile.json'))
+                        if not validator.submit(step, model, ema):
+                            log.warning(f'Previous validation still running, skipping validation at step {step}')
+                            saver.report(step, None)
+
+                # Collect finished validations without waiting for them
+                if is_main:
+                    report_validation(validator.poll())
+
                 # Evaluation
                 # rouge = Rouge()
                 # rouge_scores = rouge.get_scores(batch_source_paths, batch_target_paths, avg=True)
@@ -199,7 +280,15 @@ def main(course_dir, text_embedding_size, audio_embedding_size, image_embedding_
                 # ax = sns.heatmap(out_distributions)
                 # fig = ax.get_figure()
                 # fig.savefig(out_heatmaps_dir + str(epoch) + '.png')
-            print("Epoch loss is : {}".format(loss_epoch/count_item))
+            log.info("Epoch loss is : {}".format(loss_epoch/max(1, count_item)))
+            log.info("Epoch throughput : {:.2f} examples/sec".format(count_item * batch_size * world_size / (time.time() - epoch_start)))
+
+    if is_main:
+        report_validation(validator.close())
+        saver.wait()
+        if profiler is not None:
+            profiler.write_json(os.path.join(args.save_dir, 'profile.json'))
+    util.cleanup_distributed()
 
 if __name__ == '__main__':
     course_dir = '/home/anish17281/NLP_Dataset/dataset/'
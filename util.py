@@ -1,17 +1,22 @@
 import os
 import logging
 import queue
+import random
 import re
 import shutil
 import string
+import threading
 import torch
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import tqdm
 import numpy as np
 import ujson as json
 
+from collections import OrderedDict
+
 from torch.utils.data import Dataset
 
 def masked_softmax(logits, mask, dim=-1, log_softmax=False):
@@ -60,12 +65,15 @@ def get_save_dir(base_dir, name, training, id_max=100):
     raise RuntimeError('Too many save directories created with the same name. \
                        Delete old save directories or use another name.')
 
-def get_logger(log_dir, name):
+def get_logger(log_dir, name, rank=0, file_name='log.txt'):
     """Get a `logging.Logger` instance that prints to the console
     and an auxiliary file.
     Args:
         log_dir (str): Directory in which to create the log file.
         name (str): Name to identify the logs.
+        rank (int): Distributed rank. Ranks other than 0 write to their own
+            log file and only print warnings to the console.
+        file_name (str): Name of the log file of rank 0.
     Returns:
         logger (logging.Logger): Logger instance for logging events.
     """
@@ -85,17 +93,17 @@ def get_logger(log_dir, name):
                 self.handleError(record)
 
     # Create logger
-    logger = logging.getLogger(name)
+    logger = logging.getLogger(name if rank == 0 else f'{name}-rank{rank}')
     logger.setLevel(logging.DEBUG)
 
     # Log everything (i.e., DEBUG level and above) to a file
-    log_path = os.path.join(log_dir, 'log.txt')
+    log_path = os.path.join(log_dir, file_name if rank == 0 else f'log_rank{rank}.txt')
     file_handler = logging.FileHandler(log_path)
     file_handler.setLevel(logging.DEBUG)
 
     # Log everything except DEBUG level (i.e., INFO level and above) to console
     console_handler = StreamHandlerWithTQDM()
-    console_handler.setLevel(logging.INFO)
+    console_handler.setLevel(logging.INFO if rank == 0 else logging.WARNING)
 
     # Create format for the logs
     file_formatter = logging.Formatter('[%(asctime)s] %(message)s',
@@ -128,13 +136,112 @@ def get_available_devices():
 
     return device, gpu_ids
 
-def load_model(model, checkpoint_path, device, gpu_ids, return_step=True):
+def init_distributed(backend='gloo'):
+    """Initialise `torch.distributed` from the environment set up by `torchrun`.
+    When the script is not launched through `torchrun` (or with a single
+    process) nothing is initialised and the run behaves as before.
+    Args:
+        backend (str): Backend for the process group. `gloo` works on CPU nodes.
+    Returns:
+        rank (int): Global rank of this process.
+        world_size (int): Total number of training processes.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+
+    dist.init_process_group(backend=backend)
+
+    # Split the cores of a node between the processes running on it
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+    return dist.get_rank(), dist.get_world_size()
+
+def is_distributed():
+    """Check whether a multi-process group has been initialised."""
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process():
+    """Check whether this is rank 0 (always true without a process group)."""
+    return not is_distributed() or dist.get_rank() == 0
+
+def broadcast_object(obj, src=0):
+    """Send a picklable object from rank `src` to every other rank.
+    Args:
+        obj: Object to send. Ignored on ranks other than `src`.
+        src (int): Rank holding the object.
+    Returns:
+        obj: The object held by rank `src`.
+    """
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+def all_reduce_mean(tensor):
+    """Average a tensor over all processes (no-op without a process group).
+    Args:
+        tensor (torch.Tensor): Value computed on this rank, e.g. the batch loss.
+    Returns:
+        tensor (torch.Tensor): Mean of the value across ranks.
+    """
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / dist.get_world_size()
+
+def cleanup_distributed():
+    """Tear down the process group if one was created."""
+    if is_distributed():
+        dist.destroy_process_group()
+
+def all_gather_object(obj):
+    """Collect a picklable object from every process.
+    Args:
+        obj: Object computed on this rank.
+    Returns:
+        objs (list): The object of every rank, indexed by rank.
+    """
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+def get_rng_state():
+    """Capture the Python, NumPy and PyTorch random number generator states.
+    Everything is stored as tensors or plain Python values so that the state
+    can be saved in a checkpoint.
+    """
+    np_state = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64))) + tuple(np_state[2:]),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+def set_rng_state(rng_state):
+    """Restore generator states captured by `get_rng_state`."""
+    random.setstate(rng_state['python'])
+    np_state = rng_state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(rng_state['torch'])
+    if torch.cuda.is_available() and rng_state['cuda']:
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+def load_model(model, checkpoint_path, device, gpu_ids, return_step=True, use_ema=True):
     """Load model parameters from disk.
     Args:
         model (torch.nn.DataParallel): Load parameters into this model.
         checkpoint_path (str): Path to checkpoint to load.
         gpu_ids (list): GPU IDs for DataParallel.
         return_step (bool): Also return the step at which checkpoint was saved.
+        use_ema (bool): Load the exponential moving average of the parameters
+            when the checkpoint carries one, rather than the raw training weights.
     Returns:
         model (torch.nn.DataParallel): Model loaded from checkpoint.
         step (int): Step at which checkpoint was saved. Only if `return_step`.
@@ -144,6 +251,10 @@ def load_model(model, checkpoint_path, device, gpu_ids, return_step=True):
 
     # Build model, load parameters
     model.load_state_dict(ckpt_dict['model_state'])
+    if use_ema and 'ema_state' in ckpt_dict:
+        ema = EMA(model, ckpt_dict['ema_state']['decay'])
+        ema.load_state_dict(ckpt_dict['ema_state'])
+        ema.assign(model)
 
     if return_step:
         step = ckpt_dict['step']
@@ -151,30 +262,64 @@ def load_model(model, checkpoint_path, device, gpu_ids, return_step=True):
 
     return model
 
+def load_training_state(checkpoint_path, device):
+    """Load the state needed to resume training exactly where a checkpoint was saved.
+    Args:
+        checkpoint_path (str): Path to checkpoint to load.
+        device (torch.device): Device to map the optimizer state to.
+    Returns:
+        train_state (dict): Optimizer, scheduler and RNG states plus the position
+            in the epoch. None for checkpoints that only carry model weights.
+        ema_state (dict): EMA state (see `EMA.state_dict`), or None.
+    """
+    ckpt_dict = torch.load(checkpoint_path, map_location=device)
+    return ckpt_dict.get('train_state'), ckpt_dict.get('ema_state')
+
 class EMA:
     """Exponential moving average of model parameters.
+    The shadow weights live in a single flat buffer and are updated in place
+    with multi-tensor (`torch._foreach_*`) ops, so an update allocates no
+    per-parameter temporaries. `assign` and `resume` swap the parameter
+    storages with the shadow views instead of copying them.
     Args:
         model (torch.nn.Module): Model with parameters whose EMA will be kept.
         decay (float): Decay rate for exponential moving average.
     """
     def __init__(self, model, decay):
         self.decay = decay
-        self.shadow = {}
-        self.original = {}
+        self.names = []
+        params = []
 
         # Register model parameters
         for name, param in model.named_parameters():
             if param.requires_grad:
-                self.shadow[name] = param.data.clone()
+                self.names.append(name)
+                params.append(param.data)
+
+        # One contiguous buffer, `self.shadow` holds a view per parameter
+        self.flat_shadow = torch.cat([param.reshape(-1) for param in params])
+        self.shadow = self._views(self.flat_shadow, params)
+        self.original = None
+
+    @staticmethod
+    def _views(flat, params):
+        views, offset = [], 0
+        for param in params:
+            views.append(flat[offset:offset + param.numel()].view_as(param))
+            offset += param.numel()
+        return views
+
+    def _params(self, model):
+        params = [param for name, param in model.named_parameters() if param.requires_grad]
+        assert len(params) == len(self.shadow), 'Model parameters do not match the EMA'
+        return params
 
     def __call__(self, model, num_updates):
         decay = min(self.decay, (1.0 + num_updates) / (10.0 + num_updates))
-        for name, param in model.named_parameters():
-            if param.requires_grad:
-                assert name in self.shadow
-                new_average = \
-                    (1.0 - decay) * param.data + decay * self.shadow[name]
-                self.shadow[name] = new_average.clone()
+        params = [param.data for param in self._params(model)]
+        # shadow = decay * shadow + (1 - decay) * param
+        torch._foreach_mul_(self.shadow, decay)
+        torch._foreach_add_(self.shadow, params, alpha=1.0 - decay)
 
     def assign(self, model):
         """Assign exponential moving average of parameter values to the
@@ -182,11 +327,10 @@ class EMA:
         Args:
             model (torch.nn.Module): Model to assign parameter values.
         """
-        for name, param in model.named_parameters():
-            if param.requires_grad:
-                assert name in self.shadow
-                self.original[name] = param.data.clone()
-                param.data = self.shadow[name]
+        params = self._params(model)
+        self.original = [param.data for param in params]
+        for param, shadow in zip(params, self.shadow):
+            param.data = shadow
 
     def resume(self, model):
         """Restore original parameters to a model. That is, put back
@@ -194,16 +338,33 @@ class EMA:
         Args:
             model (torch.nn.Module): Model to assign parameter values.
         """
-        for name, param in model.named_parameters():
-            if param.requires_grad:
-                assert name in self.shadow
-                param.data = self.original[name]
+        assert self.original is not None, '`resume` called before `assign`'
+        for param, original in zip(self._params(model), self.original):
+            param.data = original
+        self.original = None
+
+    def state_dict(self):
+        """Get the EMA state to store in a checkpoint. Like `nn.Module.state_dict`,
+        the shadow buffer is returned by reference."""
+        return {'decay': self.decay,
+                'names': list(self.names),
+                'shadow': self.flat_shadow}
+
+    def load_state_dict(self, state_dict):
+        """Restore the shadow weights from `state_dict` (see `state_dict`)."""
+        assert state_dict['names'] == self.names, 'EMA state does not match the model parameters'
+        self.decay = state_dict['decay']
+        self.flat_shadow.copy_(state_dict['shadow'])
 
 class CheckpointSaver:
     """Class to save and load model checkpoints.
     Save the best checkpoints as measured by a metric value passed into the
     `save` method. Overwrite checkpoints with better checkpoints once
     `max_checkpoints` have been saved.
+
+    Saving only costs the training loop a copy of the state dict into a
+    reused host buffer. Serialization, the atomic rename and the retention
+    policy run on a background thread.
     Args:
         save_dir (str): Directory to save checkpoints.
         max_checkpoints (int): Maximum number of checkpoints to keep before
@@ -213,6 +374,10 @@ class CheckpointSaver:
             the metric value passed in via `save`. Otherwise, best checkpoint
             minimizes the metric.
         log (logging.Logger): Optional logger for printing information.
+
+    The metric of a checkpoint may also be reported after it has been saved
+    (e.g. by a validation running in another process): save it with
+    `report_later=True` and call `report` once the metric is known.
     """
     def __init__(self, save_dir, max_checkpoints, metric_name,
                  maximize_metric=False, log=None):
@@ -227,6 +392,13 @@ class CheckpointSaver:
         self.log = log
         self._print(f"Saver will {'max' if maximize_metric else 'min'}imize {metric_name}...")
 
+        # Host-side copy of the state dict, allocated on the first save and reused afterwards
+        self.host_buffer = {}
+        self.pending_paths = {}
+        self.jobs = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
     def is_best(self, metric_val):
         """Check whether `metric_val` is the best seen so far.
         Args:
@@ -248,48 +420,125 @@ class CheckpointSaver:
         if self.log is not None:
             self.log.info(message)
 
-    def save(self, step, model, device, metric_val=0):
+    def _snapshot(self, key, value):
+        """Copy `value` into the host buffer. Tensors are copied into buffers
+        reused across saves, containers are rebuilt, other values are kept as is."""
+        if torch.is_tensor(value):
+            buf = self.host_buffer.get(key)
+            if buf is None or buf.shape != value.shape or buf.dtype != value.dtype:
+                buf = torch.empty(value.shape, dtype=value.dtype,
+                                  pin_memory=value.is_cuda)
+                self.host_buffer[key] = buf
+            buf.copy_(value.detach(), non_blocking=True)
+            return buf
+        if isinstance(value, dict):
+            snapshot = type(value)() if isinstance(value, OrderedDict) else {}
+            for k, v in value.items():
+                snapshot[k] = self._snapshot(f'{key}.{k}', v)
+            if hasattr(value, '_metadata'):
+                snapshot._metadata = value._metadata
+            return snapshot
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(f'{key}.{i}', v) for i, v in enumerate(value))
+        return value
+
+    def save(self, step, model, device, metric_val=0, ema=None, train_state=None, report_later=False):
         """Save model parameters to disk.
+        Returns once the parameters have been copied to the host buffer,
+        the checkpoint is written in the background.
         Args:
             step (int): Total number of examples seen during training so far.
             model (torch.nn.DataParallel): Model to save.
             metric_val (float): Determines whether checkpoint is best so far.
             device (torch.device): Device where model resides.
+            ema (EMA): Exponential moving average to store next to the raw weights.
+            train_state (dict): Optimizer, scheduler, RNG and sampler state
+                needed to resume training (see `load_training_state`).
+            report_later (bool): The metric will be passed to `report` later,
+                until then the checkpoint is kept out of the retention policy.
         """
+        # The host buffer is shared, so the previous checkpoint must be on disk first
+        self.jobs.join()
+
         ckpt_dict = {
             'model_name': model.__class__.__name__,
-            'model_state': model.cpu().state_dict(),
+            'model_state': self._snapshot('model_state', model.state_dict()),
             'step': step
         }
-        model.to(device)
+        if ema is not None:
+            ckpt_dict['ema_state'] = self._snapshot('ema_state', ema.state_dict())
+        if train_state is not None:
+            ckpt_dict['train_state'] = self._snapshot('train_state', train_state)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
 
         checkpoint_path = os.path.join(self.save_dir,
                                        f'step_{step}.pth.tar')
-        torch.save(ckpt_dict, checkpoint_path)
+        self.jobs.put((self._write, (ckpt_dict, checkpoint_path)))
+        if report_later:
+            self.pending_paths[step] = checkpoint_path
+        else:
+            self.jobs.put((self._rank, (step, checkpoint_path, metric_val)))
+
+    def report(self, step, metric_val):
+        """Apply the best-checkpoint and retention policy to a checkpoint
+        saved with `report_later=True`.
+        Args:
+            step (int): Step passed to `save`.
+            metric_val (float): Metric of the checkpoint, None if it could not
+                be evaluated (such checkpoints are removed first).
+        """
+        checkpoint_path = self.pending_paths.pop(step)
+        self.jobs.put((self._rank, (step, checkpoint_path, metric_val)))
+
+    def wait(self):
+        """Block until every pending checkpoint has been written."""
+        self.jobs.join()
+
+    def _write_loop(self):
+        while True:
+            fn, args = self.jobs.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                if self.log is not None:
+                    self.log.error(f'Checkpoint {fn.__name__} failed: {e}')
+            finally:
+                self.jobs.task_done()
+
+    def _write(self, ckpt_dict, checkpoint_path):
+        # Write to a temporary file first so a crash never leaves a truncated checkpoint
+        tmp_path = checkpoint_path + '.tmp'
+        torch.save(ckpt_dict, tmp_path)
+        os.replace(tmp_path, checkpoint_path)
         self._print(f'Saved checkpoint: {checkpoint_path}')
 
-        # if self.is_best(metric_val):
-        #     # Save the best model
-        #     self.best_val = metric_val
-        #     best_path = os.path.join(self.save_dir, 'best.pth.tar')
-        #     shutil.copy(checkpoint_path, best_path)
-        #     self._print(f'New best checkpoint at step {step}...')
-
-        # # Add checkpoint path to priority queue (lowest priority removed first)
-        # if self.maximize_metric:
-        #     priority_order = metric_val
-        # else:
-        #     priority_order = -metric_val
-
-        # self.ckpt_paths.put((priority_order, checkpoint_path))
-
-        # # Remove a checkpoint if more than max_checkpoints have been saved
-        # if self.ckpt_paths.qsize() > self.max_checkpoints:
-        #     _, worst_ckpt = self.ckpt_paths.get()
-        #     try:
-        #         os.remove(worst_ckpt)
-        #         self._print(f'Removed checkpoint: {worst_ckpt}')
-        #     except OSError:
-        #         # Avoid crashing if checkpoint has been removed or protected
-        #         pass
-                
\ No newline at end of file
+    def _rank(self, step, checkpoint_path, metric_val):
+        if self.is_best(metric_val):
+            # Save the best model
+            self.best_val = metric_val
+            best_path = os.path.join(self.save_dir, 'best.pth.tar')
+            shutil.copy(checkpoint_path, best_path + '.tmp')
+            os.replace(best_path + '.tmp', best_path)
+            self._print(f'New best checkpoint at step {step}...')
+
+        # Add checkpoint path to priority queue (lowest priority removed first,
+        # older checkpoints first on ties)
+        if metric_val is None:
+            priority_order = float('-inf')
+        elif self.maximize_metric:
+            priority_order = metric_val
+        else:
+            priority_order = -metric_val
+
+        self.ckpt_paths.put((priority_order, step, checkpoint_path))
+
+        # Remove a checkpoint if more than max_checkpoints have been saved
+        if self.ckpt_paths.qsize() > self.max_checkpoints:
+            _, _, worst_ckpt = self.ckpt_paths.get()
+            try:
+                os.remove(worst_ckpt)
+                self._print(f'Removed checkpoint: {worst_ckpt}')
+            except OSError:
+                # Avoid crashing if checkpoint has been removed or protected
+                pass